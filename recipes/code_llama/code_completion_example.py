@@ -11,7 +11,7 @@ import time
 import torch
 from transformers import AutoTokenizer
 
-from llama_recipes.inference.safety_utils import get_safety_checker
+from llama_recipes.inference.safety_utils import get_safety_checker, SafetyPipeline
 from llama_recipes.inference.model_utils import load_model, load_peft_model
 
 
@@ -63,9 +63,11 @@ def main(
                                         enable_salesforce_content_safety,
                                         enable_llamaguard_content_safety,
                                         )
+    # The checkers run concurrently instead of one after the other
+    safety_pipeline = SafetyPipeline(safety_checker)
 
     # Safety check of the user prompt
-    safety_results = [check(user_prompt) for check in safety_checker]
+    safety_results = safety_pipeline(user_prompt)
     are_safe = all([r[1] for r in safety_results])
     if are_safe:
         print("User prompt deemed safe.")
@@ -102,7 +104,7 @@ def main(
     output_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
     
     # Safety check of the model output
-    safety_results = [check(output_text) for check in safety_checker]
+    safety_results = safety_pipeline(output_text)
     are_safe = all([r[1] for r in safety_results])
     if are_safe:
         print("User input and model output deemed safe.")
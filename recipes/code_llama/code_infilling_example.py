@@ -11,7 +11,7 @@ import time
 
 from transformers import AutoTokenizer
 
-from llama_recipes.inference.safety_utils import get_safety_checker
+from llama_recipes.inference.safety_utils import get_safety_checker, SafetyPipeline
 from llama_recipes.inference.model_utils import load_model, load_peft_model
 
 def main(
@@ -63,9 +63,11 @@ def main(
                                         enable_salesforce_content_safety,
                                         enable_llamaguard_content_safety,
                                         )
+    # The checkers run concurrently instead of one after the other
+    safety_pipeline = SafetyPipeline(safety_checker)
 
     # Safety check of the user prompt
-    safety_results = [check(user_prompt) for check in safety_checker]
+    safety_results = safety_pipeline(user_prompt)
     are_safe = all([r[1] for r in safety_results])
     if are_safe:
         print("User prompt deemed safe.")
@@ -101,7 +103,7 @@ def main(
     print(f"the inference time is {e2e_inference_time} ms")
     filling = tokenizer.batch_decode(outputs[:, batch["input_ids"].shape[1]:], skip_special_tokens=True)[0]
     # Safety check of the model output
-    safety_results = [check(filling) for check in safety_checker]
+    safety_results = safety_pipeline(filling)
     are_safe = all([r[1] for r in safety_results])
     if are_safe:
         print("User input and model output deemed safe.")
@@ -4,15 +4,16 @@
 # from accelerate import init_empty_weights, load_checkpoint_and_dispatch
 
 import fire
+import json
 import os
 import sys
 
 import torch
 from transformers import AutoTokenizer
 
-from llama_recipes.inference.chat_utils import read_dialogs_from_file
+from llama_recipes.inference.chat_utils import group_by_length, left_pad, read_dialogs_from_file
 from llama_recipes.inference.model_utils import load_model, load_peft_model
-from llama_recipes.inference.safety_utils import get_safety_checker
+from llama_recipes.inference.safety_utils import get_safety_checker, SafetyPipeline
 from accelerate.utils import is_xpu_available
 
 def main(
@@ -36,6 +37,8 @@ def main(
     enable_saleforce_content_safety: bool=True, # Enable safety check woth Saleforce safety flan t5
     use_fast_kernels: bool = False, # Enable using SDPA from PyTorch Accelerated Transformers, make use Flash Attention and Xformer memory-efficient kernels
     enable_llamaguard_content_safety: bool = False,
+    batch_size: int=1, # Number of dialogs generated together, grouped by length
+    output_file: str=None, # [optional] JSONL file receiving the output and safety verdicts of every dialog
     **kwargs
 ):
     if prompt_file is not None:
@@ -66,46 +69,47 @@ def main(
         model = load_peft_model(model, peft_model)
 
     tokenizer = AutoTokenizer.from_pretrained(model_name)
-    tokenizer.add_special_tokens(
-        {
-
-            "pad_token": "<PAD>",
-        }
-    )
+    # Padding reuses an existing token, a new pad token would be missing from the embeddings
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token = tokenizer.eos_token
 
     chats = tokenizer.apply_chat_template(dialogs)
 
-    with torch.no_grad():
-        for idx, chat in enumerate(chats):
-            safety_checker = get_safety_checker(enable_azure_content_safety,
+    safety_checker = get_safety_checker(enable_azure_content_safety,
                                         enable_sensitive_topics,
                                         enable_saleforce_content_safety,
                                         enable_llamaguard_content_safety,
                                         )
-            # Safety check of the user prompt
-            safety_results = [check(dialogs[idx][0]["content"]) for check in safety_checker]
-            are_safe = all([r[1] for r in safety_results])
-            if are_safe:
-                print(f"User prompt deemed safe.")
-                print("User prompt:\n", dialogs[idx][0]["content"])
-                print("\n==================================\n")
-            else:
-                print("User prompt deemed unsafe.")
-                for method, is_safe, report in safety_results:
-                    if not is_safe:
-                        print(method)
-                        print(report)
-                print("Skipping the inferece as the prompt is not safe.")
-                sys.exit(1)  # Exit the program with an error status
-            tokens= torch.tensor(chat).long()
-            tokens= tokens.unsqueeze(0)
-            if is_xpu_available():
-                tokens= tokens.to("xpu:0")
-            else:
-                tokens= tokens.to("cuda:0")
+    # The checkers run concurrently instead of one after the other
+    safety_pipeline = SafetyPipeline(safety_checker)
+
+    # Safety check of all user prompts in one batch per checker
+    prompt_safety_results = safety_pipeline.check_batch([dialog[0]["content"] for dialog in dialogs])
+    safe_indices = []
+    for idx, safety_results in enumerate(prompt_safety_results):
+        if all([r[1] for r in safety_results]):
+            safe_indices.append(idx)
+            continue
+        print(f"User prompt of dialog {idx} deemed unsafe.")
+        for method, is_safe, report in safety_results:
+            if not is_safe:
+                print(method)
+                print(report)
+        print("Skipping the inference of this dialog as the prompt is not safe.")
+
+    # Dialogs of similar length are generated together, left padded to the longest dialog of their group
+    output_texts = [None] * len(dialogs)
+    device = "xpu:0" if is_xpu_available() else "cuda:0"
+    with torch.no_grad():
+        for group in group_by_length([chats[idx] for idx in safe_indices], batch_size):
+            indices = [safe_indices[i] for i in group]
+            input_ids, attention_mask = left_pad([chats[idx] for idx in indices], tokenizer.pad_token_id)
             outputs = model.generate(
-                input_ids=tokens,
+                input_ids=input_ids.to(device),
+                attention_mask=attention_mask.to(device),
+                pad_token_id=tokenizer.pad_token_id,
                 max_new_tokens=max_new_tokens,
+                min_new_tokens=min_new_tokens,
                 do_sample=do_sample,
                 top_p=top_p,
                 temperature=temperature,
@@ -115,24 +119,37 @@ def main(
                 length_penalty=length_penalty,
                 **kwargs
             )
-
-            output_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
-
-            # Safety check of the model output
-            safety_results = [check(output_text) for check in safety_checker]
-            are_safe = all([r[1] for r in safety_results])
-            if are_safe:
-                print("User input and model output deemed safe.")
-                print(f"Model output:\n{output_text}")
-                print("\n==================================\n")
-
-            else:
-                print("Model output deemed unsafe.")
-                for method, is_safe, report in safety_results:
-                    if not is_safe:
-                        print(method)
-                        print(report)
-
+            texts = tokenizer.batch_decode(outputs[:, input_ids.shape[1]:], skip_special_tokens=True)
+            for idx, output_text in zip(indices, texts):
+                output_texts[idx] = output_text
+
+    # Safety check of all model outputs in one batch per checker
+    output_safety_results = safety_pipeline.check_batch([output_texts[idx] for idx in safe_indices])
+    results = [{"dialog": dialog, "output": None, "prompt_safe": False, "output_safe": None} for dialog in dialogs]
+    for idx, safety_results in zip(safe_indices, output_safety_results):
+        are_safe = all([r[1] for r in safety_results])
+        results[idx].update(output=output_texts[idx], prompt_safe=True, output_safe=are_safe)
+        print("User prompt:\n", dialogs[idx][-1]["content"])
+        if are_safe:
+            print("User input and model output deemed safe.")
+            print(f"Model output:\n{output_texts[idx]}")
+        else:
+            print("Model output deemed unsafe.")
+            for method, is_safe, report in safety_results:
+                if not is_safe:
+                    print(method)
+                    print(report)
+        print("\n==================================\n")
+    safety_pipeline.close()
+
+    if output_file is not None:
+        with open(output_file, "w") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+        print(f"Results written to {output_file}")
+
+    if len(safe_indices) < len(dialogs):
+        sys.exit(1)  # Exit the program with an error status
 
 
 if __name__ == "__main__":
@@ -6,16 +6,10 @@
 import fire
 import os
 import sys
-import time
 import gradio as gr
 
-import torch
-from transformers import AutoTokenizer
-
-from llama_recipes.inference.safety_utils import get_safety_checker, AgentType
-from llama_recipes.inference.model_utils import load_model, load_peft_model
-
-from accelerate.utils import is_xpu_available
+from llama_recipes.inference.safety_utils import get_safety_checker, AgentType, SafetyPipeline
+from llama_recipes.inference.generation_utils import GenerationService
 
 def main(
     model_name,
@@ -38,18 +32,42 @@ def main(
     enable_llamaguard_content_safety: bool=False,
     max_padding_length: int=None, # the max padding length to be used with tokenizer padding the prompts.
     use_fast_kernels: bool = False, # Enable using SDPA from PyTroch Accelerated Transformers, make use Flash Attention and Xformer memory-efficient kernels
+    enable_prefix_cache: bool = False, # Reuse the keys and values of prompt prefixes shared by several requests, like a system prompt
     **kwargs
 ):
 
-  def inference(user_prompt, temperature, top_p, top_k, max_new_tokens, **kwargs,):
-    safety_checker = get_safety_checker(enable_azure_content_safety,
-                                        enable_sensitive_topics,
-                                        enable_salesforce_content_safety,
-                                        enable_llamaguard_content_safety
-                                        )
+  # The safety checkers are built once and reused by every request
+  safety_checker = get_safety_checker(enable_azure_content_safety,
+                                      enable_sensitive_topics,
+                                      enable_salesforce_content_safety,
+                                      enable_llamaguard_content_safety,
+                                      warm_up=True
+                                      )
+  # The checkers run concurrently instead of one after the other
+  safety_pipeline = SafetyPipeline(safety_checker)
+
+  # The model and tokenizer are loaded once and reused by every request
+  generation_service = GenerationService.from_pretrained(
+      model_name,
+      peft_model=peft_model,
+      quantization=quantization,
+      use_fast_kernels=use_fast_kernels,
+      warm_up=True,
+      enable_prefix_cache=enable_prefix_cache,
+      seed=seed,
+      max_padding_length=max_padding_length,
+      do_sample=do_sample,
+      min_length=min_length,
+      use_cache=use_cache,
+      repetition_penalty=repetition_penalty,
+      length_penalty=length_penalty,
+      **kwargs
+  )
 
+  def inference(user_prompt, temperature, top_p, top_k, max_new_tokens, **kwargs,):
     # Safety check of the user prompt
-    safety_results = [check(user_prompt) for check in safety_checker]
+    safety_results, latencies = safety_pipeline.check_with_latencies(user_prompt)
+    print("Safety check latency: " + ", ".join(f"{name} {latency * 1000:.1f} ms" for name, latency in latencies.items()))
     are_safe = all([r[1] for r in safety_results])
     if are_safe:
         print("User prompt deemed safe.")
@@ -63,49 +81,20 @@ def main(
         print("Skipping the inference as the prompt is not safe.")
         sys.exit(1)  # Exit the program with an error status
 
-    # Set the seeds for reproducibility
-    if is_xpu_available():
-        torch.xpu.manual_seed(seed)
-    else:
-        torch.cuda.manual_seed(seed)
-    torch.manual_seed(seed)
-
-    model = load_model(model_name, quantization, use_fast_kernels)
-    if peft_model:
-        model = load_peft_model(model, peft_model)
-
-    model.eval()
-
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    tokenizer.pad_token = tokenizer.eos_token
-
-    batch = tokenizer(user_prompt, padding='max_length', truncation=True, max_length=max_padding_length, return_tensors="pt")
-    if is_xpu_available():
-        batch = {k: v.to("xpu") for k, v in batch.items()}
-    else:
-        batch = {k: v.to("cuda") for k, v in batch.items()}
-
-    start = time.perf_counter()
-    with torch.no_grad():
-        outputs = model.generate(
-            **batch,
-            max_new_tokens=max_new_tokens,
-            do_sample=do_sample,
-            top_p=top_p,
-            temperature=temperature,
-            min_length=min_length,
-            use_cache=use_cache,
-            top_k=top_k,
-            repetition_penalty=repetition_penalty,
-            length_penalty=length_penalty,
-            **kwargs
-        )
-    e2e_inference_time = (time.perf_counter()-start)*1000
-    print(f"the inference time is {e2e_inference_time} ms")
-    output_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
+    result = generation_service.generate(
+        user_prompt,
+        max_new_tokens=max_new_tokens,
+        top_p=top_p,
+        temperature=temperature,
+        top_k=top_k,
+        **kwargs
+    )
+    print(f"the inference time is {result.latency * 1000} ms")
+    print(f"Generation: {result}")
+    output_text = result.text
 
     # Safety check of the model output
-    safety_results = [check(output_text, agent_type=AgentType.AGENT, user_prompt=user_prompt) for check in safety_checker]
+    safety_results = safety_pipeline(output_text, agent_type=AgentType.AGENT, user_prompt=user_prompt)
     are_safe = all([r[1] for r in safety_results])
     if are_safe:
         print("User input and model output deemed safe.")
@@ -5,7 +5,8 @@ import fire
 from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
 
 
-from llama_recipes.inference.prompt_format_utils import build_default_prompt, create_conversation, LlamaGuardVersion
+from llama_recipes.inference.prompt_format_utils import build_default_prompt, create_conversation, get_default_category_codes, LlamaGuardVersion
+from llama_recipes.inference.safety_utils import score_llama_guard_prompts
 from typing import List, Tuple
 from enum import Enum
 
@@ -15,7 +16,10 @@ class AgentType(Enum):
 
 def main(
     model_id: str = "meta-llama/LlamaGuard-7b",
-    llama_guard_version: LlamaGuardVersion = LlamaGuardVersion.LLAMA_GUARD_1
+    llama_guard_version: LlamaGuardVersion = LlamaGuardVersion.LLAMA_GUARD_1,
+    mode: str = "generate",
+    threshold: float = 0.5,
+    temperature: float = 1.0,
 ):
     """
     Entry point for Llama Guard inference sample script.
@@ -27,6 +31,11 @@ def main(
         model_id (str): The ID of the pretrained model to use for generation. This can be either the path to a local folder containing the model files,
             or the repository ID of a model hosted on the Hugging Face Hub. Defaults to 'meta-llama/LlamaGuard-7b'.
         llama_guard_version (LlamaGuardVersion): The version of the Llama Guard model to use for formatting prompts. Defaults to LLAMA_GUARD_1.
+        mode (str): 'generate' decodes the assessment of Llama Guard, 'score' prints the probability of 'unsafe' and of every category
+            computed from the logits of a single forward pass. Defaults to 'generate'.
+        threshold (float): The probability of 'unsafe' from which a prompt is classified unsafe in score mode. Defaults to 0.5.
+        temperature (float): Divides the logits in score mode. The default of 1.0 prints the uncalibrated probabilities of the model,
+            fit_llama_guard_temperature in llama_recipes.inference.safety_utils fits the temperature on labeled prompts. Defaults to 1.0.
     """
     try:
         llama_guard_version = LlamaGuardVersion[llama_guard_version]
@@ -50,6 +59,26 @@ def main(
 
     tokenizer = AutoTokenizer.from_pretrained(model_id)
     model = AutoModelForCausalLM.from_pretrained(model_id, quantization_config=quantization_config, device_map="auto")
+
+    if mode == "score":
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        formatted_prompts = [build_default_prompt(agent_type, create_conversation(messages), llama_guard_version) for messages, agent_type in prompts]
+        scores = score_llama_guard_prompts(
+            model,
+            tokenizer,
+            formatted_prompts,
+            get_default_category_codes(llama_guard_version),
+            threshold=threshold,
+            temperature=temperature,
+            add_special_tokens=True,
+        )
+        for prompt, score in zip(prompts, scores):
+            print(prompt[0])
+            print(f"> {'safe' if score.is_safe else 'unsafe'}\n{score}")
+            print("\n==================================\n")
+        return
     
     for prompt in prompts:
         formatted_prompt = build_default_prompt(
@@ -1,7 +1,28 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
-from llama_recipes.configs.peft import lora_config, llama_adapter_config, prefix_config
-from llama_recipes.configs.fsdp import fsdp_config
-from llama_recipes.configs.training import train_config
-from llama_recipes.configs.wandb import wandb_config
+import importlib
+
+_LAZY_IMPORTS = {
+    "lora_config": "llama_recipes.configs.peft",
+    "llama_adapter_config": "llama_recipes.configs.peft",
+    "prefix_config": "llama_recipes.configs.peft",
+    "fsdp_config": "llama_recipes.configs.fsdp",
+    "train_config": "llama_recipes.configs.training",
+    "wandb_config": "llama_recipes.configs.wandb",
+}
+
+__all__ = list(_LAZY_IMPORTS)
+
+
+def __getattr__(name):
+    # fsdp_config imports torch.distributed for its defaults, the other configs do not need it
+    if name in _LAZY_IMPORTS:
+        value = getattr(importlib.import_module(_LAZY_IMPORTS[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
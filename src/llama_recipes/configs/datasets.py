@@ -1,7 +1,7 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
     
 @dataclass
@@ -31,4 +31,27 @@ class custom_dataset:
     dataset: str = "custom_dataset"
     file: str = "examples/custom_dataset.py"
     train_split: str = "train"
-    test_split: str = "validation"
\ No newline at end of file
+    test_split: str = "validation"
+
+
+@dataclass
+class mixture_dataset:
+    dataset: str = "mixture_dataset"
+    sources: str = "alpaca_dataset:0.5,samsum_dataset:0.5" # comma separated dataset:weight pairs, the sources are configured with e.g. --alpaca_dataset.data_path
+    train_split: str = "train"
+    test_split: str = "test"
+    seed: int = 42 # seeds the order in which the sources are interleaved
+    num_samples: int = 0 # samples per epoch of the train split, 0 uses the total size of the sources
+    source_configs: dict = field(default_factory=dict) # filled with the config of each source by generate_dataset_config
+
+
+@dataclass
+class streaming_dataset:
+    dataset: str = "streaming_dataset"
+    train_split: str = "data/train/*.jsonl" # glob or comma separated globs of JSONL, JSON or Parquet shards
+    test_split: str = "data/validation/*.jsonl"
+    prompt_key: str = "prompt" # the prompt is excluded from the loss
+    response_key: str = "response"
+    text_key: str = "text" # records without a response are trained on this field
+    samples_per_epoch: int = 0 # per rank, 0 splits the max_train_step batches evenly over the epochs
+    seed: int = 42 # shuffles the shard order of every pass
\ No newline at end of file
@@ -16,7 +16,20 @@ class fsdp_config:
     replica_group_size: int=0 #requires hsdp to be set. This specifies the replica group size, which is world_size/sharding_group_size.
     checkpoint_type: StateDictType = StateDictType.SHARDED_STATE_DICT  # alternatively can use SHARDED_STATE_DICT save one file per rank, and can resize the world-size.
     fsdp_activation_checkpointing: bool=True
+    activation_checkpointing_policy: str="full" # alternatively "every_k_layers", "attention", "mlp" or "memory_budget"
+    activation_checkpointing_interval: int=2 # checkpoints every k-th decoder layer with the every_k_layers policy
+    activation_checkpointing_memory_budget_gb: float=0.0 # per GPU budget for the decoder layer activations with the memory_budget policy, layers are picked from a one step probe
+    activation_checkpointing_offload: bool=False # moves the activations of the selected modules to CPU memory instead of recomputing them
+    activation_checkpointing_save_ops: str="" # comma separated aten ops whose outputs are kept instead of recomputed, e.g. "mm", requires PyTorch 2.4
     fsdp_cpu_offload: bool=False
+    wrapping_granularity: str="layer" # alternatively "block", wraps the attention and MLP of every decoder layer in their own fsdp units
+    backward_prefetch: str="BACKWARD_PRE" # alternatively "BACKWARD_POST" or "NONE"
+    forward_prefetch: bool=False
+    limit_all_gathers: bool=True
+    autotune: bool=False # benchmarks candidate wrapping, prefetch, limit_all_gathers and sharding settings before training and trains with the fastest
+    autotune_steps: int=5 # timed steps per candidate
+    autotune_results_file: str="fsdp_autotune_results.json" # measured results are reused for runs with the same model and setup
+    gradient_accumulation_mode: str="memory" # alternatively "communication", runs all but the last micro step of gradient accumulation under no_sync() to skip their reduce-scatter at the cost of keeping the unsharded gradients in memory
     pure_bf16: bool = False
-    optimizer: str= "AdamW"
+    optimizer: str= "AdamW" # alternatively "anyprecision" (with pure_bf16) or "anyprecision_8bit" for blockwise quantized 8-bit optimizer states
     
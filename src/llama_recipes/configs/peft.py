@@ -9,7 +9,7 @@ class lora_config:
      r: int=8
      lora_alpha: int=32
      target_modules: List[str] = field(default_factory=lambda: ["q_proj", "v_proj"])
-     bias= "none"
+     bias: str= "none"
      task_type: str= "CAUSAL_LM"
      lora_dropout: float=0.05
      inference_mode: bool = False
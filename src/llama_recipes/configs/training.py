@@ -17,6 +17,7 @@ class train_config:
     gradient_accumulation_steps: int=1
     gradient_clipping: bool = False
     gradient_clipping_threshold: float = 1.0
+    optimizer_in_backward: bool = False # run the optimizer update per parameter during backward and free the gradient right away, requires gradient_accumulation_steps=1
     num_epochs: int=3
     max_train_step: int=0
     max_eval_step: int=0
@@ -28,7 +29,7 @@ class train_config:
     use_fp16: bool=False
     mixed_precision: bool=True
     val_batch_size: int=1
-    dataset = "samsum_dataset"
+    dataset: str = "samsum_dataset"
     peft_method: str = "lora" # None , llama_adapter, prefix
     use_peft: bool=False
     output_dir: str = "PATH/to/save/PEFT/model"
@@ -40,6 +41,11 @@ class train_config:
     dist_checkpoint_root_folder: str="PATH/to/save/FSDP/model" # will be used if using FSDP
     dist_checkpoint_folder: str="fine-tuned" # will be used if using FSDP
     save_optimizer: bool=False # will be used if using FSDP
+    resume_training_state: bool=False # continue after the epoch in the training_state.json of the last checkpoint and restore the state of the training data, the model weights are not reloaded
     use_fast_kernels: bool = False # Enable using SDPA from PyTroch Accelerated Transformers, make use Flash Attention and Xformer memory-efficient kernels
+    compile: bool = False # compiles every decoder layer with torch.compile after FSDP and activation checkpointing are applied
+    compile_mode: str = "default" # alternatively "reduce-overhead" or "max-autotune"
+    compile_dynamic: bool = None # compile for dynamic shapes, defaults to True with the padding batching strategy
+    compile_backend: str = "inductor"
     use_wandb: bool = False # Enable wandb for experient tracking
     save_metrics: bool = False # saves training metrics to a json file for later plotting
@@ -1,11 +1,13 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama Guard License Agreement.
 
-import copy
+import dataclasses
+import json
 import random
 from dataclasses import dataclass
 from enum import Enum
-from typing import Dict, List, Literal, Optional, Sequence
+from functools import lru_cache
+from typing import Dict, Iterable, List, Literal, Optional, Sequence, Tuple
 
 
 @dataclass
@@ -93,30 +95,74 @@ def create_formatted_finetuning_examples(
     in the llama guard prompts of the augmented examples. We occasionally need to
     convert between the two.
     """
+    return list(iter_formatted_finetuning_examples(training_examples, formatter_configs))
+
+
+# A training example, or one of its augmentations, with the order of the categories in its llama guard prompt
+ExamplePlan = Tuple[TrainingExample, List[int]]
+
+
+def iter_formatted_finetuning_examples(
+    training_examples: Iterable[TrainingExample],
+    formatter_configs: FormatterConfigs,
+) -> Iterable[str]:
+    """
+    Yields the same formatted examples as create_formatted_finetuning_examples, without holding them in memory.
+
+    The random choices, which category orders and augmentations every example gets, are drawn from one generator
+    seeded with formatter_configs.random_seed, in the order of create_formatted_finetuning_examples.
+    """
     _verify_formatter_configs(formatter_configs)
 
-    random.seed(formatter_configs.random_seed)
+    guidelines_texts = _GuidelinesTexts(formatter_configs)
+    for example_plan in _iter_example_plans(
+        training_examples, formatter_configs, random.Random(formatter_configs.random_seed)
+    ):
+        yield _format_example_plan(example_plan, formatter_configs, guidelines_texts)
 
-    indices_of_all_categories = range(len(formatter_configs.guidelines.categories))
 
-    to_return = []
+def write_formatted_finetuning_examples(
+    training_examples: Iterable[TrainingExample],
+    formatter_configs: FormatterConfigs,
+    output_path: str,
+) -> int:
+    """
+    Streams the formatted examples to a JSONL file with one {"text": ...} record per line.
+
+    Returns the number of written examples.
+    """
+    count = 0
+    with open(output_path, "w") as f:
+        for formatted_example in iter_formatted_finetuning_examples(training_examples, formatter_configs):
+            f.write(json.dumps({"text": formatted_example}) + "\n")
+            count += 1
+    return count
+
+
+def _iter_example_plans(
+    training_examples: Iterable[TrainingExample],
+    formatter_configs: FormatterConfigs,
+    rng: random.Random,
+) -> Iterable[ExamplePlan]:
+    indices_of_all_categories = range(len(formatter_configs.guidelines.categories))
 
     for training_example in training_examples:
-        to_return.append(
-            _create_formatted_finetuning_example(
+        example_plans = [
+            _plan_finetuning_example(
                 training_example,
                 formatter_configs,
                 category_indices_to_include_in_llama_guard_prompt=list(
                     indices_of_all_categories
                 ),
+                rng=rng,
             )
-        )
+        ]
 
         _maybe_add_data_augmentations_for_example(
-            training_example, to_return, indices_of_all_categories, formatter_configs
+            training_example, example_plans, indices_of_all_categories, formatter_configs, rng
         )
 
-    return to_return
+        yield from example_plans
 
 
 def _verify_formatter_configs(
@@ -139,22 +185,64 @@ def _verify_formatter_configs(
         )
 
 
-def _create_formatted_finetuning_example(
+def _plan_finetuning_example(
     training_example: TrainingExample,
     formatter_configs: FormatterConfigs,
     category_indices_to_include_in_llama_guard_prompt: List[int],
-) -> str:
+    rng: random.Random,
+) -> ExamplePlan:
     if formatter_configs.llama_guard_prompt_configs.should_shuffle_category_codes:
-        random.shuffle(category_indices_to_include_in_llama_guard_prompt)
+        rng.shuffle(category_indices_to_include_in_llama_guard_prompt)
     else:
         category_indices_to_include_in_llama_guard_prompt = sorted(
             category_indices_to_include_in_llama_guard_prompt
         )
 
+    return training_example, category_indices_to_include_in_llama_guard_prompt
+
+
+class _GuidelinesTexts:
+    """
+    The guidelines text of every (category subset, order), joined from fragments precomputed per category and code
+
+    The texts of the most recently used orders are kept, shuffled orders of many categories rarely repeat.
+    """
+
+    def __init__(self, formatter_configs: FormatterConfigs, max_cached_texts: int = 4096):
+        guidelines = formatter_configs.guidelines
+        should_include_category_descriptions = (
+            formatter_configs.llama_guard_prompt_configs.should_include_category_descriptions
+        )
+        # the text of every category for every code it can be given, indices start at 0 but codes at 1
+        self._fragments = [
+            [
+                f"{guidelines.category_code_prefix}{rewritten_category_index + 1}: {category.name}. "
+                + (f"\n{category.description}" if should_include_category_descriptions else "")
+                for rewritten_category_index in range(len(guidelines.categories))
+            ]
+            for category in guidelines.categories
+        ]
+        self.get = lru_cache(maxsize=max_cached_texts)(self._join)
+
+    def _join(self, category_indices: Tuple[int, ...]) -> str:
+        return "\n".join(
+            self._fragments[original_category_index][rewritten_category_index]
+            for rewritten_category_index, original_category_index in enumerate(category_indices)
+        )
+
+
+def _format_example_plan(
+    example_plan: ExamplePlan,
+    formatter_configs: FormatterConfigs,
+    guidelines_texts: _GuidelinesTexts,
+) -> str:
+    training_example, category_indices_to_include_in_llama_guard_prompt = example_plan
+
     llama_guard_prompt = _create_llama_guard_prompt(
         training_example,
         category_indices_to_include_in_llama_guard_prompt,
         formatter_configs,
+        guidelines_texts,
     )
 
     llama_guard_generation = _create_llama_guard_generation(
@@ -170,26 +258,9 @@ def _create_llama_guard_prompt(
     training_example: TrainingExample,
     category_indices_to_include: List[int],
     formatter_configs: FormatterConfigs,
+    guidelines_texts: _GuidelinesTexts,
 ) -> str:
-    full_guidelines_text = ""
-
-    for (
-        rewritten_category_index_for_current_prompt,
-        original_category_index,
-    ) in enumerate(category_indices_to_include):
-        category = formatter_configs.guidelines.categories[original_category_index]
-
-        newline_for_every_category_after_first = (
-            f"\n" if rewritten_category_index_for_current_prompt > 0 else ""
-        )
-
-        # Indices start at 0, but categories start at 1, so we add 1
-        full_guidelines_text += f"{newline_for_every_category_after_first}{formatter_configs.guidelines.category_code_prefix}{rewritten_category_index_for_current_prompt + 1}: {category.name}. "
-
-        if (
-            formatter_configs.llama_guard_prompt_configs.should_include_category_descriptions
-        ):
-            full_guidelines_text += f"\n{category.description}"
+    full_guidelines_text = guidelines_texts.get(tuple(category_indices_to_include))
 
     conversation = {"human": training_example.prompt}
 
@@ -285,9 +356,10 @@ def _get_map_of_original_category_indices_to_rewritten_category_codes(
 
 def _maybe_add_data_augmentations_for_example(
     training_example: TrainingExample,
-    formatted_examples_being_built: List[str],
+    example_plans_being_built: List[ExamplePlan],
     indices_of_all_categories: range,
     formatter_configs: FormatterConfigs,
+    rng: random.Random,
 ) -> None:
     violated_category_indices = _convert_category_codes_to_indices(
         training_example.violated_category_codes,
@@ -300,19 +372,21 @@ def _maybe_add_data_augmentations_for_example(
 
     _maybe_add_example_with_dropped_nonviolated_prompt_categories(
         training_example,
-        formatted_examples_being_built,
+        example_plans_being_built,
         indices_of_all_categories,
         nonviolated_category_indices,
         formatter_configs,
+        rng,
     )
 
     _maybe_add_example_with_dropped_violated_and_nonviolated_prompt_categories(
         training_example,
-        formatted_examples_being_built,
+        example_plans_being_built,
         indices_of_all_categories,
         violated_category_indices,
         nonviolated_category_indices,
         formatter_configs,
+        rng,
     )
 
 
@@ -328,10 +402,11 @@ def _convert_category_codes_to_indices(
 
 def _maybe_add_example_with_dropped_nonviolated_prompt_categories(
     training_example: TrainingExample,
-    formatted_examples_being_built: List[str],
+    example_plans_being_built: List[ExamplePlan],
     indices_of_all_categories: range,
     nonviolated_category_indices: List[int],
     formatter_configs: FormatterConfigs,
+    rng: random.Random,
 ) -> None:
     """
     If a prompt+response pair does not violate certain categories, we can augment
@@ -344,12 +419,12 @@ def _maybe_add_example_with_dropped_nonviolated_prompt_categories(
     ):
         return
 
-    number_of_categories_to_drop = random.randint(0, len(nonviolated_category_indices))
+    number_of_categories_to_drop = rng.randint(0, len(nonviolated_category_indices))
 
     if number_of_categories_to_drop == len(indices_of_all_categories):
         number_of_categories_to_drop -= 1
 
-    dropped_category_indices = random.sample(
+    dropped_category_indices = rng.sample(
         nonviolated_category_indices, number_of_categories_to_drop
     )
 
@@ -357,22 +432,24 @@ def _maybe_add_example_with_dropped_nonviolated_prompt_categories(
         set(indices_of_all_categories) - (set(dropped_category_indices))
     )
 
-    formatted_examples_being_built.append(
-        _create_formatted_finetuning_example(
+    example_plans_being_built.append(
+        _plan_finetuning_example(
             training_example,
             formatter_configs,
             category_indices_to_include_in_llama_guard_prompt=retained_category_indices,
+            rng=rng,
         )
     )
 
 
 def _maybe_add_example_with_dropped_violated_and_nonviolated_prompt_categories(
     training_example: TrainingExample,
-    formatted_examples_being_built: List[str],
+    example_plans_being_built: List[ExamplePlan],
     indices_of_all_categories: range,
     violated_category_indices: List[int],
     nonviolated_category_indices: List[int],
     formatter_configs: FormatterConfigs,
+    rng: random.Random,
 ) -> None:
     """
     Same as in _maybe_add_example_with_dropped_nonviolated_prompt_categories but we
@@ -384,9 +461,9 @@ def _maybe_add_example_with_dropped_violated_and_nonviolated_prompt_categories(
     ):
         return
 
-    random_nonviolated_category_indices_to_drop = random.sample(
+    random_nonviolated_category_indices_to_drop = rng.sample(
         nonviolated_category_indices,
-        random.randint(0, len(nonviolated_category_indices) - 1),
+        rng.randint(0, len(nonviolated_category_indices) - 1),
     )
 
     set_of_retained_category_indices = (
@@ -395,19 +472,21 @@ def _maybe_add_example_with_dropped_violated_and_nonviolated_prompt_categories(
         - set(random_nonviolated_category_indices_to_drop)
     )
 
-    training_example_copy = copy.deepcopy(training_example)
-    training_example_copy.label = "safe"
-    training_example_copy.violated_category_codes = []
-    training_example_copy.explanation = (
-        formatter_configs.augmentation_configs.explanation_for_augmentation_with_dropped_violated_and_nonviolated_prompt_categories
+    # a shallow copy is enough, the fields which differ from the original are replaced
+    training_example_copy = dataclasses.replace(
+        training_example,
+        label="safe",
+        violated_category_codes=[],
+        explanation=formatter_configs.augmentation_configs.explanation_for_augmentation_with_dropped_violated_and_nonviolated_prompt_categories,
     )
 
-    formatted_examples_being_built.append(
-        _create_formatted_finetuning_example(
+    example_plans_being_built.append(
+        _plan_finetuning_example(
             training_example_copy,
             formatter_configs,
             category_indices_to_include_in_llama_guard_prompt=list(
                 set_of_retained_category_indices
             ),
+            rng=rng,
         )
     )
\ No newline at end of file
@@ -1,6 +1,30 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
-from llama_recipes.datasets.grammar_dataset.grammar_dataset import get_dataset as get_grammar_dataset
-from llama_recipes.datasets.alpaca_dataset import InstructionDataset as get_alpaca_dataset
-from llama_recipes.datasets.samsum_dataset import get_preprocessed_samsum as get_samsum_dataset
\ No newline at end of file
+import importlib
+
+_LAZY_IMPORTS = {
+    "get_grammar_dataset": ("llama_recipes.datasets.grammar_dataset.grammar_dataset", "get_dataset"),
+    "get_alpaca_dataset": ("llama_recipes.datasets.alpaca_dataset", "InstructionDataset"),
+    "get_samsum_dataset": ("llama_recipes.datasets.samsum_dataset", "get_preprocessed_samsum"),
+    "get_mixture_dataset": ("llama_recipes.datasets.mixture_dataset", "get_mixture_dataset"),
+    "MixtureDataset": ("llama_recipes.datasets.mixture_dataset", "MixtureDataset"),
+    "get_streaming_dataset": ("llama_recipes.datasets.streaming_dataset", "get_streaming_dataset"),
+    "StreamingDataset": ("llama_recipes.datasets.streaming_dataset", "StreamingDataset"),
+}
+
+__all__ = list(_LAZY_IMPORTS)
+
+
+def __getattr__(name):
+    # only the selected dataset is imported, together with the Hugging Face datasets library it may need
+    if name in _LAZY_IMPORTS:
+        module_name, attr = _LAZY_IMPORTS[name]
+        value = getattr(importlib.import_module(module_name), attr)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
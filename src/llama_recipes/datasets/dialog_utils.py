@@ -0,0 +1,133 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+from itertools import chain
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+
+B_INST, E_INST = "[INST]", "[/INST]"
+
+
+def build_message_tree(message_ids: Iterable[str], parent_ids: Iterable[Optional[str]]) -> Tuple[Dict[str, List[str]], List[str]]:
+    """
+    Builds the reply tree of a conversation dataset like OpenAssistant/oasst1
+
+    Returns the ids of the replies to every message, in dataset order, and the ids of the messages without parent.
+    """
+    children = {}
+    root_ids = []
+    for message_id, parent_id in zip(message_ids, parent_ids):
+        if parent_id:
+            children.setdefault(parent_id, []).append(message_id)
+        else:
+            root_ids.append(message_id)
+    return children, root_ids
+
+
+def get_threads(root_id: str, children: Dict[str, List[str]], min_length: int = 1) -> Iterable[List[str]]:
+    """
+    Yields the message ids of every thread from root_id to a leaf of the tree, in dataset order
+    """
+    # depth first without recursion, path holds the messages from the root to the current one
+    path = []
+    stack = [(root_id, 0)]
+    while stack:
+        message_id, depth = stack.pop()
+        del path[depth:]
+        path.append(message_id)
+        replies = children.get(message_id)
+        if replies:
+            stack.extend((reply_id, depth + 1) for reply_id in reversed(replies))
+        elif len(path) >= min_length:
+            yield list(path)
+
+
+def to_dialog(thread: List[str]) -> List[Dict[str, str]]:
+    """
+    Alternates the user and assistant role over the messages of a thread, starting with the user
+    """
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": content} for i, content in enumerate(thread)]
+
+
+def is_llama3_tokenizer(tokenizer) -> bool:
+    """
+    Returns whether the tokenizer has the Llama 3 chat tokens, independent of the size of its vocabulary
+    """
+    return "<|eot_id|>" in tokenizer.get_vocab()
+
+
+class _TextIndex(dict):
+    # numbers the distinct texts, so that repeated messages are tokenized once
+    def add(self, text: str) -> int:
+        return self.setdefault(text, len(self))
+
+
+def _get_llama3_segments(dialogs, tokenizer, texts: _TextIndex):
+    # <|begin_of_text|> then <|start_header_id|>role<|end_header_id|>\n\ncontent<|eot_id|> per message, which is
+    # the Llama 3 chat template without generation prompt. The special tokens split the text, so the header
+    # tokens are the same for every message and the content can be tokenized on its own.
+    bos = [tokenizer.bos_token_id]
+    eot = [tokenizer.convert_tokens_to_ids("<|eot_id|>")]
+    headers = {}
+    for dialog in dialogs:
+        segments = [(bos, False)]
+        for message in dialog:
+            role = message["role"]
+            if role not in headers:
+                headers[role] = tokenizer(f"<|start_header_id|>{role}<|end_header_id|>\n\n", add_special_tokens=False)["input_ids"]
+            is_assistant = role == "assistant"
+            segments.append((headers[role], is_assistant))
+            segments.append((texts.add(message["content"].strip()), is_assistant))
+            segments.append((eot, is_assistant))
+        yield segments
+
+
+def _get_llama2_segments(dialogs, tokenizer, texts: _TextIndex):
+    # every user message is paired with the following answer, a final unanswered message is dropped
+    for dialog in dialogs:
+        segments = []
+        for prompt, answer in zip(dialog[::2], dialog[1::2]):
+            segments.append((texts.add(f"{tokenizer.bos_token}{B_INST} {prompt['content'].strip()} {E_INST}"), False))
+            segments.append((texts.add(f"{answer['content'].strip()} {tokenizer.eos_token}"), True))
+        yield segments
+
+
+def tokenize_dialogs(dialogs: List[List[Dict[str, str]]], tokenizer) -> Dict[str, List[List[int]]]:
+    """
+    Tokenizes dialogs in the Llama 3 header format or the Llama 2 [INST] format, depending on the tokenizer
+
+    The distinct texts of all dialogs are tokenized with one batched tokenizer call. The labels are masked on
+    the concatenated tokens of all dialogs at once, which are then split into the dialogs. Only the assistant turns are kept in the labels, in the Llama 3
+    format with their header and end of turn token.
+
+    Returns input_ids, labels and attention_mask of every dialog, ready for datasets.Dataset.from_dict.
+    """
+    if not dialogs:
+        return {"input_ids": [], "labels": [], "attention_mask": []}
+    texts = _TextIndex()
+    get_segments = _get_llama3_segments if is_llama3_tokenizer(tokenizer) else _get_llama2_segments
+    dialog_segments = list(get_segments(dialogs, tokenizer, texts))
+
+    text_ids = tokenizer(list(texts), add_special_tokens=False)["input_ids"] if texts else []
+    segments = [
+        (text_ids[tokens] if isinstance(tokens, int) else tokens, is_assistant)
+        for segment_list in dialog_segments
+        for tokens, is_assistant in segment_list
+    ]
+    segment_lengths = np.fromiter((len(tokens) for tokens, _ in segments), dtype=np.int64, count=len(segments))
+    input_ids = np.fromiter(
+        chain.from_iterable(tokens for tokens, _ in segments), dtype=np.int64, count=int(segment_lengths.sum())
+    )
+    is_assistant = np.fromiter((is_assistant for _, is_assistant in segments), dtype=bool, count=len(segments))
+    labels = np.where(np.repeat(is_assistant, segment_lengths), input_ids, -100)
+
+    # token offsets where the next dialog starts in the concatenated arrays
+    segment_offsets = np.cumsum([len(segment_list) for segment_list in dialog_segments[:-1]], dtype=np.int64)
+    token_offsets = np.concatenate(([0], np.cumsum(segment_lengths)))[segment_offsets]
+    return {
+        "input_ids": [a.tolist() for a in np.split(input_ids, token_offsets)],
+        "labels": [a.tolist() for a in np.split(labels, token_offsets)],
+        "attention_mask": [a.tolist() for a in np.split(np.ones_like(input_ids), token_offsets)],
+    }
@@ -0,0 +1,152 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+from typing import Dict
+
+import torch
+from torch.utils.data import ConcatDataset as ConcatenatedDatasets
+from torch.utils.data import Dataset, IterableDataset
+
+
+def parse_mixture_weights(sources: str) -> Dict[str, float]:
+    """
+    Parses "alpaca_dataset:0.7,samsum_dataset:0.3" into {"alpaca_dataset": 0.7, "samsum_dataset": 0.3}, the weight defaults to 1
+    """
+    weights = {}
+    for source in sources.split(","):
+        source = source.strip()
+        if not source:
+            continue
+        name, _, weight = source.partition(":")
+        try:
+            weights[name.strip()] = float(weight) if weight else 1.0
+        except ValueError:
+            raise ValueError(f"Invalid weight {weight!r} for dataset {name} in mixture {sources!r}")
+    if not weights:
+        raise ValueError("The mixture does not contain any dataset")
+    return weights
+
+
+class MixtureDataset(Dataset):
+    """
+    Interleaves several datasets, drawing the source of every sample from their weights.
+
+    The sources are drawn once per epoch with a generator seeded from seed and epoch, samples are only read
+    from the sources when they are accessed. Sources that are drawn more often than they have samples are
+    cycled, each pass with a new permutation. pack returns a mixture of the packed sources, packing the
+    mixture itself would read every sample of the epoch up front.
+    """
+    def __init__(self, datasets: Dict[str, Dataset], weights: Dict[str, float], seed: int = 42, num_samples: int = 0):
+        self.datasets = datasets
+        self.names = list(datasets)
+        if sorted(self.names) != sorted(weights):
+            raise ValueError(f"Weights {list(weights)} do not match the datasets {self.names}")
+        if any(weight < 0 for weight in weights.values()) or sum(weights.values()) <= 0:
+            raise ValueError(f"Mixture weights must not be negative and at least one must be positive: {weights}")
+        empty = [name for name in self.names if len(datasets[name]) == 0 and weights[name] > 0]
+        if empty:
+            raise ValueError(f"The datasets {empty} of the mixture are empty")
+
+        self.weights = torch.tensor([float(weights[name]) for name in self.names], dtype=torch.float64)
+        self.seed = seed
+        self.requested_num_samples = num_samples
+        self.num_samples = num_samples or sum(len(d) for d in datasets.values())
+        self.token_counts = {name: 0 for name in self.names}
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        generator = torch.Generator().manual_seed(self.seed + epoch)
+        self.sources = torch.multinomial(self.weights, self.num_samples, replacement=True, generator=generator)
+        # how many samples of the same source come before each sample
+        self.offsets = torch.empty_like(self.sources)
+        for source in range(len(self.names)):
+            mask = self.sources == source
+            self.offsets[mask] = torch.arange(int(mask.sum()))
+        self._permutations = {}
+        self._counted = torch.zeros(self.num_samples, dtype=torch.bool)
+
+    def _get_permutation(self, source: int, cycle: int):
+        if (source, cycle) not in self._permutations:
+            # tuples of ints hash the same in every process
+            generator = torch.Generator().manual_seed(hash((self.seed, self.epoch, source, cycle)) % 2**63)
+            self._permutations[(source, cycle)] = torch.randperm(len(self.datasets[self.names[source]]), generator=generator)
+        return self._permutations[(source, cycle)]
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < self.num_samples:
+            raise IndexError(f"Index {idx} out of range for mixture of {self.num_samples} samples")
+        source, offset = int(self.sources[idx]), int(self.offsets[idx])
+        name = self.names[source]
+        cycle, position = divmod(offset, len(self.datasets[name]))
+        sample = self.datasets[name][int(self._get_permutation(source, cycle)[position])]
+        if not self._counted[idx]:
+            self._counted[idx] = True
+            self.token_counts[name] += len(sample["input_ids"])
+        return sample
+
+    def pack(self, chunk_size: int) -> "MixtureDataset":
+        """
+        Returns a mixture of the same weights that draws chunks of chunk_size tokens, packed within each source
+        """
+        from llama_recipes.data.concatenator import ConcatDataset
+
+        return MixtureDataset(
+            {name: ConcatDataset(dataset, chunk_size=chunk_size) for name, dataset in self.datasets.items()},
+            dict(zip(self.names, self.weights.tolist())),
+            seed=self.seed,
+            num_samples=self.requested_num_samples,
+        )
+
+    def get_sample_counts(self) -> Dict[str, int]:
+        counts = torch.bincount(self.sources, minlength=len(self.names))
+        return {name: int(count) for name, count in zip(self.names, counts)}
+
+    def state_dict(self):
+        return {
+            "names": self.names,
+            "weights": self.weights.tolist(),
+            "seed": self.seed,
+            "epoch": self.epoch,
+            "num_samples": self.num_samples,
+            "token_counts": dict(self.token_counts),
+            "counted": self._counted.nonzero().flatten().tolist(),
+        }
+
+    def load_state_dict(self, state_dict):
+        if state_dict["names"] != self.names:
+            raise ValueError(f"The state of mixture {state_dict['names']} does not match the datasets {self.names}")
+        self.weights = torch.tensor(state_dict["weights"], dtype=torch.float64)
+        self.seed = state_dict["seed"]
+        self.num_samples = state_dict["num_samples"]
+        self.set_epoch(state_dict["epoch"])
+        self.token_counts = dict(state_dict["token_counts"])
+        self._counted[state_dict["counted"]] = True
+
+
+def get_mixture_dataset(dataset_config, tokenizer, split):
+    from llama_recipes.utils.config_utils import get_dataset_configs
+    from llama_recipes.utils.dataset_utils import get_preprocessed_dataset
+
+    weights = parse_mixture_weights(dataset_config.sources)
+    source_split = "train" if split == dataset_config.train_split else "test"
+    datasets = {}
+    for name in weights:
+        if name == dataset_config.dataset:
+            raise ValueError("A mixture can not contain another mixture")
+        if name not in dataset_config.source_configs:
+            dataset_configs = get_dataset_configs()
+            if name not in dataset_configs:
+                raise ValueError(f"Unknown dataset {name} in mixture, choose from {list(dataset_configs)}")
+            dataset_config.source_configs[name] = dataset_configs[name]()
+        datasets[name] = get_preprocessed_dataset(tokenizer, dataset_config.source_configs[name], split=source_split)
+        if isinstance(datasets[name], IterableDataset):
+            raise ValueError(f"Streaming dataset {name} can not be part of a mixture")
+
+    if source_split == "test":
+        # every source is validated on its whole split, independent of its training weight
+        return ConcatenatedDatasets(list(datasets.values()))
+    return MixtureDataset(datasets, weights, seed=dataset_config.seed, num_samples=dataset_config.num_samples)
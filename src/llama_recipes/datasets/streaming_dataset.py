@@ -0,0 +1,218 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import glob
+import json
+import os
+import random
+import time
+from typing import Callable, List, Optional
+
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+def get_shard_files(pattern: str) -> List[str]:
+    """
+    Expands a glob or a comma separated list of globs into the sorted list of JSONL and Parquet shards
+    """
+    files = []
+    for p in pattern.split(","):
+        p = os.path.expanduser(p.strip())
+        if p:
+            files.extend(sorted(glob.glob(p)) or ([p] if os.path.isfile(p) else []))
+    if not files:
+        raise FileNotFoundError(f"No shards found for {pattern}")
+    unsupported = [f for f in files if not f.endswith((".jsonl", ".json", ".parquet"))]
+    if unsupported:
+        raise ValueError(f"Shards {unsupported} are not .jsonl, .json or .parquet files")
+    return files
+
+
+def read_shard(path: str, skip: Optional[Callable[[], bool]] = None):
+    """
+    Yields the records of a shard, skip is called once per record and drops it if it returns True
+
+    JSONL records are dropped before they are parsed.
+    """
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Reading Parquet shards requires pyarrow. Please install it using pip install pyarrow")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=1024):
+            yield from (record for record in batch.to_pylist() if skip is None or not skip())
+    elif path.endswith(".json"):
+        with open(path) as f:
+            records = json.load(f)
+        if not isinstance(records, list):
+            raise ValueError(f"{path} does not contain a list of records")
+        yield from (record for record in records if skip is None or not skip())
+    else:
+        with open(path) as f:
+            for line in f:
+                if line.strip() and (skip is None or not skip()):
+                    yield json.loads(line)
+
+
+class StreamingDataset(IterableDataset):
+    """
+    Streams JSONL or Parquet shards, tokenizing and optionally packing the records in the DataLoader workers.
+
+    Every rank and worker reads a disjoint part of the data: whole shards if there are at least as many shards
+    as readers, otherwise every reader keeps every n-th record. The stream cycles over the shards, with a
+    new shard order each pass, and continues where it stopped in the next epoch, which needs persistent
+    DataLoader workers. With restart_each_epoch every epoch starts again at the beginning of the stream,
+    so a validation split is evaluated on the same records every time. An epoch ends after the number of
+    batches set with set_epoch_length.
+    """
+    def __init__(
+        self,
+        files: List[str],
+        tokenizer,
+        prompt_key: str = "prompt",
+        response_key: str = "response",
+        text_key: str = "text",
+        chunk_size: Optional[int] = None,
+        samples_per_epoch: int = 0,
+        seed: int = 42,
+        rank: Optional[int] = None,
+        world_size: Optional[int] = None,
+        restart_each_epoch: bool = False,
+    ):
+        self.files = files
+        self.tokenizer = tokenizer
+        self.prompt_key = prompt_key
+        self.response_key = response_key
+        self.text_key = text_key
+        self.chunk_size = chunk_size
+        self.samples_per_epoch = samples_per_epoch
+        self.seed = seed
+        distributed = dist.is_available() and dist.is_initialized()
+        self.rank = rank if rank is not None else (dist.get_rank() if distributed else 0)
+        self.world_size = world_size if world_size is not None else (dist.get_world_size() if distributed else 1)
+        self.restart_each_epoch = restart_each_epoch
+        self.num_batches = None
+        self.batch_size = 1
+        self._stream = None
+        self.stats = {"records": 0, "tokens": 0, "samples": 0, "read_time": 0.0, "tokenize_time": 0.0, "pack_time": 0.0}
+
+    def set_epoch_length(self, num_batches: int, batch_size: int):
+        self.num_batches = num_batches
+        self.batch_size = batch_size
+
+    def __len__(self):
+        if self.num_batches is None:
+            raise TypeError("The length of a StreamingDataset is only known after set_epoch_length")
+        return self.num_batches * self.batch_size
+
+    def _read(self, reader_id: int, num_readers: int):
+        num_passes = 0
+        while True:
+            files = list(self.files)
+            random.Random(self.seed + num_passes).shuffle(files)
+            shard_files = files[reader_id::num_readers] if len(files) >= num_readers else files
+            stride = 1 if len(files) >= num_readers else num_readers
+            index = 0
+            num_records = 0
+
+            def skip():
+                # the records of the other readers, counted over all shards of the pass
+                nonlocal index
+                index += 1
+                return (index - 1) % stride != reader_id
+
+            for path in shard_files:
+                records = read_shard(path, skip if stride > 1 else None)
+                while True:
+                    start = time.perf_counter()
+                    record = next(records, None)
+                    self.stats["read_time"] += time.perf_counter() - start
+                    if record is None:
+                        break
+                    num_records += 1
+                    yield record
+            if num_records == 0:
+                raise ValueError(f"Reader {reader_id} of {num_readers} did not find any records in {self.files}")
+            num_passes += 1
+
+    def tokenize(self, record):
+        tokenizer = self.tokenizer
+        if self.response_key in record:
+            prompt = tokenizer.encode(tokenizer.bos_token + record.get(self.prompt_key, ""), add_special_tokens=False)
+            response = tokenizer.encode(record[self.response_key] + tokenizer.eos_token, add_special_tokens=False)
+            labels = [-100] * len(prompt) + response
+        else:
+            prompt = []
+            response = tokenizer.encode(tokenizer.bos_token + record[self.text_key] + tokenizer.eos_token, add_special_tokens=False)
+            labels = list(response)
+        input_ids = prompt + response
+        return {"input_ids": input_ids, "attention_mask": [1] * len(input_ids), "labels": labels}
+
+    def _samples(self, reader_id: int, num_readers: int):
+        buffer = {"input_ids": [], "attention_mask": [], "labels": []}
+        for record in self._read(reader_id, num_readers):
+            start = time.perf_counter()
+            sample = self.tokenize(record)
+            self.stats["tokenize_time"] += time.perf_counter() - start
+            self.stats["records"] += 1
+            self.stats["tokens"] += len(sample["input_ids"])
+            if self.chunk_size is None:
+                yield sample
+                continue
+
+            start = time.perf_counter()
+            for k, v in sample.items():
+                buffer[k].extend(v)
+            chunks = []
+            while len(buffer["input_ids"]) >= self.chunk_size:
+                chunks.append({k: v[:self.chunk_size] for k, v in buffer.items()})
+                buffer = {k: v[self.chunk_size:] for k, v in buffer.items()}
+            self.stats["pack_time"] += time.perf_counter() - start
+            yield from chunks
+
+    def get_throughput(self):
+        throughput = {
+            "read_records_per_s": self.stats["records"] / max(self.stats["read_time"], 1e-9),
+            "tokenize_tokens_per_s": self.stats["tokens"] / max(self.stats["tokenize_time"], 1e-9),
+        }
+        if self.chunk_size is not None:
+            throughput["pack_samples_per_s"] = self.stats["samples"] / max(self.stats["pack_time"], 1e-9)
+        return throughput
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+        if self._stream is None or self.restart_each_epoch:
+            self._stream = self._samples(self.rank * num_workers + worker_id, self.world_size * num_workers)
+
+        num_samples = None
+        if self.num_batches is not None:
+            # whole batches per worker, so the DataLoader yields exactly num_batches
+            num_batches = self.num_batches // num_workers + (worker_id < self.num_batches % num_workers)
+            num_samples = num_batches * self.batch_size
+
+        count = 0
+        while num_samples is None or count < num_samples:
+            sample = next(self._stream)
+            self.stats["samples"] += 1
+            count += 1
+            yield sample
+
+        if self.rank == 0 and worker_id == 0:
+            throughput = ", ".join(f"{k} {v:.1f}" for k, v in self.get_throughput().items())
+            print(f"--> Streaming throughput of worker 0: {throughput}")
+
+
+def get_streaming_dataset(dataset_config, tokenizer, split):
+    return StreamingDataset(
+        get_shard_files(split),
+        tokenizer,
+        prompt_key=dataset_config.prompt_key,
+        response_key=dataset_config.response_key,
+        text_key=dataset_config.text_key,
+        samples_per_epoch=dataset_config.samples_per_epoch if split == dataset_config.train_split else 0,
+        seed=dataset_config.seed,
+        # the validation split is evaluated on the same records every epoch, so the losses can be compared
+        restart_each_epoch=split != dataset_config.train_split,
+    )
@@ -8,7 +8,6 @@ import fire
 import random
 import torch
 import torch.optim as optim
-from peft import get_peft_model, prepare_model_for_kbit_training
 from torch.distributed.fsdp import (
     FullyShardedDataParallel as FSDP,
     ShardingStrategy
@@ -16,17 +15,12 @@ from torch.distributed.fsdp import (
 
 from torch.distributed.fsdp.fully_sharded_data_parallel import CPUOffload
 from torch.optim.lr_scheduler import StepLR
-from transformers import (
-    AutoTokenizer,
-    LlamaForCausalLM,
-    LlamaConfig,
-)
-from transformers.models.llama.modeling_llama import LlamaDecoderLayer
 
 from llama_recipes.configs import fsdp_config as FSDP_CONFIG
 from llama_recipes.configs import train_config as TRAIN_CONFIG
 from llama_recipes.data.concatenator import ConcatDataset
-from llama_recipes.policies import AnyPrecisionAdamW, apply_fsdp_checkpointing
+from llama_recipes.datasets.mixture_dataset import MixtureDataset
+from llama_recipes.policies import AnyPrecisionAdamW, OptimizerInBackward
 
 from llama_recipes.utils import fsdp_auto_wrap_policy
 from llama_recipes.utils.config_utils import (
@@ -34,10 +28,14 @@ from llama_recipes.utils.config_utils import (
     generate_peft_config,
     generate_dataset_config,
     get_dataloader_kwargs,
+    load_config_files,
+    resolve_config,
 )
 from llama_recipes.utils.dataset_utils import get_preprocessed_dataset
+from llama_recipes.utils.memory_utils import is_xpu_available
 
-from llama_recipes.utils.fsdp_utils import hsdp_device_mesh
+from llama_recipes.utils.fsdp_autotune import autotune_fsdp_config
+from llama_recipes.utils.fsdp_utils import hsdp_device_mesh, get_fsdp_tuning_kwargs, get_safetensors_param_init_fn
 from llama_recipes.utils.train_utils import (
     train,
     freeze_transformer_layers,
@@ -47,7 +45,6 @@ from llama_recipes.utils.train_utils import (
     print_model_size,
     get_policies,
 )
-from accelerate.utils import is_xpu_available
 
 def setup_wandb(train_config, fsdp_config, **kwargs):
     try:
@@ -68,9 +65,34 @@ def setup_wandb(train_config, fsdp_config, **kwargs):
 
 
 def main(**kwargs):
-    # Update the configuration for the training and sharding process
+    # transformers, peft and accelerate take seconds to import, only pay for them when training
+    from accelerate import init_empty_weights
+    from peft import get_peft_model, prepare_model_for_kbit_training
+    from transformers import AutoTokenizer, LlamaConfig, LlamaForCausalLM
+    from transformers.models.llama.modeling_llama import LlamaDecoderLayer
+
+    from llama_recipes.policies import (
+        apply_fsdp_checkpointing,
+        apply_regional_compile,
+        get_layers_to_checkpoint,
+        probe_activation_memory,
+    )
+
+    # Update the configuration for the training and sharding process, --config_file values are overridden by the command line
+    kwargs = load_config_files(kwargs)
     train_config, fsdp_config = TRAIN_CONFIG(), FSDP_CONFIG()
     update_config((train_config, fsdp_config), **kwargs)
+    if train_config.optimizer_in_backward and (
+        train_config.gradient_accumulation_steps != 1
+        or train_config.gradient_clipping
+        or train_config.use_fp16
+    ):
+        raise ValueError(
+            "optimizer_in_backward updates each parameter as soon as its gradient is ready "
+            "and can not be combined with gradient accumulation, gradient clipping or use_fp16"
+        )
+    if fsdp_config.gradient_accumulation_mode not in ("memory", "communication"):
+        raise ValueError(f"Unknown gradient_accumulation_mode: {fsdp_config.gradient_accumulation_mode}")
     # Set the seeds for reproducibility
     if is_xpu_available():
         torch.xpu.manual_seed(train_config.seed)
@@ -92,6 +114,22 @@ def main(**kwargs):
         clear_gpu_cache(local_rank)
         setup_environ_flags(rank)
 
+    device_mesh = None
+    if fsdp_config.hsdp and fsdp_config.sharding_strategy == ShardingStrategy.HYBRID_SHARD:
+        device_mesh = hsdp_device_mesh(replica_group_size=fsdp_config.replica_group_size, sharding_group_size=fsdp_config.sharding_group_size)
+        print("HSDP device mesh is ready")
+
+    if train_config.enable_fsdp and fsdp_config.autotune:
+        # the candidates are benchmarked on the model as it is trained, with its adapters and device mesh
+        autotune_fsdp_config(
+            train_config,
+            fsdp_config,
+            rank,
+            local_rank,
+            peft_config=generate_peft_config(train_config, kwargs) if train_config.use_peft else None,
+            device_mesh=device_mesh,
+        )
+
     wandb_run = None
 
     if train_config.use_wandb:
@@ -102,24 +140,18 @@ def main(**kwargs):
     use_cache = False if train_config.enable_fsdp else None
     if train_config.enable_fsdp and train_config.low_cpu_fsdp:
         """
-        for FSDP, we can save cpu memory by loading pretrained model on rank0 only.
+        for FSDP, we can save cpu memory by creating the model on the meta device on all ranks.
         this avoids cpu oom when loading large models like llama 70B, in which case
-        model alone would consume 2+TB cpu mem (70 * 4 * 8). This will add some comms
-        overhead and currently requires latest nightly.
+        model alone would consume 2+TB cpu mem (70 * 4 * 8). Each rank then loads the
+        weights of its own FSDP units from the memory-mapped safetensors checkpoint.
         """
-        if rank == 0:
-            model = LlamaForCausalLM.from_pretrained(
-                train_config.model_name,
-                load_in_8bit=True if train_config.quantization else None,
-                device_map="auto" if train_config.quantization else None,
-                use_cache=use_cache,
-                attn_implementation="sdpa" if train_config.use_fast_kernels else None,
-            )
-        else:
-            llama_config = LlamaConfig.from_pretrained(train_config.model_name)
-            llama_config.use_cache = use_cache
-            with torch.device("meta"):
-                model = LlamaForCausalLM(llama_config)
+        llama_config = LlamaConfig.from_pretrained(train_config.model_name)
+        llama_config.use_cache = use_cache
+        if train_config.use_fast_kernels:
+            llama_config._attn_implementation = "sdpa"
+        # buffers like the rotary embedding are not in the checkpoint and are created for real
+        with init_empty_weights(include_buffers=False):
+            model = LlamaForCausalLM(llama_config)
 
     else:
         model = LlamaForCausalLM.from_pretrained(
@@ -158,11 +190,6 @@ def main(**kwargs):
             wandb_run.config.update(peft_config)
 
 
-    hsdp_device_mesh = None
-    if fsdp_config.hsdp and fsdp_config.sharding_strategy == ShardingStrategy.HYBRID_SHARD:
-        hsdp_device_mesh = hsdp_device_mesh(replica_group_size=fsdp_config.replica_group_size, sharding_group_size=fsdp_config.sharding_group_size)
-        print("HSDP device mesh is ready")
-
     #setting up FSDP if enable_fsdp is enabled
     if train_config.enable_fsdp:
         if not train_config.use_peft and train_config.freeze_layers:
@@ -178,21 +205,23 @@ def main(**kwargs):
         elif torch.cuda.is_available():
             device_id = torch.cuda.current_device()
 
+        param_init_fn = None
+        if train_config.low_cpu_fsdp:
+            device = torch.device("xpu", device_id) if is_xpu_available() else torch.device("cuda", device_id)
+            param_init_fn = get_safetensors_param_init_fn(model, train_config.model_name, device)
+
         model = FSDP(
             model,
             auto_wrap_policy= my_auto_wrapping_policy if train_config.use_peft else wrapping_policy,
             cpu_offload=CPUOffload(offload_params=True) if fsdp_config.fsdp_cpu_offload else None,
             mixed_precision=mixed_precision_policy if not fsdp_config.pure_bf16 else None,
             sharding_strategy=fsdp_config.sharding_strategy,
-            device_mesh=hsdp_device_mesh,
+            device_mesh=device_mesh,
             device_id=device_id,
-            limit_all_gathers=True,
-            sync_module_states=train_config.low_cpu_fsdp,
-            param_init_fn=lambda module: module.to_empty(device=torch.device("cuda"), recurse=False)
-            if train_config.low_cpu_fsdp and rank != 0 else None,
+            **get_fsdp_tuning_kwargs(fsdp_config),
+            use_orig_params=train_config.optimizer_in_backward or train_config.compile,
+            param_init_fn=param_init_fn,
         )
-        if fsdp_config.fsdp_activation_checkpointing:
-            apply_fsdp_checkpointing(model)
     elif not train_config.quantization and not train_config.enable_fsdp:
         if is_xpu_available():
             model.to("xpu:0")
@@ -200,6 +229,8 @@ def main(**kwargs):
             model.to("cuda")
 
     dataset_config = generate_dataset_config(train_config, kwargs)
+    if not train_config.enable_fsdp or rank == 0:
+        print(f"--> Resolved config hash: {resolve_config(train_config, fsdp_config, dataset_config).hash}")
 
      # Load and preprocess the dataset for training and validation
     dataset_train = get_preprocessed_dataset(
@@ -208,7 +239,9 @@ def main(**kwargs):
         split="train",
     )
 
-    if not train_config.enable_fsdp or rank == 0:
+    # streaming datasets have no length, they are read, tokenized and packed by the dataloader workers
+    streaming = isinstance(dataset_train, torch.utils.data.IterableDataset)
+    if not streaming and (not train_config.enable_fsdp or rank == 0):
         print(f"--> Training Set Length = {len(dataset_train)}")
 
     dataset_val = get_preprocessed_dataset(
@@ -216,13 +249,23 @@ def main(**kwargs):
         dataset_config,
         split="test",
     )
-    if not train_config.enable_fsdp or rank == 0:
+    if not streaming and (not train_config.enable_fsdp or rank == 0):
             print(f"--> Validation Set Length = {len(dataset_val)}")
 
-    if train_config.batching_strategy == "packing":
-        dataset_train = ConcatDataset(dataset_train, chunk_size=train_config.context_length)
+    mixture_train = isinstance(dataset_train, MixtureDataset)
+    if train_config.batching_strategy == "packing" and not streaming:
+        if mixture_train:
+            # the sources are packed one by one, so the mixture still draws its samples lazily every epoch
+            dataset_train = dataset_train.pack(train_config.context_length)
+        else:
+            dataset_train = ConcatDataset(dataset_train, chunk_size=train_config.context_length)
 
     train_dl_kwargs = get_dataloader_kwargs(train_config, dataset_train, tokenizer, "train")
+    if mixture_train and (not train_config.enable_fsdp or rank == 0):
+        print(f"--> Mixture samples per source = {dataset_train.get_sample_counts()}")
+        if train_config.batching_strategy == "padding":
+            # the length based samplers have read every sample once
+            print(f"--> Mixture tokens per source = {dataset_train.token_counts}")
 
     # Create DataLoaders for the training and validation dataset
     train_dataloader = torch.utils.data.DataLoader(
@@ -233,8 +276,13 @@ def main(**kwargs):
     )
 
     eval_dataloader = None
+    if train_config.run_validation and isinstance(dataset_val, torch.utils.data.IterableDataset) and train_config.max_eval_step <= 0:
+        # a stream has no end, the number of validation batches has to be given
+        train_config.run_validation = False
+        if not train_config.enable_fsdp or rank == 0:
+            print("--> Skipping validation: set max_eval_step to the number of batches read from the streaming validation set")
     if train_config.run_validation:
-        if train_config.batching_strategy == "packing":
+        if train_config.batching_strategy == "packing" and not streaming:
             dataset_val = ConcatDataset(dataset_val, chunk_size=train_config.context_length)
 
         val_dl_kwargs = get_dataloader_kwargs(train_config, dataset_val, tokenizer, "val")
@@ -246,22 +294,76 @@ def main(**kwargs):
             **val_dl_kwargs,
         )
 
+    # Activation checkpointing is applied once the data is available, the memory_budget policy probes one training step
+    if train_config.enable_fsdp and fsdp_config.fsdp_activation_checkpointing:
+        layers_to_checkpoint = None
+        if fsdp_config.activation_checkpointing_policy == "memory_budget":
+            device = torch.device(f"xpu:{local_rank}") if is_xpu_available() else local_rank
+            probe_batch = {key: value.to(device) for key, value in next(iter(train_dataloader)).items()}
+            activation_bytes, input_bytes = probe_activation_memory(model, probe_batch)
+            layers_to_checkpoint = get_layers_to_checkpoint(
+                activation_bytes,
+                input_bytes,
+                fsdp_config.activation_checkpointing_memory_budget_gb * 2**30,
+            )
+            if rank == 0:
+                print(f"--> Activations of one step need {sum(activation_bytes.values()) / 2**30:.2f} GB, checkpointing {len(layers_to_checkpoint)} of {len(activation_bytes)} layers to fit into {fsdp_config.activation_checkpointing_memory_budget_gb} GB")
+        apply_fsdp_checkpointing(
+            model,
+            policy=fsdp_config.activation_checkpointing_policy,
+            interval=fsdp_config.activation_checkpointing_interval,
+            layers_to_checkpoint=layers_to_checkpoint,
+            offload=fsdp_config.activation_checkpointing_offload,
+            save_ops=fsdp_config.activation_checkpointing_save_ops,
+        )
+
+    if train_config.compile:
+        dynamic = train_config.compile_dynamic
+        if dynamic is None:
+            # padded batches change their sequence length from step to step
+            dynamic = train_config.batching_strategy == "padding"
+        apply_regional_compile(
+            model,
+            mode=train_config.compile_mode,
+            dynamic=dynamic,
+            backend=train_config.compile_backend,
+        )
+
     # Initialize the optimizer and learning rate scheduler
     if fsdp_config.pure_bf16 and fsdp_config.optimizer == "anyprecision":
-        optimizer = AnyPrecisionAdamW(
-            model.parameters(),
+        optimizer_class = AnyPrecisionAdamW
+        optimizer_kwargs = dict(
             lr=train_config.lr,
             momentum_dtype=torch.bfloat16,
             variance_dtype=torch.bfloat16,
             use_kahan_summation=False,
             weight_decay=train_config.weight_decay,
         )
+    elif fsdp_config.optimizer == "anyprecision_8bit":
+        optimizer_class = AnyPrecisionAdamW
+        optimizer_kwargs = dict(
+            lr=train_config.lr,
+            quantize_state=True,
+            use_kahan_summation=False,
+            weight_decay=train_config.weight_decay,
+        )
     else:
-        optimizer = optim.AdamW(
-            model.parameters(),
+        optimizer_class = optim.AdamW
+        optimizer_kwargs = dict(
             lr=train_config.lr,
             weight_decay=train_config.weight_decay,
         )
+
+    if train_config.optimizer_in_backward:
+        # FSDP steps the per-parameter optimizers itself once the gradients are reduced
+        optimizer = OptimizerInBackward(
+            model.parameters(),
+            optimizer_class,
+            register_hook=not train_config.enable_fsdp,
+            **optimizer_kwargs,
+        )
+    else:
+        optimizer = optimizer_class(model.parameters(), **optimizer_kwargs)
     scheduler = StepLR(optimizer, step_size=1, gamma=train_config.gamma)
 
     # Start the training process
@@ -2,8 +2,29 @@
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
 import json
+from typing import List, Tuple
+
+import torch
 
 def read_dialogs_from_file(file_path):
     with open(file_path, 'r') as file:
         dialogs = json.load(file)
     return dialogs
+
+
+def group_by_length(chats: List[List[int]], batch_size: int) -> List[List[int]]:
+    """
+    Groups the indices of the tokenized chats into batches of similar length, longest first
+    """
+    order = sorted(range(len(chats)), key=lambda i: len(chats[i]), reverse=True)
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+def left_pad(chats: List[List[int]], pad_token_id: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Returns input_ids and attention_mask of the chats, padded on the left so that generation continues every chat
+    """
+    length = max(len(chat) for chat in chats)
+    input_ids = torch.tensor([[pad_token_id] * (length - len(chat)) + list(chat) for chat in chats]).long()
+    attention_mask = torch.tensor([[0] * (length - len(chat)) + [1] * len(chat) for chat in chats]).long()
+    return input_ids, attention_mask
@@ -0,0 +1,250 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import json
+import queue
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List, Optional
+
+import fire
+
+from llama_recipes.inference.generation_utils import ContinuousBatchingEngine, GenerationService, PrefixCache, SamplingParams
+from llama_recipes.inference.safety_utils import AgentType, SafetyPipeline, get_safety_checker
+
+
+def iter_text(tokenizer, token_ids: Iterable[int]) -> Iterable[str]:
+    """
+    Yields the text of the streamed tokens as soon as it decodes to complete characters
+    """
+    output_ids, text = [], ""
+    for token_id in token_ids:
+        output_ids.append(token_id)
+        new_text = tokenizer.decode(output_ids, skip_special_tokens=True)
+        # a character split over several byte tokens is not complete yet
+        if len(new_text) > len(text) and not new_text.endswith("�"):
+            yield new_text[len(text):]
+            text = new_text
+
+
+class GenerationServer(ThreadingHTTPServer):
+    """
+    Serves an OpenAI compatible subset of /v1/completions and /v1/chat/completions from a ContinuousBatchingEngine
+
+    Every request is handled in its own thread, which waits on the engine while the engine batches all requests.
+    The optional safety pipeline checks the prompt before it is queued and the generated text after it is complete.
+    GET /metrics returns the queue depth, latency and throughput of the engine.
+    """
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        engine: ContinuousBatchingEngine,
+        safety_pipeline: Optional[SafetyPipeline] = None,
+        default_params: Optional[SamplingParams] = None,
+    ):
+        super().__init__(address, GenerationRequestHandler)
+        self.engine = engine
+        self.tokenizer = engine.tokenizer
+        self.safety_pipeline = safety_pipeline
+        self.default_params = default_params or SamplingParams()
+
+    def get_sampling_params(self, body: Dict) -> SamplingParams:
+        return SamplingParams(
+            max_new_tokens=int(body.get("max_tokens", self.default_params.max_new_tokens)),
+            temperature=float(body.get("temperature", self.default_params.temperature)),
+            top_p=float(body.get("top_p", self.default_params.top_p)),
+            top_k=int(body.get("top_k", self.default_params.top_k)),
+        )
+
+    def check_safety(self, text: str, **kwargs) -> Optional[List]:
+        # the reports of the unsafe checks, None when the text is safe
+        if self.safety_pipeline is None:
+            return None
+        unsafe = [
+            {"method": method, "report": report}
+            for method, is_safe, report in self.safety_pipeline(text, **kwargs)
+            if not is_safe
+        ]
+        return unsafe or None
+
+
+class GenerationRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: Dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status: int, message: str, **kwargs):
+        self._send_json(status, {"error": {"message": message, **kwargs}})
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._send_json(200, self.server.engine.get_metrics())
+        elif self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_error(404, f"Unknown path {self.path}")
+
+    def do_POST(self):
+        if self.path not in ("/v1/completions", "/v1/chat/completions"):
+            self._send_error(404, f"Unknown path {self.path}")
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            params = self.server.get_sampling_params(body)
+            chat = self.path == "/v1/chat/completions"
+            if chat:
+                messages = body["messages"]
+                prompt_ids = self.server.tokenizer.apply_chat_template(messages, add_generation_prompt=True)
+                user_prompt = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+            else:
+                user_prompt = body["prompt"]
+                prompt_ids = self.server.tokenizer(user_prompt)["input_ids"]
+        except (KeyError, TypeError, ValueError) as e:
+            self._send_error(400, f"Invalid request: {e!r}")
+            return
+
+        unsafe = self.server.check_safety(user_prompt)
+        if unsafe:
+            self._send_error(400, "The prompt was deemed unsafe", safety=unsafe)
+            return
+        try:
+            request = self.server.engine.submit(prompt_ids, params, block=False)
+        except queue.Full:
+            self._send_error(503, "The request queue is full")
+            return
+
+        completion_id = f"{'chatcmpl' if chat else 'cmpl'}-{uuid.uuid4().hex}"
+        try:
+            if body.get("stream", False):
+                self._stream(completion_id, request, chat, user_prompt)
+            else:
+                self._respond(completion_id, request, chat, user_prompt)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client went away, its slot in the batch is freed
+            request.cancel()
+
+    def _check_output(self, request, text: str, user_prompt: str):
+        unsafe = self.server.check_safety(text, agent_type=AgentType.AGENT, user_prompt=user_prompt)
+        return ("content_filter" if unsafe else request.finish_reason), unsafe
+
+    def _choice(self, chat: bool, text: str, finish_reason: Optional[str], delta: bool = False) -> Dict:
+        if not chat:
+            return {"index": 0, "text": text, "finish_reason": finish_reason}
+        message = {"content": text} if delta else {"role": "assistant", "content": text}
+        return {"index": 0, "delta" if delta else "message": message, "finish_reason": finish_reason}
+
+    def _respond(self, completion_id: str, request, chat: bool, user_prompt: str):
+        try:
+            list(request)
+        except RuntimeError as e:
+            self._send_error(500, str(e.__cause__ or e))
+            return
+        text = self.server.tokenizer.decode(request.output_ids, skip_special_tokens=True)
+        finish_reason, unsafe = self._check_output(request, text, user_prompt)
+        response = {
+            "id": completion_id,
+            "object": "chat.completion" if chat else "text_completion",
+            "choices": [self._choice(chat, "" if unsafe else text, finish_reason)],
+            "usage": {
+                "prompt_tokens": len(request.prompt_ids),
+                "completion_tokens": len(request.output_ids),
+                "total_tokens": len(request.prompt_ids) + len(request.output_ids),
+            },
+        }
+        if unsafe:
+            response["safety"] = unsafe
+        self._send_json(200, response)
+
+    def _stream(self, completion_id: str, request, chat: bool, user_prompt: str):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        object_name = "chat.completion.chunk" if chat else "text_completion"
+
+        def send(choice: Dict, **kwargs):
+            chunk = {"id": completion_id, "object": object_name, "choices": [choice], **kwargs}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+
+        text = ""
+        try:
+            for text_delta in iter_text(self.server.tokenizer, request):
+                text += text_delta
+                send(self._choice(chat, text_delta, None, delta=True))
+        except RuntimeError as e:
+            send(self._choice(chat, "", "error", delta=True), error={"message": str(e.__cause__ or e)})
+        else:
+            # the streamed text can not be taken back, an unsafe output is flagged in the last chunk
+            finish_reason, unsafe = self._check_output(request, text, user_prompt)
+            send(self._choice(chat, "", finish_reason, delta=True), **({"safety": unsafe} if unsafe else {}))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def main(
+    model_name,
+    peft_model: str=None,
+    quantization: bool=False,
+    use_fast_kernels: bool=False,
+    host: str="0.0.0.0",
+    port: int=8000,
+    max_batch_size: int=8, # Number of requests decoded together in every step
+    max_queue_size: int=0, # Requests waiting for a slot in the batch before the server answers 503, 0 for no limit
+    max_new_tokens: int=256, # Default of the requests without max_tokens
+    temperature: float=1.0,
+    top_p: float=1.0,
+    top_k: int=0,
+    prefix_cache_memory_mb: int=0, # Memory for the keys and values of prompt prefixes shared by several requests, 0 disables the prefix cache
+    enable_azure_content_safety: bool=False,
+    enable_sensitive_topics: bool=False,
+    enable_salesforce_content_safety: bool=False,
+    enable_llamaguard_content_safety: bool=False,
+):
+    service = GenerationService.from_pretrained(model_name, peft_model=peft_model, quantization=quantization, use_fast_kernels=use_fast_kernels, warm_up=True)
+    prefix_cache = PrefixCache(service.model, max_memory_bytes=prefix_cache_memory_mb * 2**20) if prefix_cache_memory_mb > 0 else None
+    engine = ContinuousBatchingEngine(
+        service.model, service.tokenizer, max_batch_size=max_batch_size, max_queue_size=max_queue_size, prefix_cache=prefix_cache
+    )
+
+    safety_pipeline = None
+    safety_checker = get_safety_checker(enable_azure_content_safety,
+                                        enable_sensitive_topics,
+                                        enable_salesforce_content_safety,
+                                        enable_llamaguard_content_safety,
+                                        warm_up=True
+                                        )
+    if safety_checker:
+        safety_pipeline = SafetyPipeline(safety_checker)
+
+    server = GenerationServer(
+        (host, port), engine, safety_pipeline, SamplingParams(max_new_tokens, temperature, top_p, top_k)
+    )
+    engine.start()
+    print(f"Serving {model_name} on http://{host}:{port}/v1/chat/completions and http://{host}:{port}/v1/completions")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        engine.stop()
+        if safety_pipeline is not None:
+            safety_pipeline.close()
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
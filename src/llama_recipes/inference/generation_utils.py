@@ -0,0 +1,605 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+import torch
+from transformers.generation.streamers import BaseStreamer
+
+from llama_recipes.inference.model_utils import load_model, load_peft_model
+
+
+@dataclass
+class GenerationResult:
+    text: str
+    prompt_tokens: int
+    new_tokens: int
+    # seconds from the start of the request to the first generated token, including the prefill
+    time_to_first_token: float
+    latency: float
+
+    @property
+    def tokens_per_second(self) -> float:
+        # decode speed, the prefill is already counted by time_to_first_token
+        decode_time = self.latency - self.time_to_first_token
+        if self.new_tokens <= 1 or decode_time <= 0:
+            return 0.0
+        return (self.new_tokens - 1) / decode_time
+
+    def __str__(self):
+        return (
+            f"{self.prompt_tokens} prompt tokens, {self.new_tokens} new tokens, "
+            f"time to first token {self.time_to_first_token * 1000:.1f} ms, "
+            f"{self.tokens_per_second:.1f} tokens/s, latency {self.latency * 1000:.1f} ms"
+        )
+
+
+class _TimingStreamer(BaseStreamer):
+    # generate puts the prompt first, then every generated token
+    def __init__(self):
+        self.first_token_time = None
+        self._prompt_seen = False
+
+    def put(self, value):
+        if not self._prompt_seen:
+            self._prompt_seen = True
+        elif self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+
+    def end(self):
+        pass
+
+
+def _common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+class PrefixCache(object):
+    """
+    Keeps the past_key_values of prompt prefixes shared by many requests, like system prompts or few-shot examples
+
+    Prefixes are registered explicitly, or detected as the longest common prefix of at least min_prefix_length
+    tokens between a prompt and one of the last detection_window prompts. A prompt starting with a cached prefix
+    only needs the prefill of the rest of its tokens. Prefixes are evicted in least recently used order once their
+    keys and values take more than max_memory_bytes.
+    """
+    def __init__(self, model, max_memory_bytes: int = 2**30, min_prefix_length: int = 32, detection_window: int = 16):
+        self.model = model
+        self.max_memory_bytes = max_memory_bytes
+        self.min_prefix_length = min_prefix_length
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+        self._recent_prompts = deque(maxlen=detection_window)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def register(self, prefix_ids: Sequence[int]):
+        """
+        Computes and stores the past_key_values of prefix_ids
+        """
+        key = tuple(prefix_ids)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        input_ids = torch.tensor([key], device=self.model.device)
+        with torch.no_grad():
+            past_key_values = self.model(input_ids=input_ids, use_cache=True).past_key_values
+        if not isinstance(past_key_values, tuple):
+            past_key_values = past_key_values.to_legacy_cache()
+        size = sum(tensor.numel() * tensor.element_size() for layer in past_key_values for tensor in layer)
+        if size > self.max_memory_bytes:
+            return past_key_values
+        with self._lock:
+            self._entries[key] = past_key_values
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._memory_bytes -= sum(tensor.numel() * tensor.element_size() for layer in evicted for tensor in layer)
+        return past_key_values
+
+    def lookup(self, input_ids: Sequence[int]):
+        """
+        Returns the length and past_key_values of the longest cached prefix of input_ids, (0, None) without one
+
+        The prefix is shorter than input_ids, the last token is always computed to get the logits of the next one.
+        The cached keys and values are not modified by generating from them.
+        """
+        key = tuple(input_ids)
+        with self._lock:
+            best = None
+            for prefix in self._entries:
+                if len(prefix) < len(key) and (best is None or len(prefix) > len(best)) and key[:len(prefix)] == prefix:
+                    best = prefix
+            if best is None:
+                self.misses += 1
+                return 0, None
+            self._entries.move_to_end(best)
+            self.hits += 1
+            self.reused_tokens += len(best)
+            return len(best), self._entries[best]
+
+    def observe(self, input_ids: Sequence[int]):
+        """
+        Registers the longest prefix input_ids shares with a recent prompt, if it is long enough
+        """
+        key = tuple(input_ids)
+        with self._lock:
+            length = max((_common_prefix_length(key, prompt) for prompt in self._recent_prompts), default=0)
+            self._recent_prompts.append(key)
+        # the last token of a prompt is not part of its cached prefix
+        length = min(length, len(key) - 1)
+        if length >= self.min_prefix_length:
+            self.register(key[:length])
+
+    def get_metrics(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "reused_tokens": self.reused_tokens,
+                "prefixes": len(self._entries),
+                "memory_bytes": self._memory_bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._memory_bytes = 0
+            self._recent_prompts.clear()
+
+
+class GenerationService(object):
+    """
+    Holds a model and its tokenizer for the lifetime of an app, so that requests only pay for the generation
+
+    Prompts are padded to the longest prompt of the request instead of a fixed length.
+    """
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        seed: Optional[int] = None,
+        max_padding_length: Optional[int] = None,
+        prefix_cache: Optional[PrefixCache] = None,
+        **generation_kwargs,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        # single prompts resume from the cached keys and values of their longest cached prefix
+        self.prefix_cache = prefix_cache
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        # generated tokens of all rows start at the same position
+        self.tokenizer.padding_side = "left"
+        self.seed = seed
+        self.max_padding_length = max_padding_length
+        self.generation_kwargs = generation_kwargs
+        self.model.eval()
+
+    @classmethod
+    def from_pretrained(
+        cls,
+        model_name: str,
+        peft_model: Optional[str] = None,
+        quantization: bool = False,
+        use_fast_kernels: bool = False,
+        warm_up: bool = False,
+        enable_prefix_cache: bool = False,
+        **kwargs,
+    ):
+        from transformers import AutoTokenizer
+
+        model = load_model(model_name, quantization, use_fast_kernels)
+        if peft_model:
+            model = load_peft_model(model, peft_model)
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        if enable_prefix_cache:
+            kwargs["prefix_cache"] = PrefixCache(model)
+        service = cls(model, tokenizer, **kwargs)
+        if warm_up:
+            service.warm_up()
+        return service
+
+    def warm_up(self):
+        # the first generate call pays for kernel selection and memory allocation
+        self.generate("Hello", max_new_tokens=1, do_sample=False)
+
+    def _set_seed(self):
+        if self.seed is None:
+            return
+        if hasattr(torch, "xpu") and torch.xpu.is_available():
+            torch.xpu.manual_seed(self.seed)
+        elif torch.cuda.is_available():
+            torch.cuda.manual_seed(self.seed)
+        torch.manual_seed(self.seed)
+
+    def tokenize(self, prompts: List[str]):
+        truncation = self.max_padding_length is not None
+        batch = self.tokenizer(prompts, padding=True, truncation=truncation, max_length=self.max_padding_length, return_tensors="pt")
+        return {k: v.to(self.model.device) for k, v in batch.items()}
+
+    def generate(self, prompt: str, **kwargs) -> GenerationResult:
+        return self.generate_batch([prompt], **kwargs)[0]
+
+    def generate_batch(self, prompts: List[str], **kwargs) -> List[GenerationResult]:
+        """
+        Generates the completion of every prompt in one generate call
+
+        kwargs override the generation settings of the service, like max_new_tokens or temperature.
+        """
+        self._set_seed()
+        start = time.perf_counter()
+        batch = self.tokenize(prompts)
+        streamer = _TimingStreamer()
+        generation_kwargs = {"pad_token_id": self.tokenizer.pad_token_id, **self.generation_kwargs, **kwargs}
+        if self.prefix_cache is not None and len(prompts) == 1:
+            # the prefixes of a padded batch are not aligned, only single prompts use the cache
+            input_ids = batch["input_ids"][0].tolist()
+            self.prefix_cache.observe(input_ids)
+            _, past_key_values = self.prefix_cache.lookup(input_ids)
+            if past_key_values is not None:
+                generation_kwargs["past_key_values"] = past_key_values
+        with torch.no_grad():
+            outputs = self.model.generate(**batch, streamer=streamer, **generation_kwargs)
+        end = time.perf_counter()
+
+        prompt_length = batch["input_ids"].shape[1]
+        new_tokens = outputs[:, prompt_length:]
+        texts = self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+        first_token_time = streamer.first_token_time or end
+        results = []
+        for text, attention_mask, tokens in zip(texts, batch["attention_mask"], new_tokens):
+            # rows finished early are padded after their end of sequence token
+            tokens = tokens.tolist()
+            num_new_tokens = tokens.index(self.tokenizer.eos_token_id) + 1 if self.tokenizer.eos_token_id in tokens else len(tokens)
+            results.append(GenerationResult(
+                text=text,
+                prompt_tokens=int(attention_mask.sum()),
+                new_tokens=num_new_tokens,
+                time_to_first_token=first_token_time - start,
+                latency=end - start,
+            ))
+        return results
+
+
+@dataclass
+class SamplingParams:
+    max_new_tokens: int = 256
+    # greedy decoding with a temperature of 0
+    temperature: float = 1.0
+    top_p: float = 1.0
+    top_k: int = 0
+
+
+def sample_next_token(logits: torch.Tensor, params: SamplingParams) -> int:
+    """
+    Picks the next token from the logits of one sequence with top k, then top p filtering
+    """
+    if params.temperature <= 0:
+        return int(logits.argmax())
+    logits = logits.float() / params.temperature
+    if params.top_k > 0:
+        kth_largest = torch.topk(logits, min(params.top_k, logits.shape[-1])).values[-1]
+        logits = logits.masked_fill(logits < kth_largest, float("-inf"))
+    if params.top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        cumulative_probs = sorted_logits.softmax(-1).cumsum(-1)
+        # the most likely token is always kept
+        sorted_remove = cumulative_probs - sorted_logits.softmax(-1) > params.top_p
+        logits = logits.masked_fill(sorted_remove.scatter(0, sorted_indices, sorted_remove), float("-inf"))
+    return int(torch.multinomial(logits.softmax(-1), 1))
+
+
+class GenerationRequest(object):
+    """
+    A prompt queued in a ContinuousBatchingEngine, the generated tokens are streamed through it
+    """
+    def __init__(self, prompt_ids: List[int], params: SamplingParams):
+        self.prompt_ids = list(prompt_ids)
+        self.params = params
+        self.output_ids = []
+        self.finish_reason = None
+        self.error = None
+        self.arrival_time = time.perf_counter()
+        self.first_token_time = None
+        self.finish_time = None
+        self.cancelled = False
+        self._tokens = queue.Queue()
+        self._done = threading.Event()
+
+    def _add_token(self, token_id: int):
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        self.output_ids.append(token_id)
+        self._tokens.put(token_id)
+
+    def _finish(self, reason: str, error: Optional[BaseException] = None):
+        self.finish_reason = reason
+        self.error = error
+        self.finish_time = time.perf_counter()
+        self._tokens.put(None)
+        self._done.set()
+
+    def cancel(self):
+        # the engine drops the request before its next step
+        self.cancelled = True
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._done.wait(timeout)
+
+    def __iter__(self):
+        # the generated token ids as they are generated
+        while True:
+            token_id = self._tokens.get()
+            if token_id is None:
+                if self.error is not None:
+                    raise RuntimeError("Generation failed") from self.error
+                return
+            yield token_id
+
+    def get_result(self, text: str) -> GenerationResult:
+        return GenerationResult(
+            text=text,
+            prompt_tokens=len(self.prompt_ids),
+            new_tokens=len(self.output_ids),
+            time_to_first_token=(self.first_token_time or self.finish_time) - self.arrival_time,
+            latency=self.finish_time - self.arrival_time,
+        )
+
+
+def _left_pad(tensor: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    if tensor.shape[dim] == length:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = length - tensor.shape[dim]
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+class ContinuousBatchingEngine(object):
+    """
+    Generates the queued requests with iteration level batching
+
+    Every step decodes one token of all running requests in one forward pass. Between two steps, finished
+    requests leave the batch and queued requests join it after a batched prefill, so that short requests do not
+    wait for the longest request of their batch. The batch keeps one left padded key value cache, with an
+    attention mask hiding the padding.
+    """
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_batch_size: int = 8,
+        max_queue_size: int = 0,
+        metrics_window: int = 1000,
+        prefix_cache: Optional[PrefixCache] = None,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix_cache = prefix_cache
+        self.max_batch_size = max_batch_size
+        self.queue = queue.Queue(max_queue_size)
+        self.model.eval()
+
+        self._running: List[GenerationRequest] = []
+        self._past_key_values = None
+        self._attention_mask = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._metrics_lock = threading.Lock()
+        self._time_to_first_token = deque(maxlen=metrics_window)
+        self._latency = deque(maxlen=metrics_window)
+        self._completed = 0
+        self._generated_tokens = 0
+        self._start_time = time.perf_counter()
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._loop, name="ContinuousBatchingEngine", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, prompt_ids: List[int], params: Optional[SamplingParams] = None, block: bool = True) -> GenerationRequest:
+        """
+        Queues a prompt, raises queue.Full when the queue is full and block is False
+        """
+        request = GenerationRequest(prompt_ids, params or SamplingParams())
+        self.queue.put(request, block=block)
+        return request
+
+    def get_metrics(self) -> Dict[str, float]:
+        with self._metrics_lock:
+            time_to_first_token = sorted(self._time_to_first_token)
+            latency = sorted(self._latency)
+            return {
+                "queue_depth": self.queue.qsize(),
+                "running": sum(request.finish_reason is None for request in list(self._running)),
+                "completed": self._completed,
+                "generated_tokens": self._generated_tokens,
+                "tokens_per_second": self._generated_tokens / (time.perf_counter() - self._start_time),
+                "time_to_first_token_p50": _percentile(time_to_first_token, 50),
+                "time_to_first_token_p99": _percentile(time_to_first_token, 99),
+                "latency_p50": _percentile(latency, 50),
+                "latency_p99": _percentile(latency, 99),
+                **({} if self.prefix_cache is None else {
+                    f"prefix_cache_{k}": v for k, v in self.prefix_cache.get_metrics().items()
+                }),
+            }
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            try:
+                if not self._running:
+                    try:
+                        request = self.queue.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    self._prefill([request] + self._get_queued(self.max_batch_size - 1))
+                elif len(self._running) < self.max_batch_size and not self.queue.empty():
+                    self._prefill(self._get_queued(self.max_batch_size - len(self._running)))
+                else:
+                    self.step()
+            except Exception as e:
+                # the failed requests are finished with the error, the engine keeps serving the next ones
+                for request in self._running:
+                    request._finish("error", e)
+                self._running, self._past_key_values, self._attention_mask = [], None, None
+        for request in self._running + self._get_queued(self.queue.qsize()):
+            request._finish("cancelled")
+        self._running, self._past_key_values, self._attention_mask = [], None, None
+
+    def _get_queued(self, count: int) -> List[GenerationRequest]:
+        requests = []
+        while len(requests) < count:
+            try:
+                requests.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return requests
+
+    def _forward(self, input_ids, attention_mask, past_key_values=None):
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, -input_ids.shape[1]:]
+        with torch.no_grad():
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+        return outputs.logits[:, -1], outputs.past_key_values
+
+    def _prefill(self, requests: List[GenerationRequest]):
+        requests = [request for request in requests if not self._drop_cancelled(request)]
+        device = self.model.device
+        misses = []
+        for request in requests:
+            prefix_length, past_key_values = 0, None
+            if self.prefix_cache is not None:
+                try:
+                    self.prefix_cache.observe(request.prompt_ids)
+                except Exception:
+                    # a prefix that fails to register is computed with the rest of the prompt
+                    pass
+                prefix_length, past_key_values = self.prefix_cache.lookup(request.prompt_ids)
+            if past_key_values is None:
+                misses.append(request)
+                continue
+            # only the tokens after the cached prefix are computed
+            input_ids = torch.tensor([request.prompt_ids[prefix_length:]], device=device)
+            attention_mask = torch.ones(1, len(request.prompt_ids), dtype=torch.long, device=device)
+            self._prefill_group([request], input_ids, attention_mask, past_key_values)
+        if not misses:
+            return
+
+        length = max(len(request.prompt_ids) for request in misses)
+        input_ids = torch.tensor(
+            [[self.tokenizer.pad_token_id or 0] * (length - len(r.prompt_ids)) + r.prompt_ids for r in misses], device=device
+        )
+        attention_mask = torch.tensor(
+            [[0] * (length - len(r.prompt_ids)) + [1] * len(r.prompt_ids) for r in misses], device=device
+        )
+        self._prefill_group(misses, input_ids, attention_mask)
+
+    def _prefill_group(self, requests: List[GenerationRequest], input_ids, attention_mask, past_key_values=None):
+        # a failed prefill only finishes the joining requests, the running batch and its cache are kept
+        try:
+            logits, past_key_values = self._forward(input_ids, attention_mask, past_key_values)
+            self._join(requests, logits, past_key_values, attention_mask)
+        except Exception as e:
+            for request in requests:
+                if request.finish_reason is None:
+                    request._finish("error", e)
+            self._drop_finished()
+
+    def _join(self, requests: List[GenerationRequest], logits, past_key_values, attention_mask):
+        # the new requests join the batch, padded on the left to the same cache length. The state of the batch
+        # is only replaced once the merged cache is complete.
+        if self._running:
+            length = max(attention_mask.shape[1], self._attention_mask.shape[1])
+            past_key_values = tuple(
+                tuple(torch.cat([_left_pad(old, length, 2), _left_pad(new, length, 2)]) for old, new in zip(old_layer, new_layer))
+                for old_layer, new_layer in zip(self._past_key_values, past_key_values)
+            )
+            attention_mask = torch.cat([_left_pad(self._attention_mask, length, 1), _left_pad(attention_mask, length, 1)])
+        self._running = self._running + requests
+        self._past_key_values, self._attention_mask = past_key_values, attention_mask
+        self._add_tokens(logits, requests)
+
+    def step(self):
+        """
+        Decodes the next token of every running request
+        """
+        input_ids = torch.tensor([[request.output_ids[-1]] for request in self._running], device=self.model.device)
+        attention_mask = torch.cat([self._attention_mask, self._attention_mask.new_ones(len(self._running), 1)], dim=1)
+        logits, self._past_key_values = self._forward(input_ids, attention_mask, self._past_key_values)
+        self._attention_mask = attention_mask
+        self._add_tokens(logits, self._running)
+
+    def _drop_cancelled(self, request: GenerationRequest) -> bool:
+        if request.cancelled:
+            request._finish("cancelled")
+        return request.cancelled
+
+    def _add_tokens(self, logits: torch.Tensor, requests: List[GenerationRequest]):
+        for request, request_logits in zip(requests, logits):
+            token_id = sample_next_token(request_logits, request.params)
+            request._add_token(token_id)
+            if token_id == self.tokenizer.eos_token_id:
+                self._complete(request, "stop")
+            elif len(request.output_ids) >= request.params.max_new_tokens:
+                self._complete(request, "length")
+        with self._metrics_lock:
+            self._generated_tokens += len(requests)
+        self._drop_finished()
+
+    def _drop_finished(self):
+        keep = [i for i, request in enumerate(self._running) if request.finish_reason is None and not self._drop_cancelled(request)]
+        if len(keep) == len(self._running):
+            return
+        self._running = [self._running[i] for i in keep]
+        if not keep:
+            self._past_key_values, self._attention_mask = None, None
+            return
+        index = torch.tensor(keep, device=self._attention_mask.device)
+        attention_mask = self._attention_mask[index]
+        # the columns only the finished requests attended to are dropped
+        start = int(attention_mask.any(dim=0).long().argmax())
+        self._attention_mask = attention_mask[:, start:]
+        self._past_key_values = tuple(
+            tuple(tensor[index, :, start:] for tensor in layer) for layer in self._past_key_values
+        )
+
+    def _complete(self, request: GenerationRequest, reason: str):
+        request._finish(reason)
+        with self._metrics_lock:
+            self._completed += 1
+            self._time_to_first_token.append(request.first_token_time - request.arrival_time)
+            self._latency.append(request.finish_time - request.arrival_time)
+
+
+def _percentile(sorted_values: List[float], percentile: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile / 100))]
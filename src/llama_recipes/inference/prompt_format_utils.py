@@ -175,6 +175,11 @@ def create_conversation(messges: List[str]) -> List[ConversationTurn]:
 
     return conversations
 
+def get_default_category_codes(llama_guard_version: LlamaGuardVersion = LlamaGuardVersion.LLAMA_GUARD_2) -> List[str]:
+    if llama_guard_version == LlamaGuardVersion.LLAMA_GUARD_2:
+        return [f"{LLAMA_GUARD_2_CATEGORY_SHORT_NAME_PREFIX}{i+1}" for i in range(len(LLAMA_GUARD_2_CATEGORY))]
+    return [f"{LLAMA_GUARD_1_CATEGORY_SHORT_NAME_PREFIX}{i+1}" for i in range(len(LLAMA_GUARD_1_CATEGORY))]
+
 def build_default_prompt(
         agent_type: AgentType, 
         conversations: List[ConversationTurn], 
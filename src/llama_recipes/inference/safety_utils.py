@@ -1,86 +1,279 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
+import hashlib
+import json
 import os
+import sqlite3
+import threading
+import time
 import torch
+import unicodedata
 import warnings
-from typing import List
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Hashable, List, Optional, Sequence, Tuple, Union
 from string import Template
 from enum import Enum
 
+from llama_recipes.inference.prompt_format_utils import LlamaGuardVersion, get_default_category_codes
+
 
 class AgentType(Enum):
     AGENT = "Agent"
     USER = "User"
 
+
+# Models of the safety checkers, shared by all checkers and requests of the process
+_SHARED_MODELS: Dict[Hashable, object] = {}
+_SHARED_MODELS_LOCK = threading.Lock()
+
+
+def get_shared_model(key: Hashable, load_model: Callable[[], object]):
+    """
+    Returns the model stored under key, calling load_model only the first time the key is requested in this process
+    """
+    with _SHARED_MODELS_LOCK:
+        if key not in _SHARED_MODELS:
+            _SHARED_MODELS[key] = load_model()
+        return _SHARED_MODELS[key]
+
+
+def clear_shared_models():
+    with _SHARED_MODELS_LOCK:
+        _SHARED_MODELS.clear()
+
+
+def _load_salesforce_model(model_id):
+    from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, AutoConfig
+
+    config = AutoConfig.from_pretrained(model_id)
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_id, config=config)
+    model.eval()
+    return tokenizer, model
+
+
+def _load_llama_guard_model(model_id):
+    from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+
+    quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    # batches are left padded, so that the generated tokens of all rows start at the same position
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(model_id, quantization_config=quantization_config, device_map="auto")
+    return tokenizer, model
+
+
+def _group(values: list, sizes: List[int]) -> List[list]:
+    groups, start = [], 0
+    for size in sizes:
+        groups.append(values[start:start + size])
+        start += size
+    return groups
+
+
+def _broadcast(values: Optional[Sequence], length: int, default) -> list:
+    if values is None:
+        return [default] * length
+    if len(values) != length:
+        raise ValueError(f"Expected {length} values, got {len(values)}")
+    return list(values)
+
+
+def split_into_windows(text: str, max_length: int, overlap: int = 0, tokenizer=None) -> List[str]:
+    """
+    Splits text into windows of at most max_length tokens, or characters without tokenizer, overlapping by overlap
+
+    The text is tokenized once, the windows are cut from the original text at token boundaries.
+    """
+    if overlap >= max_length:
+        raise ValueError(f"The overlap {overlap} of the windows must be smaller than their length {max_length}")
+    step = max_length - overlap
+    if tokenizer is None:
+        if len(text) <= max_length:
+            return [text]
+        return [text[start:start + max_length] for start in range(0, len(text) - overlap, step)]
+
+    if getattr(tokenizer, "is_fast", False):
+        offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+        if len(offsets) <= max_length:
+            return [text]
+        return [
+            text[offsets[start][0]:offsets[min(start + max_length, len(offsets)) - 1][1]]
+            for start in range(0, len(offsets) - overlap, step)
+        ]
+    # slow tokenizers have no offsets, the windows are decoded from the tokens
+    input_ids = tokenizer.encode(text, add_special_tokens=False)
+    if len(input_ids) <= max_length:
+        return [text]
+    return [tokenizer.decode(input_ids[start:start + max_length]) for start in range(0, len(input_ids) - overlap, step)]
+
+
+def _aggregate_window_results(results: List[Tuple[str, bool, str]]) -> Tuple[str, bool, str]:
+    # the most severe verdict wins, the reports of all unsafe windows are kept
+    if len(results) == 1:
+        return results[0]
+    unsafe = [(k, report) for k, (_, is_safe, report) in enumerate(results) if not is_safe]
+    if not unsafe:
+        return results[0]
+    report = "\n".join(f"Window {k + 1}/{len(results)}:\n{report}" for k, report in unsafe)
+    return results[0][0], False, report
+
+
+class BatchSafetyChecker(object):
+    """
+    Base class of the safety checkers
+
+    check_batch(texts, agent_types, user_prompts) returns one (method, is_safe, report) tuple per text,
+    calling a checker with a single text is the same as a batch of one.
+    """
+    batch_size = 16
+    # checkers waiting on a remote service instead of computing locally
+    io_bound = False
+    # bumped when a change to a checker changes its verdicts, which invalidates cached verdicts
+    version = 1
+    # longer texts are checked in overlapping windows of max_window_length tokens of window_tokenizer,
+    # or characters without tokenizer, and the text is unsafe if any window is
+    max_window_length = None
+    window_overlap = 0
+    window_tokenizer = None
+
+    def __call__(self, output_text, **kwargs):
+        agent_type = kwargs.get('agent_type', AgentType.USER)
+        user_prompt = kwargs.get('user_prompt', "")
+        return self.check_batch([output_text], [agent_type], [user_prompt])[0]
+
+    def check_batch(self, texts: Sequence[str], agent_types: Optional[Sequence[AgentType]] = None, user_prompts: Optional[Sequence[str]] = None) -> List[Tuple[str, bool, str]]:
+        texts, agent_types, user_prompts, owners = self._split_batch(texts, agent_types, user_prompts)
+        results = []
+        for start in range(0, len(texts), self.batch_size):
+            end = start + self.batch_size
+            results.extend(self._check_batch(texts[start:end], agent_types[start:end], user_prompts[start:end]))
+        return [_aggregate_window_results(window_results) for window_results in _group(results, owners)]
+
+    def preprocess(self, text: str, agent_type: AgentType, user_prompt: str) -> str:
+        return text
+
+    def _split_batch(self, texts, agent_types, user_prompts):
+        # the windows of all texts form one batch, owners holds the number of windows of every text
+        texts = list(texts)
+        agent_types = _broadcast(agent_types, len(texts), AgentType.USER)
+        user_prompts = _broadcast(user_prompts, len(texts), "")
+        windows, window_agent_types, window_user_prompts, owners = [], [], [], []
+        for text, agent_type, user_prompt in zip(texts, agent_types, user_prompts):
+            text = self.preprocess(text, agent_type, user_prompt)
+            text_windows = [text] if self.max_window_length is None else split_into_windows(
+                text, self.max_window_length, self.window_overlap, self.window_tokenizer
+            )
+            windows.extend(text_windows)
+            window_agent_types.extend([agent_type] * len(text_windows))
+            window_user_prompts.extend([user_prompt] * len(text_windows))
+            owners.append(len(text_windows))
+        return windows, window_agent_types, window_user_prompts, owners
+
+    def _check_batch(self, texts: List[str], agent_types: List[AgentType], user_prompts: List[str]) -> List[Tuple[str, bool, str]]:
+        raise NotImplementedError
+
+    def warm_up(self):
+        self("Hello")
+
+    def get_config(self) -> Dict[str, object]:
+        """
+        Returns the settings of the checker which change its verdicts, like the model id or the threshold
+        """
+        config = {
+            k: v.name if isinstance(v, Enum) else v
+            for k, v in sorted(vars(self).items())
+            if isinstance(v, (str, int, float, bool, Enum, type(None))) and not k.startswith("_")
+        }
+        if self.max_window_length is not None:
+            config.update(max_window_length=self.max_window_length, window_overlap=self.window_overlap)
+        return config
+
+
 # Class for performing safety checks using AuditNLG library
-class AuditNLGSensitiveTopics(object):
+class AuditNLGSensitiveTopics(BatchSafetyChecker):
+    # the classifier reads 512 tokens, the library tokenizes internally so the windows are cut in characters
+    max_window_length = 1500
+    window_overlap = 150
+
     def __init__(self):
         pass
 
-    def __call__(self, output_text, **kwargs):
+    def _check_batch(self, texts, agent_types, user_prompts):
         try:
             from auditnlg.safety.exam import safety_scores
         except ImportError as e:
             print("Could not import optional dependency: auditnlg\nPlease install manually with:\n pip install auditnlg\nFollowed by:\npip install -r requirements.txt")
             raise e
-            
 
-        data = [{"output": output_text}]
+        data = [{"output": output_text} for output_text in texts]
 
         result = safety_scores(data=data, method="sensitive_topics")
-        scores = result[1]["all_scores"][0]
-        is_safe = scores["pred_class"] == "none"
-        report = ""
-        if not is_safe:
-            report += f"Predicted class: {scores['pred_class']}\n"
-            report += "|" + "|".join(f"{n:^10}" for n in [list(k.keys())[0] for k in scores["class_scores"]]) + "|\n"
-            report += "|" + "|".join(f"{n:^10.5}" for n in [list(k.values())[0] for k in scores["class_scores"]]) + "|\n"
-        return "Sensitive Topics", is_safe, report
-    
-    
-class SalesforceSafetyChecker(object):
-    def __init__(self):
-        pass
-
-    def __call__(self, output_text, **kwargs):
-        from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, AutoConfig
-
-        config = AutoConfig.from_pretrained("Salesforce/safety-flan-t5-base")
-        tokenizer = AutoTokenizer.from_pretrained("Salesforce/safety-flan-t5-base") 
-        model = AutoModelForSeq2SeqLM.from_pretrained("Salesforce/safety-flan-t5-base", config=config)
-        model.eval()
+        results = []
+        for scores in result[1]["all_scores"]:
+            is_safe = scores["pred_class"] == "none"
+            report = ""
+            if not is_safe:
+                report += f"Predicted class: {scores['pred_class']}\n"
+                report += "|" + "|".join(f"{n:^10}" for n in [list(k.keys())[0] for k in scores["class_scores"]]) + "|\n"
+                report += "|" + "|".join(f"{n:^10.5}" for n in [list(k.values())[0] for k in scores["class_scores"]]) + "|\n"
+            results.append(("Sensitive Topics", is_safe, report))
+        return results
+
+
+class SalesforceSafetyChecker(BatchSafetyChecker):
+    batch_size = 32
+    # the model reads 512 tokens, including the prompt around the text
+    max_window_length = 480
+    window_overlap = 64
+
+    def __init__(self, model_id="Salesforce/safety-flan-t5-base"):
+        self.model_id = model_id
+        self.tokenizer, self.model = get_shared_model(model_id, lambda: _load_salesforce_model(model_id))
+        self.window_tokenizer = self.tokenizer
+
+    def _check_batch(self, texts, agent_types, user_prompts):
+        tokenizer, model = self.tokenizer, self.model
 
         prefix = "Is the <Text> field safe or unsafe?"
-        input_ids = tokenizer(prefix + " <Text> " + output_text + " <Context> ", return_tensors="pt").input_ids
-        
-        if len(input_ids[0]) > 512:
+        inputs = tokenizer([prefix + " <Text> " + output_text + " <Context> " for output_text in texts], padding=True, return_tensors="pt")
+
+        if inputs.input_ids.shape[-1] > 512:
             warnings.warn(
                 "Input length is > 512 token. Safety check result could be incorrect."
             )
 
         with torch.no_grad():
             outputs = model.generate(
-                input_ids,
+                **inputs,
                 output_scores=True,
                 return_dict_in_generate=True,
                 max_new_tokens=20,
                 )
-        
-        is_safe = tokenizer.decode(outputs.sequences[0], skip_special_tokens=True).split(" ")[0] == "safe"    
-            
-        report = ""
-        if not is_safe:
-            true_false_ids = tokenizer("true false").input_ids[:2]
-            keys = ["toxicity", "hate", "identity", "violence", "physical", "sexual", "profanity", "biased"]
-            scores = {}
-            for k, i in zip(keys, range(3,20,2)):
-                scores[k] = round(outputs.scores[i][0,true_false_ids].softmax(dim=0)[0].item(), 5)
-            
-            report += "|" + "|".join(f"{n:^10}" for n in scores.keys()) + "|\n"
-            report += "|" + "|".join(f"{n:^10}" for n in scores.values()) + "|\n"
-        return "Salesforce Content Safety Flan T5 Base", is_safe, report
-        
+
+        true_false_ids = tokenizer("true false").input_ids[:2]
+        keys = ["toxicity", "hate", "identity", "violence", "physical", "sexual", "profanity", "biased"]
+        results = []
+        for row, sequence in enumerate(outputs.sequences):
+            is_safe = tokenizer.decode(sequence, skip_special_tokens=True).split(" ")[0] == "safe"
+
+            report = ""
+            if not is_safe:
+                scores = {}
+                for k, i in zip(keys, range(3,20,2)):
+                    if i < len(outputs.scores):
+                        scores[k] = round(outputs.scores[i][row,true_false_ids].softmax(dim=0)[0].item(), 5)
+
+                report += "|" + "|".join(f"{n:^10}" for n in scores.keys()) + "|\n"
+                report += "|" + "|".join(f"{n:^10}" for n in scores.values()) + "|\n"
+            results.append(("Salesforce Content Safety Flan T5 Base", is_safe, report))
+        return results
 
     def get_total_length(self, data):
         prefix = "Is the <Text> field safe or unsafe "
@@ -90,7 +283,12 @@ class SalesforceSafetyChecker(object):
 
 
 # Class for performing safety checks using Azure Content Safety service
-class AzureSaftyChecker(object):
+class AzureSaftyChecker(BatchSafetyChecker):
+    io_bound = True
+    # the service analyzes at most 1000 characters per request
+    max_window_length = 1000
+    window_overlap = 100
+
     def __init__(self):
         try:
             from azure.ai.contentsafety import ContentSafetyClient
@@ -109,14 +307,18 @@ class AzureSaftyChecker(object):
 
         self.client = ContentSafetyClient(endpoint, AzureKeyCredential(key))
 
-    def __call__(self, output_text, **kwargs):
+    def warm_up(self):
+        # nothing is loaded locally, the service is only called on demand
+        pass
+
+    def _check_batch(self, texts, agent_types, user_prompts):
+        # the service analyzes one text per request
+        return [self._check(output_text) for output_text in texts]
+
+    def _check(self, output_text):
         from azure.core.exceptions import HttpResponseError
         from azure.ai.contentsafety.models import AnalyzeTextOptions, TextCategory
 
-        print(len(output_text))
-        if len(output_text) > 1000:
-            raise Exception("Input length to safety check is too long (>1000).")
-
         categories = [
             TextCategory.VIOLENCE,
             TextCategory.SELF_HARM,
@@ -154,61 +356,589 @@ class AzureSaftyChecker(object):
 
         return "Azure Content Saftey API", is_safe, report
 
-class LlamaGuardSafetyChecker(object):
+@dataclass
+class LlamaGuardScore:
+    # probability of "unsafe" against "safe" as the first generated token
+    unsafe_probability: float
+    is_safe: bool
+    # probability of every category to be listed first, only computed for unsafe verdicts
+    category_probabilities: Dict[str, float] = field(default_factory=dict)
+
+    def __str__(self):
+        report = f"unsafe probability: {self.unsafe_probability:.4f}"
+        if self.category_probabilities:
+            report += "\n" + ", ".join(f"{code}: {p:.4f}" for code, p in self.category_probabilities.items())
+        return report
+
+
+def _get_first_token_id(tokenizer, text):
+    return tokenizer.encode(text, add_special_tokens=False)[0]
+
+
+def _get_category_tokens(tokenizer, category_codes):
+    # the tokens of "unsafe\n" and of the code prefix shared by all codes, and the token telling the codes apart
+    code_ids = [tokenizer.encode(f"unsafe\n{code}", add_special_tokens=False) for code in category_codes]
+    prefix_len = 0
+    while all(len(ids) > prefix_len + 1 for ids in code_ids) and len({ids[prefix_len] for ids in code_ids}) == 1:
+        prefix_len += 1
+    category_ids = [ids[prefix_len] for ids in code_ids]
+    if any(len(ids) != prefix_len + 1 for ids in code_ids) or len(set(category_ids)) != len(category_ids):
+        raise ValueError(f"The category codes {category_codes} do not differ in exactly their last token")
+    return code_ids[0][:prefix_len], category_ids
+
+
+def _get_verdict_logits(model, tokenizer, prompts, add_special_tokens):
+    # the inputs of the prompts and the logits of "safe" and "unsafe" as the first generated token
+    if tokenizer.padding_side != "left":
+        raise ValueError("Scoring Llama Guard prompts needs a tokenizer with padding_side='left'")
+    verdict_ids = [_get_first_token_id(tokenizer, "safe"), _get_first_token_id(tokenizer, "unsafe")]
+    if verdict_ids[0] == verdict_ids[1]:
+        raise ValueError("The tokens of 'safe' and 'unsafe' start with the same token, they can not be scored")
+
+    inputs = tokenizer(list(prompts), padding=True, add_special_tokens=add_special_tokens, return_tensors="pt").to(model.device)
+    with torch.no_grad():
+        logits = model(**inputs).logits[:, -1, verdict_ids].float()
+    return inputs, logits
+
+
+def fit_llama_guard_temperature(
+    model,
+    tokenizer,
+    prompts: Sequence[str],
+    is_unsafe: Sequence[bool],
+    batch_size: int = 8,
+    add_special_tokens: bool = False,
+) -> float:
+    """
+    Returns the temperature that calibrates the probability of "unsafe" of score_llama_guard_prompts
+
+    The temperature minimizes the negative log likelihood of the labels of held out prompts, the probabilities
+    of the model are not calibrated on their own. The prompts need both safe and unsafe examples.
+    """
+    if len(prompts) != len(is_unsafe):
+        raise ValueError(f"Got {len(prompts)} prompts but {len(is_unsafe)} labels")
+    if all(is_unsafe) or not any(is_unsafe):
+        raise ValueError("Fitting the temperature needs both safe and unsafe prompts")
+    margins = torch.cat([
+        # the log odds of "unsafe" against "safe"
+        logits[:, 1] - logits[:, 0]
+        for logits in (
+            _get_verdict_logits(model, tokenizer, prompts[start:start + batch_size], add_special_tokens)[1].cpu()
+            for start in range(0, len(prompts), batch_size)
+        )
+    ])
+    labels = torch.tensor(is_unsafe, dtype=torch.float)
+
+    # the temperature is fit in log space to stay positive
+    log_temperature = torch.zeros(1, requires_grad=True)
+    optimizer = torch.optim.LBFGS([log_temperature], lr=0.1, max_iter=100, line_search_fn="strong_wolfe")
+
+    def closure():
+        optimizer.zero_grad()
+        loss = torch.nn.functional.binary_cross_entropy_with_logits(margins / log_temperature.exp(), labels)
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+    return log_temperature.exp().item()
+
+
+def score_llama_guard_prompts(
+    model,
+    tokenizer,
+    prompts: Sequence[str],
+    category_codes: Sequence[str],
+    threshold: float = 0.5,
+    temperature: float = 1.0,
+    add_special_tokens: bool = False,
+) -> List[LlamaGuardScore]:
+    """
+    Classifies Llama Guard prompts with one forward pass instead of generating the verdict
+
+    The probability of "unsafe" is the softmax of the "safe" and "unsafe" logits of the first generated token,
+    divided by temperature. The default temperature of 1.0 keeps the probability of the model, which is not
+    calibrated, fit_llama_guard_temperature finds the temperature that calibrates it on labeled prompts.
+    Prompts at or above threshold get a second forward pass over "unsafe\n" and the code prefix, scoring the
+    probability of every category code to be listed first. The tokenizer must pad on the left.
+    """
+    inputs, logits = _get_verdict_logits(model, tokenizer, prompts, add_special_tokens)
+    unsafe_probabilities = (logits / temperature).softmax(dim=-1)[:, 1]
+    is_unsafe = unsafe_probabilities >= threshold
+
+    scores = [
+        LlamaGuardScore(unsafe_probability=p, is_safe=not unsafe)
+        for p, unsafe in zip(unsafe_probabilities.tolist(), is_unsafe.tolist())
+    ]
+    if not is_unsafe.any() or not category_codes:
+        return scores
+
+    prefix_ids, category_ids = _get_category_tokens(tokenizer, category_codes)
+    rows = is_unsafe.nonzero().squeeze(-1)
+    suffix = torch.tensor(prefix_ids, dtype=inputs.input_ids.dtype, device=inputs.input_ids.device).expand(len(rows), -1)
+    input_ids = torch.cat([inputs.input_ids[rows], suffix], dim=-1)
+    attention_mask = torch.cat([inputs.attention_mask[rows], torch.ones_like(suffix)], dim=-1)
+    with torch.no_grad():
+        category_logits = model(input_ids=input_ids, attention_mask=attention_mask).logits[:, -1, category_ids].float()
+    for row, probabilities in zip(rows.tolist(), (category_logits / temperature).softmax(dim=-1).tolist()):
+        scores[row].category_probabilities = dict(zip(category_codes, probabilities))
+    return scores
+
+
+def _is_llama_guard_verdict_complete(text: str) -> bool:
+    lines = text.lstrip().split("\n")
+    verdict = lines[0].strip()
+    if verdict == "safe":
+        return True
+    if verdict == "unsafe":
+        # the line of the violated categories is complete once the next line starts
+        return len(lines) > 2
+    # the first line is no verdict, generating more does not make it one
+    return len(lines) > 1
+
+
+class LlamaGuardVerdictStoppingCriteria:
+    """
+    Stopping criteria for model.generate that finishes every row once its Llama Guard verdict is complete
+
+    "safe" is complete on its own, "unsafe" once the line of the violated categories ends. This keeps a batch from
+    generating up to max_new_tokens when a row does not end its verdict with the end of sequence token.
+    """
+
+    def __init__(self, tokenizer, prompt_len: int):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        is_done = [
+            _is_llama_guard_verdict_complete(self.tokenizer.decode(generated, skip_special_tokens=True))
+            for generated in input_ids[:, self.prompt_len:]
+        ]
+        return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
+
+
+class LlamaGuardSafetyChecker(BatchSafetyChecker):
+    # leaves room for the policy, the user prompt of agent checks and the verdict in the 4096 tokens context
+    max_window_length = 2048
+    window_overlap = 128
+
+    def __init__(
+        self,
+        model_id="meta-llama/LlamaGuard-7b",
+        max_new_tokens=20,
+        mode="generate",
+        threshold=0.5,
+        temperature=1.0,
+        llama_guard_version=LlamaGuardVersion.LLAMA_GUARD_1,
+    ):
+        if mode not in ("generate", "score"):
+            raise ValueError(f"Unknown Llama Guard mode {mode}, valid modes are generate and score")
+        self.model_id = model_id
+        self.tokenizer, self.model = get_shared_model(model_id, lambda: _load_llama_guard_model(model_id))
+        # the verdict and the violated categories are a few tokens, generation stops at the end of sequence token
+        # or once the verdict is complete, see LlamaGuardVerdictStoppingCriteria
+        self.max_new_tokens = max_new_tokens
+        # in score mode the verdict comes from the probability of "unsafe", see score_llama_guard_prompts
+        # and fit_llama_guard_temperature for the temperature that calibrates it
+        self.mode = mode
+        self.threshold = threshold
+        self.temperature = temperature
+        self.category_codes = get_default_category_codes(llama_guard_version)
+        self.window_tokenizer = self.tokenizer
+
+    def preprocess(self, output_text, agent_type, user_prompt):
+        # the agent response is checked without the user prompt it repeats
+        model_prompt = output_text.strip()
+        if agent_type == AgentType.AGENT and user_prompt != "":
+            model_prompt = model_prompt.replace(user_prompt, "")
+        return model_prompt
 
-    def __init__(self):
-        from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
-        from llama_recipes.inference.prompt_format_utils import build_default_prompt, create_conversation, LlamaGuardVersion
+    def _create_chat(self, model_prompt, agent_type, user_prompt):
+        if(agent_type == AgentType.AGENT):
+            if user_prompt == "":
+                return None
+            user_prompt = f"User: {user_prompt}"
+            agent_prompt = f"Agent: {model_prompt}"
+            return [
+                {"role": "user", "content": user_prompt},
+                {"role": "assistant", "content": agent_prompt},
+            ]
+        return [
+            {"role": "user", "content": model_prompt},
+        ]
+
+    def _get_prompts(self, texts, agent_types, user_prompts):
+        prompts = []
+        for output_text, agent_type, user_prompt in zip(texts, agent_types, user_prompts):
+            chat = self._create_chat(output_text, agent_type, user_prompt)
+            prompts.append(None if chat is None else self.tokenizer.apply_chat_template(chat, tokenize=False))
+        return prompts
+
+    def score_batch(self, texts, agent_types=None, user_prompts=None) -> List[Optional[LlamaGuardScore]]:
+        """
+        Returns the LlamaGuardScore of every text, None for agent responses without user prompt
+        """
+        windows, window_agent_types, window_user_prompts, owners = self._split_batch(texts, agent_types, user_prompts)
+        scores = self._score_windows(windows, window_agent_types, window_user_prompts)
+        # the window with the highest probability of being unsafe scores the text
+        return [
+            None if None in window_scores else max(window_scores, key=lambda score: score.unsafe_probability)
+            for window_scores in _group(scores, owners)
+        ]
 
-        model_id = "meta-llama/LlamaGuard-7b"
+    def _score_windows(self, texts, agent_types, user_prompts):
+        prompts = self._get_prompts(texts, agent_types, user_prompts)
+        indices = [i for i, prompt in enumerate(prompts) if prompt is not None]
+        scores = [None] * len(texts)
+        for start in range(0, len(indices), self.batch_size):
+            batch_indices = indices[start:start + self.batch_size]
+            batch_scores = score_llama_guard_prompts(
+                self.model,
+                self.tokenizer,
+                [prompts[i] for i in batch_indices],
+                self.category_codes,
+                threshold=self.threshold,
+                temperature=self.temperature,
+            )
+            for i, score in zip(batch_indices, batch_scores):
+                scores[i] = score
+        return scores
+
+    def _check_batch(self, texts, agent_types, user_prompts):
+        if self.mode == "score":
+            results = []
+            for score in self._score_windows(texts, agent_types, user_prompts):
+                if score is None:
+                    print("empty user prompt for agent check, returning unsafe")
+                    results.append(("Llama Guard", False, "Missing user_prompt from Agent response check"))
+                else:
+                    results.append(("Llama Guard", score.is_safe, str(score)))
+            return results
+
+        results = [None] * len(texts)
+        prompts = []
+        for i, prompt in enumerate(self._get_prompts(texts, agent_types, user_prompts)):
+            if prompt is None:
+                print("empty user prompt for agent check, returning unsafe")
+                results[i] = ("Llama Guard", False, "Missing user_prompt from Agent response check")
+            else:
+                prompts.append((i, prompt))
+        if not prompts:
+            return results
 
-        quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+        inputs = self.tokenizer(
+            [prompt for _, prompt in prompts], padding=True, add_special_tokens=False, return_tensors="pt"
+        ).to(self.model.device)
+        from transformers import StoppingCriteriaList
 
-        self.tokenizer = AutoTokenizer.from_pretrained(model_id)
-        self.model = AutoModelForCausalLM.from_pretrained(model_id, quantization_config=quantization_config, device_map="auto")
+        prompt_len = inputs.input_ids.shape[-1]
+        with torch.no_grad():
+            output = self.model.generate(
+                **inputs,
+                max_new_tokens=self.max_new_tokens,
+                pad_token_id=self.tokenizer.pad_token_id,
+                stopping_criteria=StoppingCriteriaList([LlamaGuardVerdictStoppingCriteria(self.tokenizer, prompt_len)]),
+            )
+        for (i, _), generated in zip(prompts, output[:, prompt_len:]):
+            result = self.tokenizer.decode(generated, skip_special_tokens=True)
+
+            splitted_result = result.split("\n")[0]
+            is_safe = splitted_result == "safe"
+
+            results[i] = ("Llama Guard", is_safe, result)
+        return results
+
+
+def check_batch(safety_checker, texts: Sequence[str], agent_types: Optional[Sequence[AgentType]] = None, user_prompts: Optional[Sequence[str]] = None) -> List[List[Tuple[str, bool, str]]]:
+    """
+    Runs every checker once over all texts and returns the results of all checkers for each text
+    """
+    results_per_checker = [check.check_batch(texts, agent_types, user_prompts) for check in safety_checker]
+    return [list(results) for results in zip(*results_per_checker)] if results_per_checker else [[] for _ in texts]
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class VerdictCache(object):
+    """
+    Cache of safety verdicts with an in-memory LRU tier and an optional SQLite tier shared across processes
+
+    Entries older than ttl seconds are ignored and replaced. hits, misses and get_metrics report the use of the cache.
+    """
+    def __init__(self, max_size: int = 10000, path: Optional[str] = None, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS verdicts (key TEXT PRIMARY KEY, method TEXT, is_safe INTEGER, report TEXT, created REAL)")
+            self._db.commit()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _is_expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _remember(self, key: str, result: Tuple[str, bool, str], created: float):
+        self._memory[key] = (result, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Tuple[str, bool, str]]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._is_expired(entry[1]):
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if self._db is not None:
+                row = self._db.execute("SELECT method, is_safe, report, created FROM verdicts WHERE key = ?", (key,)).fetchone()
+                if row is not None and not self._is_expired(row[3]):
+                    result = (row[0], bool(row[1]), row[2])
+                    self._remember(key, result, row[3])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return result
+            self.misses += 1
+            return None
+
+    def put(self, key: str, result: Tuple[str, bool, str]):
+        created = time.time()
+        with self._lock:
+            self._remember(key, result, created)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO verdicts (key, method, is_safe, report, created) VALUES (?, ?, ?, ?, ?)",
+                    (key, result[0], int(result[1]), result[2], created),
+                )
+                self._db.commit()
+
+    def get_metrics(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self._memory),
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class CachedSafetyChecker(BatchSafetyChecker):
+    """
+    Wraps a safety checker, answering texts it has already checked from a VerdictCache
+
+    Verdicts are keyed by the checker class, version and config, the text with normalized whitespace,
+    the agent type and the hash of the user prompt. Only the texts missing from the cache are checked, in one batch.
+    """
+    def __init__(self, checker: BatchSafetyChecker, cache: VerdictCache):
+        self.checker = checker
+        self.cache = cache
+        self.io_bound = checker.io_bound
+        self._checker_key = json.dumps(
+            [type(checker).__name__, checker.version, checker.get_config()], sort_keys=True, default=str
+        )
+
+    def get_key(self, text: str, agent_type: AgentType, user_prompt: str) -> str:
+        agent_type = agent_type.value if isinstance(agent_type, Enum) else agent_type
+        return _hash(json.dumps([self._checker_key, normalize_text(text), agent_type, _hash(user_prompt or "")]))
+
+    def check_batch(self, texts, agent_types=None, user_prompts=None):
+        texts = list(texts)
+        agent_types = _broadcast(agent_types, len(texts), AgentType.USER)
+        user_prompts = _broadcast(user_prompts, len(texts), "")
+        keys = [self.get_key(*args) for args in zip(texts, agent_types, user_prompts)]
+        results = [self.cache.get(key) for key in keys]
+
+        # every distinct missing input is checked once
+        missing = {}
+        for i, result in enumerate(results):
+            if result is None:
+                missing.setdefault(keys[i], i)
+        if missing:
+            indices = list(missing.values())
+            checked = self.checker.check_batch(
+                [texts[i] for i in indices], [agent_types[i] for i in indices], [user_prompts[i] for i in indices]
+            )
+            for i, result in zip(indices, checked):
+                self.cache.put(keys[i], result)
+            positions = {key: n for n, key in enumerate(missing)}
+            for i, key in enumerate(keys):
+                if results[i] is None:
+                    results[i] = checked[positions[key]]
+        return results
+
+    def warm_up(self):
+        self.checker.warm_up()
+
+
+def _get_checker_name(check) -> str:
+    return type(check.checker if isinstance(check, CachedSafetyChecker) else check).__name__
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+class SafetyPipeline(object):
+    """
+    Runs independent safety checkers concurrently, so that the latency of a check is the one of the slowest checker
+
+    Every checker gets its own worker thread, model checkers compute in parallel since torch releases the GIL.
+    Batches of io_bound checkers like the Azure service are split into one request per text, sent from
+    io_workers threads. A checker that does not answer within its timeout, in seconds, counts as unsafe.
+    With short_circuit, a single check returns as soon as one checker finds the text unsafe, without the
+    results of the checkers still running. A running check can not be cancelled, so a checker that timed out
+    gets a new worker for the next calls while the old one finishes or hangs on its own.
+    check_with_latencies returns the latency of every checker together with the results of the call.
+    """
+    def __init__(self, safety_checker, timeout: Optional[Union[float, Dict[str, float]]] = None, short_circuit: bool = False, io_workers: int = 8):
+        self.safety_checker = list(safety_checker)
+        self.names = [_get_checker_name(check) for check in self.safety_checker]
+        self.timeouts = [timeout.get(name) if isinstance(timeout, dict) else timeout for name in self.names]
+        self.short_circuit = short_circuit
+        self.io_workers = io_workers
+        self.executors = [self._new_executor(i) for i in range(len(self.safety_checker))]
+        # concurrent calls of the threaded server may replace the executor of a checker
+        self._executors_lock = threading.Lock()
+
+    def _new_executor(self, i):
+        check = self.safety_checker[i]
+        return ThreadPoolExecutor(max_workers=self.io_workers if check.io_bound else 1, thread_name_prefix=self.names[i])
+
+    def _replace_executor(self, i, executor):
+        with self._executors_lock:
+            # only once, when several calls time out on the same hung worker
+            if self.executors[i] is executor:
+                self.executors[i] = self._new_executor(i)
+        # checks of other calls queued behind the hung one still run if it ever returns
+        executor.shutdown(wait=False)
+
+    def __len__(self):
+        return len(self.safety_checker)
+
+    def __iter__(self):
+        return iter(self.safety_checker)
+
+    def _run(self, submit, short_circuit):
+        # submit(i, executor) returns the futures of checker i, results are collected in checker order
+        start = time.perf_counter()
+        futures = {}
+        # submitted under the lock, a concurrent call may shut down the executor it replaces
+        with self._executors_lock:
+            executors = list(self.executors)
+            for i, executor in enumerate(executors):
+                for future in submit(i, executor):
+                    futures[future] = i
+        pending = set(futures)
+        outputs = [[] for _ in self.safety_checker]
+        done_checkers = set()
+        timed_out = set()
+        latencies = {}
+        while pending:
+            now = time.perf_counter() - start
+            deadlines = [self.timeouts[futures[f]] for f in pending if self.timeouts[futures[f]] is not None]
+            wait_time = max(min(deadlines) - now, 0) if deadlines else None
+            done, pending = wait(pending, timeout=wait_time, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = futures[future]
+                result, latency = future.result()
+                outputs[i].append(result)
+                latencies[self.names[i]] = max(latencies.get(self.names[i], 0.0), latency)
+                if not any(futures[f] == i for f in pending):
+                    done_checkers.add(i)
+            now = time.perf_counter() - start
+            for future in list(pending):
+                i = futures[future]
+                if self.timeouts[i] is not None and now >= self.timeouts[i]:
+                    pending.discard(future)
+                    if i not in timed_out:
+                        timed_out.add(i)
+                        self._replace_executor(i, executors[i])
+            if short_circuit and any(not r[1] for i in done_checkers for r in outputs[i]):
+                for future in pending:
+                    future.cancel()
+                break
+        return outputs, done_checkers, timed_out, latencies
 
     def __call__(self, output_text, **kwargs):
-        
-        agent_type = kwargs.get('agent_type', AgentType.USER)
-        user_prompt = kwargs.get('user_prompt', "")
-
-        model_prompt = output_text.strip()
-        if(agent_type == AgentType.AGENT):
-            if user_prompt == "":
-                print("empty user prompt for agent check, returning unsafe")
-                return "Llama Guard", False, "Missing user_prompt from Agent response check"
-            else:
-                model_prompt = model_prompt.replace(user_prompt, "")
-                user_prompt = f"User: {user_prompt}"
-                agent_prompt = f"Agent: {model_prompt}"
-                chat = [
-                    {"role": "user", "content": user_prompt},
-                    {"role": "assistant", "content": agent_prompt},
+        return self.check_with_latencies(output_text, **kwargs)[0]
+
+    def check_with_latencies(self, output_text, **kwargs) -> Tuple[List[Tuple[str, bool, str]], Dict[str, float]]:
+        """
+        Returns the results of the checkers like __call__ and the latency of every checker that answered, in seconds
+        """
+        outputs, done_checkers, timed_out, latencies = self._run(
+            lambda i, executor: [executor.submit(_timed, lambda check=self.safety_checker[i]: check(output_text, **kwargs))],
+            self.short_circuit,
+        )
+        results = []
+        for i, name in enumerate(self.names):
+            if i in timed_out:
+                results.append((name, False, f"Safety check timed out after {self.timeouts[i]}s"))
+            elif i in done_checkers:
+                results.append(outputs[i][0])
+        return results, latencies
+
+    def check_batch(self, texts: Sequence[str], agent_types: Optional[Sequence[AgentType]] = None, user_prompts: Optional[Sequence[str]] = None) -> List[List[Tuple[str, bool, str]]]:
+        """
+        Returns the results of all checkers for each text, like check_batch(safety_checker, ...)
+        """
+        texts = list(texts)
+        agent_types = _broadcast(agent_types, len(texts), AgentType.USER)
+        user_prompts = _broadcast(user_prompts, len(texts), "")
+
+        def submit(i, executor):
+            check = self.safety_checker[i]
+            if check.io_bound:
+                return [
+                    executor.submit(_timed, lambda j=j: (j, check.check_batch(texts[j:j + 1], agent_types[j:j + 1], user_prompts[j:j + 1])))
+                    for j in range(len(texts))
                 ]
-        else:
-            chat = [
-                {"role": "user", "content": model_prompt},
-            ]
+            return [executor.submit(_timed, lambda: (0, check.check_batch(texts, agent_types, user_prompts)))]
 
-        input_ids = self.tokenizer.apply_chat_template(chat, return_tensors="pt").to("cuda")
-        prompt_len = input_ids.shape[-1]
-        output = self.model.generate(input_ids=input_ids, max_new_tokens=100, pad_token_id=0)
-        result = self.tokenizer.decode(output[0][prompt_len:], skip_special_tokens=True)
-        
-        splitted_result = result.split("\n")[0];
-        is_safe = splitted_result == "safe"    
+        outputs, _, timed_out, _ = self._run(submit, short_circuit=False)
+        results = [[] for _ in texts]
+        for i, name in enumerate(self.names):
+            if i in timed_out:
+                for text_results in results:
+                    text_results.append((name, False, f"Safety check timed out after {self.timeouts[i]}s"))
+                continue
+            for offset, checker_results in sorted(outputs[i], key=lambda output: output[0]):
+                for j, result in enumerate(checker_results):
+                    results[offset + j].append(result)
+        return results
+
+    def close(self):
+        for executor in self.executors:
+            executor.shutdown(wait=False, cancel_futures=True)
 
-        report = result
-        
-        return "Llama Guard", is_safe, report
-        
 
-# Function to load the PeftModel for performance optimization
 # Function to determine which safety checker to use based on the options selected
+# The models are loaded once per process and shared by all checkers, warm_up runs a first check right away
+# With a VerdictCache, every checker answers the texts it has already checked from the cache
 def get_safety_checker(enable_azure_content_safety,
                        enable_sensitive_topics,
                        enable_salesforce_content_safety,
-                       enable_llamaguard_content_safety):
+                       enable_llamaguard_content_safety,
+                       warm_up=False,
+                       cache=None):
     safety_checker = []
     if enable_azure_content_safety:
         safety_checker.append(AzureSaftyChecker())
@@ -218,5 +948,9 @@ def get_safety_checker(enable_azure_content_safety,
         safety_checker.append(SalesforceSafetyChecker())
     if enable_llamaguard_content_safety:
         safety_checker.append(LlamaGuardSafetyChecker())
+    if cache is not None:
+        safety_checker = [CachedSafetyChecker(check, cache) for check in safety_checker]
+    if warm_up:
+        for check in safety_checker:
+            check.warm_up()
     return safety_checker
-
@@ -1,12 +1,31 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
-from llama_recipes.model_checkpointing.checkpoint_handler import (
-    load_model_checkpoint,
-    save_model_checkpoint,
-    load_optimizer_checkpoint,
-    save_optimizer_checkpoint,
-    save_model_and_optimizer_sharded,
-    load_model_sharded,
-    load_sharded_model_single_gpu
-)
+import importlib
+
+_LAZY_IMPORTS = {
+    "load_model_checkpoint": "llama_recipes.model_checkpointing.checkpoint_handler",
+    "save_model_checkpoint": "llama_recipes.model_checkpointing.checkpoint_handler",
+    "load_optimizer_checkpoint": "llama_recipes.model_checkpointing.checkpoint_handler",
+    "save_optimizer_checkpoint": "llama_recipes.model_checkpointing.checkpoint_handler",
+    "save_model_and_optimizer_sharded": "llama_recipes.model_checkpointing.checkpoint_handler",
+    "load_model_sharded": "llama_recipes.model_checkpointing.checkpoint_handler",
+    "load_sharded_model_single_gpu": "llama_recipes.model_checkpointing.checkpoint_handler",
+    "save_training_state": "llama_recipes.model_checkpointing.checkpoint_handler",
+    "load_training_state": "llama_recipes.model_checkpointing.checkpoint_handler",
+}
+
+__all__ = list(_LAZY_IMPORTS)
+
+
+def __getattr__(name):
+    # the checkpoint handler imports torch.distributed.checkpoint, import it on first use only
+    if name in _LAZY_IMPORTS:
+        value = getattr(importlib.import_module(_LAZY_IMPORTS[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -3,6 +3,7 @@
 
 from pathlib import Path
 from datetime import datetime
+import json
 import torch
 import time
 
@@ -43,6 +44,46 @@ def get_date_of_run():
 # create singleton saving policies to avoid making over and over
 fullstate_save_policy = FullStateDictConfig(offload_to_cpu=True, rank0_only=True)
 
+TRAINING_STATE_NAME = "training_state.json"
+
+
+def get_checkpoint_dir(cfg):
+    """the PEFT modules are saved to output_dir, the FSDP checkpoints to the dist checkpoint folder"""
+    if cfg.use_peft:
+        return Path(cfg.output_dir)
+    return Path.cwd() / (
+        cfg.dist_checkpoint_root_folder
+        + "/"
+        + cfg.dist_checkpoint_folder
+        + "-"
+        + cfg.model_name
+    )
+
+
+def save_training_state(dataset, epoch, rank, cfg):
+    """save the epoch and the state of the training dataset, e.g. a mixture, next to the model checkpoint"""
+    if rank:
+        return
+    state = {"epoch": epoch}
+    if hasattr(dataset, "state_dict"):
+        state["dataset"] = dataset.state_dict()
+    save_dir = get_checkpoint_dir(cfg)
+    save_dir.mkdir(parents=True, exist_ok=True)
+    with open(save_dir / TRAINING_STATE_NAME, "w") as f:
+        json.dump(state, f)
+
+
+def load_training_state(dataset, cfg):
+    """restore the state of the training dataset and return the epoch of the checkpoint"""
+    state_path = get_checkpoint_dir(cfg) / TRAINING_STATE_NAME
+    if not state_path.is_file():
+        raise FileNotFoundError(f"No training state to resume from at {state_path}")
+    with open(state_path) as f:
+        state = json.load(f)
+    if "dataset" in state and hasattr(dataset, "load_state_dict"):
+        dataset.load_state_dict(state["dataset"])
+    return state["epoch"]
+
 
 def load_model_sharded(model, rank, cfg):
     # torch.manual_seed(103)
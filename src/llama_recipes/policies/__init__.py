@@ -1,7 +1,34 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
-from llama_recipes.policies.mixed_precision import *
-from llama_recipes.policies.wrapping import *
-from llama_recipes.policies.activation_checkpointing_functions import apply_fsdp_checkpointing
-from llama_recipes.policies.anyprecision_optimizer import AnyPrecisionAdamW
+import importlib
+
+_LAZY_IMPORTS = {
+    "fpSixteen": "llama_recipes.policies.mixed_precision",
+    "bfSixteen": "llama_recipes.policies.mixed_precision",
+    "bfSixteen_mixed": "llama_recipes.policies.mixed_precision",
+    "fp32_policy": "llama_recipes.policies.mixed_precision",
+    "get_size_policy": "llama_recipes.policies.wrapping",
+    "get_llama_wrapper": "llama_recipes.policies.wrapping",
+    "apply_fsdp_checkpointing": "llama_recipes.policies.activation_checkpointing_functions",
+    "get_layers_to_checkpoint": "llama_recipes.policies.activation_checkpointing_functions",
+    "probe_activation_memory": "llama_recipes.policies.activation_checkpointing_functions",
+    "AnyPrecisionAdamW": "llama_recipes.policies.anyprecision_optimizer",
+    "OptimizerInBackward": "llama_recipes.policies.optimizer_in_backward",
+    "apply_regional_compile": "llama_recipes.policies.compile_functions",
+}
+
+__all__ = list(_LAZY_IMPORTS)
+
+
+def __getattr__(name):
+    # the wrapping and checkpointing policies import the transformers model classes, import them on first use only
+    if name in _LAZY_IMPORTS:
+        value = getattr(importlib.import_module(_LAZY_IMPORTS[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -3,12 +3,14 @@
 
 from functools import partial
 
+import torch
 from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import (
     checkpoint_wrapper,
+    offload_wrapper,
     CheckpointImpl,
     apply_activation_checkpointing,
 )
-from transformers.models.llama.modeling_llama import LlamaDecoderLayer
+from transformers.models.llama.modeling_llama import LlamaAttention, LlamaDecoderLayer, LlamaMLP
 
 non_reentrant_wrapper = partial(
     checkpoint_wrapper,
@@ -17,13 +19,143 @@ non_reentrant_wrapper = partial(
 
 check_fn = lambda submodule: isinstance(submodule, LlamaDecoderLayer)
 
+ACTIVATION_CHECKPOINTING_POLICIES = ("full", "every_k_layers", "attention", "mlp", "memory_budget")
 
-def apply_fsdp_checkpointing(model):
+
+def get_checkpointing_check_fn(policy="full", interval=2, layers_to_checkpoint=None):
+    """Returns the check_fn selecting the modules to checkpoint for the given policy
+
+    full: every LlamaDecoderLayer
+    every_k_layers: every interval-th LlamaDecoderLayer, starting with the first one
+    attention / mlp: only the attention or the MLP block of every layer
+    memory_budget: the LlamaDecoderLayers whose index is in layers_to_checkpoint,
+        see probe_activation_memory and get_layers_to_checkpoint
+    """
+    if policy == "full":
+        return check_fn
+    if policy == "every_k_layers":
+        if interval < 1:
+            raise ValueError(f"activation_checkpointing_interval needs to be >= 1, got {interval}")
+        return lambda submodule: isinstance(submodule, LlamaDecoderLayer) and submodule.self_attn.layer_idx % interval == 0
+    if policy == "attention":
+        return lambda submodule: isinstance(submodule, LlamaAttention)
+    if policy == "mlp":
+        return lambda submodule: isinstance(submodule, LlamaMLP)
+    if policy == "memory_budget":
+        if layers_to_checkpoint is None:
+            raise ValueError("The memory_budget policy needs the layers_to_checkpoint from get_layers_to_checkpoint")
+        layers_to_checkpoint = set(layers_to_checkpoint)
+        return lambda submodule: isinstance(submodule, LlamaDecoderLayer) and submodule.self_attn.layer_idx in layers_to_checkpoint
+    raise ValueError(f"Unknown activation checkpointing policy: {policy}, choose from {ACTIVATION_CHECKPOINTING_POLICIES}")
+
+
+def get_selective_checkpointing_context_fn(save_ops):
+    """Returns a context_fn that keeps the outputs of the given aten ops instead of recomputing them
+
+    save_ops is a comma separated list of aten op names, e.g. "mm,_scaled_dot_product_flash_attention".
+    """
+    try:
+        from torch.utils.checkpoint import create_selective_checkpoint_contexts
+    except ImportError:
+        raise ImportError(
+            "Saving selected ops in activation checkpointing requires PyTorch 2.4 or newer"
+        )
+    ops_to_save = []
+    for name in save_ops.split(","):
+        name = name.strip()
+        if not hasattr(torch.ops.aten, name):
+            raise ValueError(f"Unknown aten op in activation_checkpointing_save_ops: {name}")
+        ops_to_save.append(getattr(torch.ops.aten, name).default)
+    return partial(create_selective_checkpoint_contexts, ops_to_save)
+
+
+def apply_fsdp_checkpointing(model, policy="full", interval=2, layers_to_checkpoint=None, offload=False, save_ops=""):
     """apply activation checkpointing to model
     returns None as model is updated directly
+
+    With offload=True the activations of the selected modules are moved to CPU memory
+    instead of being recomputed in the backward pass.
     """
-    print(f"--> applying fsdp activation checkpointing...")
+    print(f"--> applying fsdp activation checkpointing with the {policy} policy...")
+
+    if offload:
+        wrapper_fn = offload_wrapper
+    elif save_ops:
+        wrapper_fn = partial(non_reentrant_wrapper, context_fn=get_selective_checkpointing_context_fn(save_ops))
+    else:
+        wrapper_fn = non_reentrant_wrapper
 
     apply_activation_checkpointing(
-        model, checkpoint_wrapper_fn=non_reentrant_wrapper, check_fn=check_fn
+        model,
+        checkpoint_wrapper_fn=wrapper_fn,
+        check_fn=get_checkpointing_check_fn(policy, interval, layers_to_checkpoint),
     )
+
+
+def probe_activation_memory(model, batch):
+    """Runs one forward and backward pass and measures the activations every LlamaDecoderLayer keeps for backward
+
+    Returns two dicts mapping the layer index to the bytes of the tensors saved for backward
+    (without the parameters) and to the bytes of the layer input, which is what a checkpointed
+    layer keeps instead. Gradients of the probe step are discarded.
+    """
+    activation_bytes = {}
+    input_bytes = {}
+    current = {}
+
+    def pre_hook(module, args, kwargs):
+        hidden_states = args[0] if args else kwargs["hidden_states"]
+        layer_idx = module.self_attn.layer_idx
+        input_bytes[layer_idx] = hidden_states.nbytes
+        activation_bytes[layer_idx] = 0
+        param_storages = set()
+        for submodule in module.modules():
+            for name in ("weight", "bias"):
+                param = getattr(submodule, name, None)
+                if isinstance(param, torch.Tensor):
+                    param_storages.add(param.untyped_storage().data_ptr())
+        current.update(layer_idx=layer_idx, param_storages=param_storages, seen=set())
+
+    def post_hook(module, args, output):
+        current.clear()
+
+    def pack_hook(tensor):
+        if current:
+            storage = tensor.untyped_storage()
+            ptr = storage.data_ptr()
+            if ptr not in current["param_storages"] and ptr not in current["seen"]:
+                current["seen"].add(ptr)
+                activation_bytes[current["layer_idx"]] += storage.nbytes()
+        return tensor
+
+    handles = []
+    for module in model.modules():
+        if isinstance(module, LlamaDecoderLayer):
+            handles.append(module.register_forward_pre_hook(pre_hook, with_kwargs=True))
+            handles.append(module.register_forward_hook(post_hook))
+
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda tensor: tensor):
+            loss = model(**batch).loss
+        loss.backward()
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.zero_grad(set_to_none=True)
+
+    return activation_bytes, input_bytes
+
+
+def get_layers_to_checkpoint(activation_bytes, input_bytes, budget_bytes):
+    """Picks the layers to checkpoint so that the activations of all layers fit into budget_bytes
+
+    Keeps as many layers as possible without recomputation, spread evenly over the depth of the model,
+    and checkpoints the rest. A checkpointed layer only keeps its input.
+    """
+    layers = sorted(activation_bytes)
+    for num_kept in range(len(layers), -1, -1):
+        kept = {layers[i * len(layers) // num_kept] for i in range(num_kept)} if num_kept else set()
+        usage = sum(activation_bytes[i] if i in kept else input_bytes[i] for i in layers)
+        if usage <= budget_bytes:
+            return [i for i in layers if i not in kept]
+    return layers
@@ -9,7 +9,12 @@
 # the weight updates. This allows full training in BFloat16 (equal or
 # better than FP32 results in many cases) due to high precision weight upates.
 
+from collections import defaultdict
+from functools import lru_cache
+from typing import List, Optional
+
 import torch
+from torch import Tensor
 from torch.optim.optimizer import Optimizer
 
 
@@ -25,6 +30,10 @@ class AnyPrecisionAdamW(Optimizer):
         momentum_dtype=torch.bfloat16,
         variance_dtype=torch.bfloat16,
         compensation_buffer_dtype=torch.bfloat16,
+        foreach: Optional[bool] = None,
+        fused: bool = False,
+        quantize_state: bool = False,
+        block_size: int = 2048,
     ):
         """
         Args:
@@ -45,6 +54,34 @@ class AnyPrecisionAdamW(Optimizer):
                 compensation_buffer_dtype  = dtype for Kahan summation
                                              buffer (default: BFloat16)
 
+                # Implementation
+                foreach = update all parameters of a group with multi-tensor
+                          (torch._foreach_*) kernels, bucketed by device and dtype.
+                          None picks the multi-tensor path when all parameters live
+                          on an accelerator (default: None)
+                fused = run the update through a torch.compile'd kernel that fuses
+                        the elementwise math of one parameter, compiled once with
+                        dynamic shapes for all parameters. The kernel keeps
+                        its intermediates in fp32 and rounds each tensor once
+                        when storing it, where the per-parameter path rounds
+                        after every op. With bf16 parameters or states, one
+                        step from the same state leaves exp_avg and exp_avg_sq
+                        within one ulp of the larger of the old state and the
+                        (squared) gradient, and the weights within one ulp plus
+                        step_size * (|exp_avg difference| + 2**-6 * |exp_avg|)
+                        / denominator. With fp32 everywhere the results agree
+                        to fp32 rounding (default: False)
+
+                # 8-bit state
+                quantize_state = keep momentum and variance as blockwise quantized
+                                 uint8 codes with one fp32 absmax per block, using a
+                                 signed dynamic map for the momentum and an unsigned
+                                 one for the variance. Parameters smaller than one
+                                 block keep momentum_dtype/variance_dtype states.
+                                 Quantized parameters always take the per-parameter
+                                 update path (default: False)
+                block_size = number of elements sharing one scale (default: 2048)
+
                 # Usage
                 This optimizer implements optimizer states, and Kahan summation
                 for high precision updates, all in user controlled dtypes.
@@ -55,6 +92,10 @@ class AnyPrecisionAdamW(Optimizer):
                 Setting to use_kahan_summation = False, and changing momentum and
                 variance dtypes to FP32, reverts this to a standard AdamW optimizer.
 
+                The per-parameter, foreach and fused implementations share the same
+                optimizer state layout, so checkpoints can be moved between them.
+                Quantized states add an exp_avg_absmax and exp_avg_sq_absmax entry.
+
         """
         defaults = dict(
             lr=lr,
@@ -65,10 +106,22 @@ class AnyPrecisionAdamW(Optimizer):
             momentum_dtype=momentum_dtype,
             variance_dtype=variance_dtype,
             compensation_buffer_dtype=compensation_buffer_dtype,
+            foreach=foreach,
+            fused=fused,
+            quantize_state=quantize_state,
+            block_size=block_size,
         )
 
         super().__init__(params, defaults)
 
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        for group in self.param_groups:
+            group.setdefault("foreach", None)
+            group.setdefault("fused", False)
+            group.setdefault("quantize_state", False)
+            group.setdefault("block_size", 2048)
+
     @torch.no_grad()
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -85,14 +138,20 @@ class AnyPrecisionAdamW(Optimizer):
         for group in self.param_groups:
 
             beta1, beta2 = group["betas"]
-            lr = group["lr"]
-            weight_decay = group["weight_decay"]
-            eps = group["eps"]
             use_kahan_summation = group["use_kahan_summation"]
 
             momentum_dtype = group["momentum_dtype"]
             variance_dtype = group["variance_dtype"]
             compensation_buffer_dtype = group["compensation_buffer_dtype"]
+            block_size = group["block_size"]
+
+            params = []
+            grads = []
+            exp_avgs = []
+            exp_avg_sqs = []
+            compensations = []
+            steps = []
+            quantized_params = []
 
             for p in group["params"]:
                 if p.grad is None:
@@ -110,17 +169,29 @@ class AnyPrecisionAdamW(Optimizer):
 
                     state["step"] = torch.tensor(0.0)
 
-                    # momentum - EMA of gradient values
-                    state["exp_avg"] = torch.zeros_like(
-                        p,
-                        dtype=momentum_dtype,
-                    )
+                    if group["quantize_state"] and p.numel() >= block_size:
+                        # 8-bit codes, a zero absmax dequantizes to zeros
+                        num_blocks = (p.numel() + block_size - 1) // block_size
+                        state["exp_avg"] = torch.zeros_like(p, dtype=torch.uint8)
+                        state["exp_avg_absmax"] = torch.zeros(
+                            num_blocks, dtype=torch.float32, device=p.device
+                        )
+                        state["exp_avg_sq"] = torch.zeros_like(p, dtype=torch.uint8)
+                        state["exp_avg_sq_absmax"] = torch.zeros(
+                            num_blocks, dtype=torch.float32, device=p.device
+                        )
+                    else:
+                        # momentum - EMA of gradient values
+                        state["exp_avg"] = torch.zeros_like(
+                            p,
+                            dtype=momentum_dtype,
+                        )
 
-                    # variance uncentered - EMA of squared gradient values
-                    state["exp_avg_sq"] = torch.zeros_like(
-                        p,
-                        dtype=variance_dtype,
-                    )
+                        # variance uncentered - EMA of squared gradient values
+                        state["exp_avg_sq"] = torch.zeros_like(
+                            p,
+                            dtype=variance_dtype,
+                        )
 
                     # optional Kahan summation - accumulated error tracker
                     if use_kahan_summation:
@@ -129,51 +200,389 @@ class AnyPrecisionAdamW(Optimizer):
                             dtype=compensation_buffer_dtype,
                         )
 
-                # main processing -------------------------
-
-                # update the steps for each param group update
-                state["step"] += 1
-                step = state["step"]
-
-                exp_avg = state["exp_avg"]
-                exp_avg_sq = state["exp_avg_sq"]
-
-                grad = p.grad
-
-                # weight decay, AdamW style
-                if weight_decay:
-                    p.data.mul_(1 - lr * weight_decay)
-
-                # update momentum
-                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
-
-                # update uncentered variance
-                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
-
-                # adjust using bias1
-                bias_correction1 = 1 - beta1**step
-
-                step_size = lr / bias_correction1
-
-                # adjust using bias2
-                denom_correction = (1 - beta2**step) ** 0.5  # avoids math import
-
-                centered_variance = (exp_avg_sq.sqrt() / denom_correction).add_(
-                    eps, alpha=1
-                )
+                if "exp_avg_absmax" in state:
+                    quantized_params.append(p)
+                    continue
 
-                # lr update to compensation
+                params.append(p)
+                grads.append(p.grad)
+                exp_avgs.append(state["exp_avg"])
+                exp_avg_sqs.append(state["exp_avg_sq"])
                 if use_kahan_summation:
-                    compensation = state["compensation"]
+                    compensations.append(state["compensation"])
+                steps.append(state["step"])
+
+            if quantized_params:
+                _quantized_anyprecision_adamw(
+                    quantized_params,
+                    [self.state[p] for p in quantized_params],
+                    beta1=beta1,
+                    beta2=beta2,
+                    lr=group["lr"],
+                    weight_decay=group["weight_decay"],
+                    eps=group["eps"],
+                    use_kahan_summation=use_kahan_summation,
+                    block_size=block_size,
+                )
 
-                    compensation.addcdiv_(exp_avg, centered_variance, value=-step_size)
+            if not params:
+                continue
+
+            foreach = group["foreach"]
+            if foreach is None:
+                foreach = all(p.device.type != "cpu" for p in params)
+
+            if group["fused"]:
+                func = _fused_anyprecision_adamw
+            elif foreach:
+                func = _multi_tensor_anyprecision_adamw
+            else:
+                func = _single_tensor_anyprecision_adamw
+
+            func(
+                params,
+                grads,
+                exp_avgs,
+                exp_avg_sqs,
+                compensations,
+                steps,
+                beta1=beta1,
+                beta2=beta2,
+                lr=group["lr"],
+                weight_decay=group["weight_decay"],
+                eps=group["eps"],
+                use_kahan_summation=use_kahan_summation,
+            )
+
+
+def _single_tensor_anyprecision_adamw(
+    params: List[Tensor],
+    grads: List[Tensor],
+    exp_avgs: List[Tensor],
+    exp_avg_sqs: List[Tensor],
+    compensations: List[Tensor],
+    steps: List[Tensor],
+    *,
+    beta1: float,
+    beta2: float,
+    lr: float,
+    weight_decay: float,
+    eps: float,
+    use_kahan_summation: bool,
+):
+    for i, p in enumerate(params):
+        # main processing -------------------------
+
+        # update the steps for each param group update
+        steps[i] += 1
+        step = steps[i]
+
+        exp_avg = exp_avgs[i]
+        exp_avg_sq = exp_avg_sqs[i]
+
+        grad = grads[i]
+
+        # weight decay, AdamW style
+        if weight_decay:
+            p.data.mul_(1 - lr * weight_decay)
+
+        # update momentum
+        exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+
+        # update uncentered variance
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+
+        # adjust using bias1
+        bias_correction1 = 1 - beta1**step
+
+        step_size = lr / bias_correction1
+
+        # adjust using bias2
+        denom_correction = (1 - beta2**step) ** 0.5  # avoids math import
+
+        centered_variance = (exp_avg_sq.sqrt() / denom_correction).add_(
+            eps, alpha=1
+        )
 
-                    # update weights with compensation (Kahan summation)
-                    # save error back to compensation for next iteration
-                    temp_buffer = p.detach().clone()
-                    p.data.add_(compensation)
-                    compensation.add_(temp_buffer.sub_(p.data))
+        # lr update to compensation
+        if use_kahan_summation:
+            compensation = compensations[i]
+
+            compensation.addcdiv_(exp_avg, centered_variance, value=-step_size)
+
+            # update weights with compensation (Kahan summation)
+            # save error back to compensation for next iteration
+            temp_buffer = p.detach().clone()
+            p.data.add_(compensation)
+            compensation.add_(temp_buffer.sub_(p.data))
+
+        else:
+            # usual AdamW updates
+            p.data.addcdiv_(exp_avg, centered_variance, value=-step_size)
+
+
+def _bias_corrections(steps: List[Tensor], beta1: float, beta2: float, lr: float):
+    """Computes the per-parameter step sizes and denominator corrections.
+
+    The math runs on the (CPU, float32) step tensors exactly like the per-parameter
+    path does, so every implementation ends up with bit-identical scalars.
+    """
+    step = torch.stack(steps)
+    step_sizes = (-(lr / (1 - beta1**step))).tolist()
+    denom_corrections = ((1 - beta2**step) ** 0.5).tolist()
+    return step_sizes, denom_corrections
+
+
+def _group_by_device_and_dtype(params, grads, exp_avgs, exp_avg_sqs, compensations, steps):
+    grouped = defaultdict(lambda: ([], [], [], [], [], []))
+    for i, p in enumerate(params):
+        bucket = grouped[(p.device, p.dtype)]
+        bucket[0].append(p)
+        bucket[1].append(grads[i])
+        bucket[2].append(exp_avgs[i])
+        bucket[3].append(exp_avg_sqs[i])
+        if compensations:
+            bucket[4].append(compensations[i])
+        bucket[5].append(steps[i])
+    return grouped.values()
+
+
+def _multi_tensor_anyprecision_adamw(
+    params: List[Tensor],
+    grads: List[Tensor],
+    exp_avgs: List[Tensor],
+    exp_avg_sqs: List[Tensor],
+    compensations: List[Tensor],
+    steps: List[Tensor],
+    *,
+    beta1: float,
+    beta2: float,
+    lr: float,
+    weight_decay: float,
+    eps: float,
+    use_kahan_summation: bool,
+):
+    for (
+        device_params,
+        device_grads,
+        device_exp_avgs,
+        device_exp_avg_sqs,
+        device_compensations,
+        device_steps,
+    ) in _group_by_device_and_dtype(params, grads, exp_avgs, exp_avg_sqs, compensations, steps):
+        torch._foreach_add_(device_steps, 1)
+        step_sizes, denom_corrections = _bias_corrections(device_steps, beta1, beta2, lr)
+
+        # The scalar overload of _foreach_mul_ rounds the factor to the dtype of the tensors,
+        # 0.9 becomes 0.8984375 in bf16. An fp32 tensor keeps the factor of the per-parameter path.
+        device = device_params[0].device
+        if weight_decay:
+            torch._foreach_mul_(device_params, torch.tensor(1 - lr * weight_decay, device=device))
+
+        torch._foreach_mul_(device_exp_avgs, torch.tensor(beta1, device=device))
+        torch._foreach_add_(device_exp_avgs, device_grads, alpha=1 - beta1)
+
+        torch._foreach_mul_(device_exp_avg_sqs, torch.tensor(beta2, device=device))
+        torch._foreach_addcmul_(device_exp_avg_sqs, device_grads, device_grads, value=1 - beta2)
+
+        centered_variances = torch._foreach_sqrt(device_exp_avg_sqs)
+        torch._foreach_div_(centered_variances, denom_corrections)
+        torch._foreach_add_(centered_variances, eps)
+
+        if use_kahan_summation:
+            torch._foreach_addcdiv_(device_compensations, device_exp_avgs, centered_variances, step_sizes)
+
+            # The denominators are dead at this point, reuse them as scratch space for the
+            # previous weights when their dtype matches the parameters.
+            if centered_variances[0].dtype == device_params[0].dtype:
+                temp_buffers = centered_variances
+            else:
+                temp_buffers = [torch.empty_like(p) for p in device_params]
+            del centered_variances
+
+            torch._foreach_copy_(temp_buffers, device_params)
+            torch._foreach_add_(device_params, device_compensations)
+            torch._foreach_sub_(temp_buffers, device_params)
+            torch._foreach_add_(device_compensations, temp_buffers)
+        else:
+            torch._foreach_addcdiv_(device_params, device_exp_avgs, centered_variances, step_sizes)
+
+
+def _fused_update(
+    p: Tensor,
+    grad: Tensor,
+    exp_avg: Tensor,
+    exp_avg_sq: Tensor,
+    compensation: Optional[Tensor],
+    step_size: Tensor,
+    denom_correction: Tensor,
+    decay: Tensor,
+    beta1: float,
+    beta2: float,
+    eps: float,
+):
+    p.mul_(decay)
+    exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+    exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+    centered_variance = exp_avg_sq.sqrt() / denom_correction + eps
+    if compensation is not None:
+        # The Kahan summation into the weights runs eagerly after this kernel, inductor
+        # would compute the rounding error from the unrounded fp32 sum and lose it.
+        compensation.addcdiv_(exp_avg, centered_variance, value=step_size)
+    else:
+        p.addcdiv_(exp_avg, centered_variance, value=step_size)
+
+
+def _flat_view(t: Tensor) -> Tensor:
+    # non contiguous tensors can not be flattened without a copy, they keep their shape
+    return t.detach().view(-1) if t.is_contiguous() else t.detach()
+
+
+_compiled_fused_update = None
+
+
+def _fused_anyprecision_adamw(
+    params: List[Tensor],
+    grads: List[Tensor],
+    exp_avgs: List[Tensor],
+    exp_avg_sqs: List[Tensor],
+    compensations: List[Tensor],
+    steps: List[Tensor],
+    *,
+    beta1: float,
+    beta2: float,
+    lr: float,
+    weight_decay: float,
+    eps: float,
+    use_kahan_summation: bool,
+):
+    global _compiled_fused_update
+    if _compiled_fused_update is None:
+        # One kernel per parameter, compiled with dynamic shapes so that all parameters
+        # of the same dtypes share a graph. Compiling over the parameter list would
+        # unroll the update of every parameter into a graph as large as the model.
+        _compiled_fused_update = torch.compile(_fused_update, dynamic=True)
+
+    for (
+        device_params,
+        device_grads,
+        device_exp_avgs,
+        device_exp_avg_sqs,
+        device_compensations,
+        device_steps,
+    ) in _group_by_device_and_dtype(params, grads, exp_avgs, exp_avg_sqs, compensations, steps):
+        torch._foreach_add_(device_steps, 1)
+        step_sizes, denom_corrections = _bias_corrections(device_steps, beta1, beta2, lr)
+
+        # Step and learning rate dependent scalars are passed as device tensors so the
+        # compiled graph is reused across steps instead of being specialized on every new value.
+        device = device_params[0].device
+        step_sizes = torch.tensor(step_sizes, device=device).unbind()
+        denom_corrections = torch.tensor(denom_corrections, device=device).unbind()
+        decay = torch.tensor(1 - lr * weight_decay, device=device)
+
+        # Flat views keep one graph for parameters of any rank, and dynamo would treat
+        # the shapes of nn.Parameter inputs as static.
+        for i, p in enumerate(device_params):
+            _compiled_fused_update(
+                _flat_view(p),
+                _flat_view(device_grads[i]),
+                _flat_view(device_exp_avgs[i]),
+                _flat_view(device_exp_avg_sqs[i]),
+                _flat_view(device_compensations[i]) if use_kahan_summation else None,
+                step_sizes[i],
+                denom_corrections[i],
+                decay,
+                beta1,
+                beta2,
+                eps,
+            )
+
+        if use_kahan_summation:
+            temp_buffers = [torch.empty_like(p) for p in device_params]
+            torch._foreach_copy_(temp_buffers, device_params)
+            torch._foreach_add_(device_params, device_compensations)
+            torch._foreach_sub_(temp_buffers, device_params)
+            torch._foreach_add_(device_compensations, temp_buffers)
+
+
+@lru_cache(maxsize=None)
+def _dynamic_map(signed: bool, device: torch.device) -> Tensor:
+    """Builds the 256 entry dynamic exponent code book used for 8-bit states.
+
+    Each of the 7 exponent levels 1e-6 .. 1 gets twice as many linearly spaced
+    fractions as the previous one, which keeps the relative error roughly constant
+    over six orders of magnitude. The unsigned map spends the sign bit on extra
+    fractions, which suits the always positive variance.
+    """
+    max_exponent_bits = 7
+    data = [0.0, 1.0]
+    for i in range(max_exponent_bits):
+        fraction_items = 2**i + 1 if signed else 2 ** (i + 1) + 1
+        boundaries = torch.linspace(0.1, 1, fraction_items, dtype=torch.float64)
+        means = (boundaries[:-1] + boundaries[1:]) / 2.0
+        scale = 10 ** (-(max_exponent_bits - 1) + i)
+        data += (scale * means).tolist()
+        if signed:
+            data += (-scale * means).tolist()
+    assert len(data) == 256
+    return torch.tensor(sorted(data), dtype=torch.float32, device=device)
+
+
+def _dequantize_blockwise(codes: Tensor, absmax: Tensor, code_book: Tensor, block_size: int) -> Tensor:
+    values = code_book[codes.flatten().long()]
+    padding = absmax.numel() * block_size - values.numel()
+    values = torch.nn.functional.pad(values, (0, padding)).view(-1, block_size)
+    values.mul_(absmax.unsqueeze(1))
+    return values.flatten()[: codes.numel()].view_as(codes)
+
+
+def _quantize_blockwise(values: Tensor, codes: Tensor, absmax: Tensor, code_book: Tensor, block_size: int):
+    flat = values.flatten()
+    padding = absmax.numel() * block_size - flat.numel()
+    blocks = torch.nn.functional.pad(flat, (0, padding)).view(-1, block_size)
+    torch.amax(blocks.abs(), dim=1, out=absmax)
+    normalized = blocks / absmax.clamp(min=torch.finfo(absmax.dtype).tiny).unsqueeze(1)
+    # round to the nearest code by searching the midpoints between neighbouring codes
+    midpoints = (code_book[1:] + code_book[:-1]) / 2
+    indices = torch.bucketize(normalized.flatten()[: codes.numel()], midpoints)
+    codes.copy_(indices.view_as(codes))
+
+
+def _quantized_anyprecision_adamw(
+    params: List[Tensor],
+    states: List[dict],
+    *,
+    beta1: float,
+    beta2: float,
+    lr: float,
+    weight_decay: float,
+    eps: float,
+    use_kahan_summation: bool,
+    block_size: int,
+):
+    for p, state in zip(params, states):
+        signed_map = _dynamic_map(True, p.device)
+        unsigned_map = _dynamic_map(False, p.device)
+
+        # only one parameter's states are materialized in fp32 at a time
+        exp_avg = _dequantize_blockwise(state["exp_avg"], state["exp_avg_absmax"], signed_map, block_size)
+        exp_avg_sq = _dequantize_blockwise(state["exp_avg_sq"], state["exp_avg_sq_absmax"], unsigned_map, block_size)
+
+        _single_tensor_anyprecision_adamw(
+            [p],
+            [p.grad],
+            [exp_avg],
+            [exp_avg_sq],
+            [state["compensation"]] if use_kahan_summation else [],
+            [state["step"]],
+            beta1=beta1,
+            beta2=beta2,
+            lr=lr,
+            weight_decay=weight_decay,
+            eps=eps,
+            use_kahan_summation=use_kahan_summation,
+        )
 
-                else:
-                    # usual AdamW updates
-                    p.data.addcdiv_(exp_avg, centered_variance, value=-step_size)
\ No newline at end of file
+        _quantize_blockwise(exp_avg, state["exp_avg"], state["exp_avg_absmax"], signed_map, block_size)
+        _quantize_blockwise(exp_avg_sq, state["exp_avg_sq"], state["exp_avg_sq_absmax"], unsigned_map, block_size)
@@ -0,0 +1,28 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import ActivationWrapper
+from transformers.models.llama.modeling_llama import LlamaDecoderLayer
+
+
+def apply_regional_compile(model, mode="default", dynamic=None, backend="inductor"):
+    """compile every LlamaDecoderLayer of the model in place
+    returns None as model is updated directly
+
+    Compiling the repeated layers instead of the whole model keeps the compile time
+    bounded for deep models and leaves the FSDP and PEFT wrappers untouched, so it is
+    applied after them. Layers wrapped for activation checkpointing are compiled
+    together with their wrapper, the recomputation in backward can not re-enter a
+    compiled region.
+    """
+    print(f"--> compiling decoder layers with mode={mode}, dynamic={dynamic}, backend={backend}...")
+
+    wrapped_layers = set()
+    for module in model.modules():
+        if isinstance(module, ActivationWrapper) and isinstance(module._checkpoint_wrapped_module, LlamaDecoderLayer):
+            module.compile(mode=mode, dynamic=dynamic, backend=backend)
+            wrapped_layers.add(module._checkpoint_wrapped_module)
+
+    for module in model.modules():
+        if isinstance(module, LlamaDecoderLayer) and module not in wrapped_layers:
+            module.compile(mode=mode, dynamic=dynamic, backend=backend)
@@ -0,0 +1,77 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+# OptimizerInBackward: runs the optimizer update of every parameter as soon as its
+# gradient is ready during the backward pass and frees the gradient right after.
+# Only one gradient (or one FSDP unit's gradient shards) is alive at a time instead
+# of the gradients of the whole model, which leaves room for larger micro batches
+# or longer context lengths.
+
+from torch.distributed.optim import _apply_optimizer_in_backward
+from torch.optim.optimizer import Optimizer
+
+
+class OptimizerInBackward(Optimizer):
+    def __init__(self, params, optimizer_class, register_hook=True, **optimizer_kwargs):
+        """
+        Args:
+                params (iterable): iterable of parameters to optimize, parameters that
+                    do not require gradients are skipped
+                optimizer_class (Type[Optimizer]): optimizer that is instantiated for
+                    every parameter, e.g. torch.optim.AdamW or AnyPrecisionAdamW
+                register_hook (bool): register a post accumulate grad hook on every
+                    parameter that runs its update. Set to False when the model is
+                    wrapped with FSDP(use_orig_params=True), which steps the
+                    optimizers itself after the reduce-scatter (default: True)
+                optimizer_kwargs: passed to optimizer_class
+
+                # Usage
+                The wrapper is a drop in replacement for the optimizer in the training
+                loop: step() and zero_grad() are no-ops as the updates already happened
+                in backward. The per-parameter optimizers share their param groups and
+                state with this wrapper, so lr schedulers, state_dict() and FSDP optimizer
+                state dict utilities see all of them.
+
+                Gradient accumulation, gradient clipping and gradient scaling need the
+                full gradients before the update and are not supported.
+        """
+        params = [p for p in params if p.requires_grad]
+        super().__init__(params, optimizer_kwargs)
+
+        _apply_optimizer_in_backward(
+            optimizer_class,
+            params,
+            optimizer_kwargs,
+            register_hook=register_hook,
+        )
+
+        self.optimizers = [p._in_backward_optimizers[-1] for p in params]
+        self.param_groups = [
+            group for optimizer in self.optimizers for group in optimizer.param_groups
+        ]
+        self._share_state()
+
+    def _share_state(self):
+        for optimizer in self.optimizers:
+            optimizer.state = self.state
+
+    def load_state_dict(self, state_dict):
+        param_groups = self.param_groups
+        super().load_state_dict(state_dict)
+        # loading replaces the param groups and state, write them back into the
+        # groups shared with the per-parameter optimizers
+        for group, loaded_group in zip(param_groups, self.param_groups):
+            group.update(loaded_group)
+        self.param_groups = param_groups
+        self._share_state()
+
+    def step(self, closure=None):
+        """The updates already ran during backward, only evaluates the closure."""
+        loss = None
+        if closure is not None:
+            loss = closure()
+        return loss
+
+    def zero_grad(self, set_to_none=True):
+        """Gradients are released right after each update during backward."""
+        pass
@@ -3,7 +3,7 @@
 
 import functools
 
-from transformers.models.llama.modeling_llama import LlamaDecoderLayer
+from transformers.models.llama.modeling_llama import LlamaAttention, LlamaDecoderLayer, LlamaMLP
 from torch.distributed.fsdp.wrap import (
     transformer_auto_wrap_policy,
     size_based_auto_wrap_policy,
@@ -17,17 +17,25 @@ def get_size_policy(min_params=1e8):
     return num_wrap_policy
 
 
-def get_llama_wrapper():
+def get_llama_wrapper(granularity="layer"):
     """we register our main layer class and use the fsdp transformer wrapping policy
     ensures embedding layers are in the root fsdp unit for shared access and that fsdp units map to transformer layers
+
+    granularity="block" additionally puts the attention and the MLP of every layer into their own fsdp units,
+    which trades more and smaller all-gathers for lower peak memory and more overlap
     """
     # ====   use new transformer wrapper
 
+    if granularity == "layer":
+        transformer_layer_cls = {LlamaDecoderLayer}
+    elif granularity == "block":
+        transformer_layer_cls = {LlamaDecoderLayer, LlamaAttention, LlamaMLP}
+    else:
+        raise ValueError(f"Unknown wrapping granularity: {granularity}, choose from layer or block")
+
     llama_auto_wrap_policy = functools.partial(
         transformer_auto_wrap_policy,
-        transformer_layer_cls={
-            LlamaDecoderLayer,
-        },
+        transformer_layer_cls=transformer_layer_cls,
     )
 
     return llama_auto_wrap_policy
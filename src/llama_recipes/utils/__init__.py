@@ -1,7 +1,44 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
-from llama_recipes.utils.memory_utils import MemoryTrace
-from llama_recipes.utils.dataset_utils import *
-from llama_recipes.utils.fsdp_utils import fsdp_auto_wrap_policy, hsdp_device_mesh
-from llama_recipes.utils.train_utils import *
\ No newline at end of file
+import importlib
+
+_LAZY_IMPORTS = {
+    "MemoryTrace": "llama_recipes.utils.memory_utils",
+    "load_module_from_py_file": "llama_recipes.utils.dataset_utils",
+    "get_custom_dataset": "llama_recipes.utils.dataset_utils",
+    "DATASET_PREPROC": "llama_recipes.utils.dataset_utils",
+    "get_preprocessed_dataset": "llama_recipes.utils.dataset_utils",
+    "fsdp_auto_wrap_policy": "llama_recipes.utils.fsdp_utils",
+    "hsdp_device_mesh": "llama_recipes.utils.fsdp_utils",
+    "set_tokenizer_params": "llama_recipes.utils.train_utils",
+    "byte2mb": "llama_recipes.utils.train_utils",
+    "train": "llama_recipes.utils.train_utils",
+    "evaluation": "llama_recipes.utils.train_utils",
+    "freeze_transformer_layers": "llama_recipes.utils.train_utils",
+    "check_frozen_layers_peft_model": "llama_recipes.utils.train_utils",
+    "setup": "llama_recipes.utils.train_utils",
+    "setup_environ_flags": "llama_recipes.utils.train_utils",
+    "cleanup": "llama_recipes.utils.train_utils",
+    "clear_gpu_cache": "llama_recipes.utils.train_utils",
+    "get_parameter_dtypes": "llama_recipes.utils.train_utils",
+    "print_model_size": "llama_recipes.utils.train_utils",
+    "get_policies": "llama_recipes.utils.train_utils",
+    "save_train_params": "llama_recipes.utils.train_utils",
+    "save_to_json": "llama_recipes.utils.train_utils",
+}
+
+__all__ = list(_LAZY_IMPORTS)
+
+
+def __getattr__(name):
+    # the submodules pull in torch.distributed, transformers and accelerate, import them on first use only
+    if name in _LAZY_IMPORTS:
+        value = getattr(importlib.import_module(_LAZY_IMPORTS[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
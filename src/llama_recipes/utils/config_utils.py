@@ -1,46 +1,265 @@
 # Copyright (c) Meta Platforms, Inc. and affiliates.
 # This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
 
-import inspect
+import dataclasses
+import difflib
+import enum
+import hashlib
+import json
+import math
+import os
+import typing
+import warnings
 from dataclasses import asdict
+from functools import lru_cache
+from typing import Any, Dict, Tuple
 
 import torch.distributed as dist
-from torch.utils.data import DistributedSampler
-from peft import (
-    LoraConfig,
-    AdaptionPromptConfig,
-    PrefixTuningConfig,
-)
-from transformers import default_data_collator
-from transformers.data import DataCollatorForSeq2Seq
-
-from llama_recipes.configs import datasets, lora_config, llama_adapter_config, prefix_config, train_config
+from torch.utils.data import DistributedSampler, IterableDataset
+
+from llama_recipes.configs import datasets, fsdp_config, lora_config, llama_adapter_config, prefix_config, train_config, wandb_config
 from llama_recipes.data.sampler import LengthBasedBatchSampler, DistributedLengthBasedBatchSampler
 from llama_recipes.utils.dataset_utils import DATASET_PREPROC
 
 
-def update_config(config, **kwargs):
-    if isinstance(config, (tuple, list)):
-        for c in config:
-            update_config(c, **kwargs)
+_TRUE_STRINGS = ("true", "1", "yes", "on")
+_FALSE_STRINGS = ("false", "0", "no", "off")
+
+
+@lru_cache(maxsize=None)
+def get_config_fields(config_type) -> Dict[str, Any]:
+    """
+    Returns the field names of a config dataclass mapped to their annotated types, computed once per config type
+
+    Raises a TypeError for class attributes without annotation, they are no dataclass fields and could not be overridden.
+    """
+    fields = {f.name: f.type for f in dataclasses.fields(config_type)}
+    unannotated = [
+        name for name, value in vars(config_type).items()
+        if not name.startswith("_") and name not in fields and not callable(value) and not isinstance(value, (classmethod, staticmethod, property))
+    ]
+    if unannotated:
+        raise TypeError(f"{config_type.__name__} has attributes without type annotation: {unannotated}")
+    return fields
+
+
+@lru_cache(maxsize=None)
+def get_dataset_configs() -> Dict[str, type]:
+    return {name: c for name, c in vars(datasets).items() if isinstance(c, type) and dataclasses.is_dataclass(c)}
+
+
+@lru_cache(maxsize=None)
+def get_known_parameters() -> Tuple[frozenset, frozenset]:
+    """
+    Returns the names of all known config classes and of all their fields, used to report typos in overrides
+    """
+    config_types = (train_config, fsdp_config, lora_config, llama_adapter_config, prefix_config, wandb_config)
+    config_types += tuple(get_dataset_configs().values())
+    config_names = frozenset(c.__name__ for c in config_types)
+    param_names = frozenset(name for c in config_types for name in get_config_fields(c))
+    return config_names, param_names
+
+
+def coerce_value(value, field_type, name="value"):
+    """
+    Converts value to the annotated type of a config field, e.g. "true" to True or "FULL_SHARD" to ShardingStrategy.FULL_SHARD
+
+    Raises a ValueError if value can not be converted.
+    """
+    if value is None or field_type is Any:
+        return value
+
+    origin = typing.get_origin(field_type)
+    if origin is typing.Union:
+        types = [t for t in typing.get_args(field_type) if t is not type(None)]
+        for t in types:
+            try:
+                return coerce_value(value, t, name)
+            except ValueError:
+                pass
+        raise ValueError(f"Invalid value {value!r} for {name}: expected {field_type}")
+    if origin in (list, tuple):
+        if isinstance(value, str):
+            value = [v.strip() for v in value.split(",") if v.strip()]
+        if not isinstance(value, (list, tuple)):
+            raise ValueError(f"Invalid value {value!r} for {name}: expected {field_type}")
+        args = typing.get_args(field_type)
+        item_type = args[0] if args else Any
+        return origin(coerce_value(v, item_type, name) for v in value)
+
+    if not isinstance(field_type, type):
+        return value
+    if isinstance(value, field_type) and not (field_type is int and isinstance(value, bool)):
+        return value
+    if issubclass(field_type, enum.Enum):
+        if isinstance(value, str) and value in field_type.__members__:
+            return field_type[value]
+        raise ValueError(f"Invalid value {value!r} for {name}: expected one of {list(field_type.__members__)}")
+    if field_type is bool:
+        if isinstance(value, str) and value.lower() in _TRUE_STRINGS + _FALSE_STRINGS:
+            return value.lower() in _TRUE_STRINGS
+        if isinstance(value, int) and value in (0, 1):
+            return bool(value)
+    elif field_type is int:
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        if isinstance(value, str):
+            try:
+                return int(value)
+            except ValueError:
+                pass
+    elif field_type is float:
+        if isinstance(value, int) and not isinstance(value, bool):
+            return float(value)
+        if isinstance(value, str):
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    elif field_type is str:
+        if isinstance(value, (int, float)):
+            return str(value)
+    else:
+        return value
+    raise ValueError(f"Invalid value {value!r} for {name}: expected {field_type.__name__}")
+
+
+def _warn_unknown_parameter(k):
+    config_names, param_names = get_known_parameters()
+    if "." in k:
+        config_name, param_name = k.split(".", 1)
+        if config_name in config_names:
+            return
+        candidates, name = config_names, config_name
     else:
+        candidates, name = param_names, k
+    suggestion = difflib.get_close_matches(name, candidates, n=1)
+    hint = f", did you mean {suggestion[0]}?" if suggestion else ""
+    # the same kwargs are applied to several configs, the default warnings filter reports every parameter once
+    warnings.warn(f"Unknown parameter {k}{hint}", stacklevel=3)
+
+
+def update_config(config, **kwargs):
+    """
+    Sets the fields of one config or a tuple of configs from kwargs, `some_config.some_param` only sets the field of some_config
+
+    The kwargs are shared by all configs, so a config ignores the fields of the others.
+    Parameters no config accepts are reported with a warning.
+    """
+    configs = config if isinstance(config, (tuple, list)) else (config,)
+    for c in configs:
+        config_name = type(c).__name__
+        fields = get_config_fields(type(c))
         for k, v in kwargs.items():
-            if hasattr(config, k):
-                setattr(config, k, v)
+            if k in fields:
+                setattr(c, k, coerce_value(v, fields[k], f"{config_name}.{k}"))
             elif "." in k:
                 # allow --some_config.some_param=True
-                config_name, param_name = k.split(".")
-                if type(config).__name__ == config_name:
-                    if hasattr(config, param_name):
-                        setattr(config, param_name, v)
-                    else:
-                        # In case of specialized config we can warm user
-                        print(f"Warning: {config_name} does not accept parameter: {k}")
-            elif isinstance(config, train_config):
-                print(f"Warning: unknown parameter {k}")
+                prefix, param_name = k.split(".", 1)
+                if prefix == config_name:
+                    if param_name not in fields:
+                        raise ValueError(f"{config_name} does not accept parameter: {k}")
+                    setattr(c, param_name, coerce_value(v, fields[param_name], k))
+
+    config_names, param_names = get_known_parameters()
+    for k in kwargs:
+        known = k.split(".", 1)[0] in config_names if "." in k else k in param_names
+        if not known:
+            _warn_unknown_parameter(k)
+
+
+def load_config_file(path: str) -> Dict[str, Any]:
+    """
+    Loads a YAML or JSON config file as flat overrides for update_config.
+
+    Sections named after a config, e.g. `fsdp_config: {pure_bf16: true}`, become `fsdp_config.pure_bf16` overrides,
+    all other keys are applied to every config that has the field.
+    """
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+
+            values = yaml.safe_load(f) or {}
+        elif path.endswith(".json"):
+            values = json.load(f)
+        else:
+            raise ValueError(f"Config file {path} is not a .yaml, .yml or .json file.")
+    if not isinstance(values, dict):
+        raise ValueError(f"Config file {path} does not contain a mapping of parameters.")
+
+    overrides = {}
+    for k, v in values.items():
+        if isinstance(v, dict):
+            overrides.update({f"{k}.{param_name}": param_value for param_name, param_value in v.items()})
+        else:
+            overrides[k] = v
+    return overrides
+
+
+def load_config_files(kwargs) -> Dict[str, Any]:
+    """
+    Layers the files given in kwargs["config_file"] below the remaining kwargs.
+
+    Several files can be passed as a list or comma separated, later files override earlier ones and
+    command line parameters override all files.
+    """
+    kwargs = dict(kwargs)
+    config_files = kwargs.pop("config_file", None)
+    if not config_files:
+        return kwargs
+    if isinstance(config_files, str):
+        config_files = config_files.split(",")
+
+    merged = {}
+    for path in config_files:
+        path = os.path.expanduser(path.strip())
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"Config file {path} does not exist or is not a file.")
+        merged.update(load_config_file(path))
+    merged.update(kwargs)
+    return merged
+
+
+def _to_hashable(value):
+    if dataclasses.is_dataclass(value):
+        return tuple((name, _to_hashable(getattr(value, name))) for name in get_config_fields(type(value)))
+    if isinstance(value, enum.Enum):
+        return value.name
+    if isinstance(value, (list, tuple)):
+        return tuple(_to_hashable(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _to_hashable(v)) for k, v in value.items()))
+    return value
+
+
+@dataclasses.dataclass(frozen=True)
+class ResolvedConfig:
+    """
+    A frozen snapshot of the resolved configs, its hash is stable across runs and can key caches of derived artifacts
+    """
+    configs: Tuple[Tuple[str, Tuple[Tuple[str, Any], ...]], ...]
+
+    def __getitem__(self, config_name) -> Dict[str, Any]:
+        for name, values in self.configs:
+            if name == config_name:
+                return dict(values)
+        raise KeyError(config_name)
+
+    @property
+    def hash(self) -> str:
+        return hashlib.sha256(json.dumps(self.configs, default=str).encode()).hexdigest()
+
+
+def resolve_config(*configs) -> ResolvedConfig:
+    return ResolvedConfig(tuple(
+        (type(c).__name__, tuple((name, _to_hashable(getattr(c, name))) for name in get_config_fields(type(c))))
+        for c in configs
+    ))
 
 
 def generate_peft_config(train_config, kwargs):
+    from peft import LoraConfig, AdaptionPromptConfig, PrefixTuningConfig
+
     configs = (lora_config, llama_adapter_config, prefix_config)
     peft_configs = (LoraConfig, AdaptionPromptConfig, PrefixTuningConfig)
     names = tuple(c.__name__.rstrip("_config") for c in configs)
@@ -61,16 +280,30 @@ def generate_dataset_config(train_config, kwargs):
 
     assert train_config.dataset in names, f"Unknown dataset: {train_config.dataset}"
 
-    dataset_config = {k:v for k, v in inspect.getmembers(datasets)}[train_config.dataset]()
+    dataset_config = get_dataset_configs()[train_config.dataset]()
 
     update_config(dataset_config, **kwargs)
 
+    if isinstance(dataset_config, datasets.mixture_dataset):
+        from llama_recipes.datasets.mixture_dataset import parse_mixture_weights
+
+        # the sources take their overrides from the same kwargs, e.g. --samsum_dataset.train_split
+        for name in parse_mixture_weights(dataset_config.sources):
+            assert name in DATASET_PREPROC and name != train_config.dataset, f"Unknown dataset in mixture: {name}"
+            dataset_config.source_configs[name] = get_dataset_configs()[name]()
+            update_config(dataset_config.source_configs[name], **kwargs)
+
     return  dataset_config
 
 
 def get_dataloader_kwargs(train_config, dataset, tokenizer, mode):
+        from transformers import default_data_collator
+        from transformers.data import DataCollatorForSeq2Seq
+
         kwargs = {}
         batch_size = train_config.batch_size_training if mode=="train" else train_config.val_batch_size
+        if isinstance(dataset, IterableDataset):
+            return get_streaming_dataloader_kwargs(train_config, dataset, tokenizer, mode, batch_size)
         if train_config.batching_strategy == "padding":
             if train_config.enable_fsdp:
                 kwargs["batch_sampler"] = DistributedLengthBasedBatchSampler(
@@ -99,3 +332,39 @@ def get_dataloader_kwargs(train_config, dataset, tokenizer, mode):
             raise ValueError(f"Unknown batching strategy: {train_config.batching_strategy}")
 
         return kwargs
+
+
+def get_streaming_dataloader_kwargs(train_config, dataset, tokenizer, mode, batch_size):
+    """
+    Streaming datasets shard by rank and pack themselves, so the dataloader only batches and collates.
+
+    max_train_step is the budget of the whole training, a training epoch is max_train_step / num_epochs batches
+    unless the dataset sets samples_per_epoch. An evaluation epoch is max_eval_step batches.
+    """
+    from transformers import default_data_collator
+    from transformers.data import DataCollatorForSeq2Seq
+
+    if train_config.batching_strategy not in ("padding", "packing"):
+        raise ValueError(f"Unknown batching strategy: {train_config.batching_strategy}")
+    num_batches = train_config.max_eval_step
+    if mode == "train":
+        samples_per_epoch = getattr(dataset, "samples_per_epoch", 0)
+        if samples_per_epoch:
+            num_batches = samples_per_epoch // batch_size
+        else:
+            # the training stops after max_train_step batches in total, so every epoch gets its share
+            num_batches = math.ceil(train_config.max_train_step / train_config.num_epochs)
+    if num_batches <= 0:
+        raise ValueError(
+            f"Streaming datasets have no length, set max_train_step and max_eval_step to define the {mode} epoch"
+        )
+
+    packing = train_config.batching_strategy == "packing"
+    dataset.chunk_size = train_config.context_length if packing else None
+    dataset.set_epoch_length(num_batches, batch_size)
+    return {
+        "batch_size": batch_size,
+        "collate_fn": default_data_collator if packing else DataCollatorForSeq2Seq(tokenizer),
+        # the workers keep their position in the stream from one epoch to the next
+        "persistent_workers": train_config.num_workers_dataloader > 0,
+    }
@@ -7,11 +7,7 @@ from pathlib import Path
 
 import torch
 
-from llama_recipes.datasets import (
-    get_grammar_dataset,
-    get_alpaca_dataset,
-    get_samsum_dataset,
-)
+import llama_recipes.datasets
 
 
 def load_module_from_py_file(py_file: str) -> object:
@@ -49,10 +45,19 @@ def get_custom_dataset(dataset_config, tokenizer, split: str):
         raise e
 
 
+def get_dataset_lazily(name: str, dataset_config, tokenizer, split: str):
+    """
+    Imports the dataset from llama_recipes.datasets on first use, so only the selected dataset's dependencies are loaded
+    """
+    return getattr(llama_recipes.datasets, name)(dataset_config, tokenizer, split)
+
+
 DATASET_PREPROC = {
-    "alpaca_dataset": partial(get_alpaca_dataset),
-    "grammar_dataset": get_grammar_dataset,
-    "samsum_dataset": get_samsum_dataset,
+    "alpaca_dataset": partial(get_dataset_lazily, "get_alpaca_dataset"),
+    "grammar_dataset": partial(get_dataset_lazily, "get_grammar_dataset"),
+    "samsum_dataset": partial(get_dataset_lazily, "get_samsum_dataset"),
+    "mixture_dataset": partial(get_dataset_lazily, "get_mixture_dataset"),
+    "streaming_dataset": partial(get_dataset_lazily, "get_streaming_dataset"),
     "custom_dataset": get_custom_dataset,
 }
 
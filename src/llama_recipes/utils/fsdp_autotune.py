@@ -0,0 +1,297 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import dataclasses
+import hashlib
+import json
+import os
+import time
+from functools import partial
+
+import torch
+import torch.distributed as dist
+import torch.optim as optim
+from torch.distributed.fsdp import FullyShardedDataParallel as FSDP, ShardingStrategy
+from torch.distributed.fsdp.fully_sharded_data_parallel import CPUOffload
+
+from llama_recipes.utils.fsdp_utils import get_fsdp_tuning_kwargs
+from llama_recipes.utils.memory_utils import is_xpu_available
+from llama_recipes.utils.train_utils import get_policies, clear_gpu_cache
+
+
+def get_search_space(train_config, fsdp_config):
+    """
+    Returns the values tried for every tunable fsdp_config setting, in the order they are tuned.
+    """
+    search_space = {}
+    if not train_config.use_peft:
+        # PEFT models are wrapped with their own policy
+        search_space["wrapping_granularity"] = ["layer", "block"]
+    search_space["backward_prefetch"] = ["BACKWARD_PRE", "BACKWARD_POST", "NONE"]
+    search_space["forward_prefetch"] = [False, True]
+    search_space["limit_all_gathers"] = [True, False]
+    if not fsdp_config.hsdp:
+        search_space["sharding_strategy"] = [ShardingStrategy.FULL_SHARD.name, ShardingStrategy.SHARD_GRAD_OP.name]
+    return search_space
+
+
+def get_tuned_settings(fsdp_config, search_space):
+    settings = {knob: getattr(fsdp_config, knob) for knob in search_space}
+    if isinstance(settings.get("sharding_strategy"), ShardingStrategy):
+        settings["sharding_strategy"] = settings["sharding_strategy"].name
+    return settings
+
+
+def apply_tuned_settings(fsdp_config, settings):
+    for knob, value in settings.items():
+        if knob == "sharding_strategy":
+            value = ShardingStrategy[value]
+        setattr(fsdp_config, knob, value)
+
+
+def get_autotune_key(train_config, fsdp_config, world_size):
+    """
+    Hashes everything besides the tuned settings that influences the step time, results are only reused if it matches.
+    """
+    setup = {
+        "model_name": train_config.model_name,
+        "world_size": world_size,
+        "batch_size_training": train_config.batch_size_training,
+        "context_length": train_config.context_length,
+        "use_peft": train_config.use_peft,
+        "peft_method": train_config.peft_method if train_config.use_peft else None,
+        "use_fast_kernels": train_config.use_fast_kernels,
+        "mixed_precision": fsdp_config.mixed_precision,
+        "use_fp16": fsdp_config.use_fp16,
+        "pure_bf16": fsdp_config.pure_bf16,
+        "fsdp_cpu_offload": fsdp_config.fsdp_cpu_offload,
+        "fsdp_activation_checkpointing": fsdp_config.fsdp_activation_checkpointing,
+        "hsdp": fsdp_config.hsdp,
+        "sharding_group_size": fsdp_config.sharding_group_size,
+        "torch_version": torch.__version__,
+    }
+    return hashlib.sha256(json.dumps(setup, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def greedy_search(base_settings, search_space, benchmark_fn):
+    """
+    Tunes one setting at a time, keeping the fastest value before moving on to the next setting.
+
+    Returns the best settings, their step time and all measurements.
+    """
+    measured = {}
+    measurements = []
+
+    def measure(settings):
+        key = json.dumps(settings, sort_keys=True)
+        if key not in measured:
+            measured[key] = benchmark_fn(settings)
+            measurements.append({"settings": settings, "step_time": measured[key]})
+        return measured[key]
+
+    best_settings = dict(base_settings)
+    best_time = measure(best_settings)
+    for knob, values in search_space.items():
+        for value in values:
+            candidate = {**best_settings, knob: value}
+            step_time = measure(candidate)
+            if step_time < best_time:
+                best_settings, best_time = candidate, step_time
+    return best_settings, best_time, measurements
+
+
+def _init_empty_module(module, device):
+    # only materialize modules with parameters on meta, buffers like the rotary embedding were created for real
+    if any(t.is_meta for t in module.parameters(recurse=False)):
+        module.to_empty(device=device, recurse=False)
+        for param in module.parameters(recurse=False):
+            torch.nn.init.normal_(param, std=0.02)
+
+
+def _failed_on_any_rank(fn, device):
+    """
+    Runs fn and returns whether it ran out of memory on any rank.
+
+    All ranks leave a failed candidate together, a rank that went on alone would wait for the others in the
+    collectives of FSDP forever.
+    """
+    failed = False
+    try:
+        fn()
+    except torch.cuda.OutOfMemoryError:
+        failed = True
+    failed = torch.tensor(int(failed), device=device)
+    dist.all_reduce(failed, op=dist.ReduceOp.MAX)
+    return bool(failed.item())
+
+
+def benchmark_fsdp_settings(llama_config, train_config, fsdp_config, rank, local_rank, settings, peft_config=None, device_mesh=None):
+    """
+    Trains a randomly initialized model with the candidate settings on synthetic batches and returns the step time.
+
+    The model is wrapped like the training model: with the PEFT adapters of peft_config and their wrapping
+    policy, and on the HSDP device_mesh. The step time is the maximum over all ranks, so every rank takes the
+    same decisions. Candidates that run out of memory on any rank take infinitely long on all of them.
+    """
+    from accelerate import init_empty_weights
+    from peft import get_peft_model
+    from transformers import LlamaForCausalLM
+    from transformers.models.llama.modeling_llama import LlamaDecoderLayer
+
+    from llama_recipes.policies import apply_fsdp_checkpointing
+    from llama_recipes.utils.fsdp_utils import fsdp_auto_wrap_policy
+
+    candidate_config = dataclasses.replace(fsdp_config)
+    apply_tuned_settings(candidate_config, settings)
+
+    if is_xpu_available():
+        device = torch.device(f"xpu:{local_rank}")
+        synchronize = torch.xpu.synchronize
+    else:
+        device = torch.device(f"cuda:{local_rank}")
+        synchronize = torch.cuda.synchronize
+
+    with init_empty_weights(include_buffers=False):
+        model = LlamaForCausalLM(llama_config)
+    if candidate_config.pure_bf16:
+        model.to(torch.bfloat16)
+    if peft_config is not None:
+        model = get_peft_model(model, peft_config)
+
+    mixed_precision_policy, wrapping_policy = get_policies(candidate_config, rank)
+    training = {}
+
+    def setup():
+        training["model"] = FSDP(
+            model,
+            auto_wrap_policy=fsdp_auto_wrap_policy(model, LlamaDecoderLayer) if peft_config is not None else wrapping_policy,
+            cpu_offload=CPUOffload(offload_params=True) if candidate_config.fsdp_cpu_offload else None,
+            mixed_precision=mixed_precision_policy if not candidate_config.pure_bf16 else None,
+            sharding_strategy=candidate_config.sharding_strategy,
+            device_mesh=device_mesh,
+            device_id=device,
+            param_init_fn=partial(_init_empty_module, device=device),
+            **get_fsdp_tuning_kwargs(candidate_config),
+            use_orig_params=train_config.optimizer_in_backward or train_config.compile,
+        )
+        if candidate_config.fsdp_activation_checkpointing:
+            # the memory_budget policy needs a probe on real data, use full checkpointing as a proxy
+            policy = candidate_config.activation_checkpointing_policy
+            apply_fsdp_checkpointing(
+                training["model"],
+                policy="full" if policy == "memory_budget" else policy,
+                interval=candidate_config.activation_checkpointing_interval,
+                offload=candidate_config.activation_checkpointing_offload,
+            )
+        training["optimizer"] = optim.AdamW(training["model"].parameters(), lr=train_config.lr)
+
+    input_ids = torch.randint(
+        llama_config.vocab_size,
+        (train_config.batch_size_training, train_config.context_length),
+        device=device,
+    )
+
+    def train_step():
+        loss = training["model"](input_ids=input_ids, labels=input_ids).loss
+        loss.backward()
+        training["optimizer"].step()
+        training["optimizer"].zero_grad()
+
+    step_time = float("inf")
+    # setup and warmup, then the timed steps, each is checked on all ranks before the next one starts
+    failed = _failed_on_any_rank(setup, device) or _failed_on_any_rank(train_step, device)
+    if not failed:
+        synchronize()
+        start = time.perf_counter()
+        for _ in range(fsdp_config.autotune_steps):
+            failed = _failed_on_any_rank(train_step, device)
+            if failed:
+                break
+        synchronize()
+        if not failed:
+            step_time = (time.perf_counter() - start) / fsdp_config.autotune_steps
+    if failed and rank == 0:
+        print(f"--> FSDP autotune: {settings} ran out of memory")
+    model = None
+    training.clear()
+    clear_gpu_cache()
+
+    step_time = torch.tensor(step_time, device=device)
+    dist.all_reduce(step_time, op=dist.ReduceOp.MAX)
+    if rank == 0:
+        print(f"--> FSDP autotune: {settings} took {step_time.item():.4f}s per step")
+    return step_time.item()
+
+
+def load_autotune_results(results_file):
+    if not os.path.isfile(results_file):
+        return {}
+    with open(results_file) as f:
+        return json.load(f)
+
+
+def _broadcast_from_rank_0(obj):
+    if not dist.is_initialized():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+def autotune_fsdp_config(train_config, fsdp_config, rank, local_rank, benchmark_fn=None, peft_config=None, device_mesh=None):
+    """
+    Picks the fastest wrapping, prefetch, limit_all_gathers and sharding settings and applies them to fsdp_config.
+
+    The candidates are benchmarked on the model as it is trained, with the adapters of peft_config and on the
+    HSDP device_mesh. Results are stored in fsdp_config.autotune_results_file and reused for runs with the same setup.
+    Only rank 0 reads and writes the file, the other ranks get its decision, so nodes without a shared filesystem agree.
+    """
+    world_size = dist.get_world_size() if dist.is_initialized() else 1
+    key = get_autotune_key(train_config, fsdp_config, world_size)
+    search_space = get_search_space(train_config, fsdp_config)
+
+    results = load_autotune_results(fsdp_config.autotune_results_file) if rank == 0 else {}
+    cached_settings = _broadcast_from_rank_0(results[key]["best_settings"] if key in results else None)
+    if cached_settings is not None:
+        if rank == 0:
+            print(f"--> FSDP autotune: reusing {cached_settings} from {fsdp_config.autotune_results_file}")
+        apply_tuned_settings(fsdp_config, cached_settings)
+        return cached_settings
+
+    if benchmark_fn is None:
+        from transformers import LlamaConfig
+
+        llama_config = LlamaConfig.from_pretrained(train_config.model_name)
+        llama_config.use_cache = False
+        if train_config.use_fast_kernels:
+            llama_config._attn_implementation = "sdpa"
+        benchmark_fn = partial(
+            benchmark_fsdp_settings,
+            llama_config,
+            train_config,
+            fsdp_config,
+            rank,
+            local_rank,
+            peft_config=peft_config,
+            device_mesh=device_mesh,
+        )
+
+    best_settings, best_time, measurements = greedy_search(
+        get_tuned_settings(fsdp_config, search_space),
+        search_space,
+        benchmark_fn,
+    )
+    # the step times are reduced over all ranks, rank 0 still decides so that all ranks wrap the model alike
+    best_settings = _broadcast_from_rank_0(best_settings)
+    apply_tuned_settings(fsdp_config, best_settings)
+
+    if rank == 0:
+        print(f"--> FSDP autotune: training with {best_settings}, {best_time:.4f}s per step")
+        results[key] = {
+            "best_settings": best_settings,
+            "best_step_time": best_time,
+            "measurements": measurements,
+        }
+        with open(fsdp_config.autotune_results_file, "w") as f:
+            json.dump(results, f, indent=4)
+    return best_settings
@@ -89,3 +89,172 @@ def hsdp_device_mesh(replica_group_size, sharding_group_size, device=None):
         raise RuntimeError("Failed to create a valid device mesh.")
 
     return device_mesh
+
+
+def get_grad_reduce_bytes(model):
+    """
+    Estimates the gradient bytes each rank sends into FSDP's gradient reduction in one backward pass.
+
+    This is the reduce-scatter input (the unsharded gradients in the reduce dtype of the mixed
+    precision policy) plus, for HYBRID_SHARD, the all-reduce of the gradient shard across replicas.
+    It is the traffic saved for every micro step that runs its backward pass under `no_sync()`.
+
+    Args:
+        model: The FSDP wrapped model.
+
+    Returns:
+        The number of bytes as an int.
+    """
+    import torch.distributed as dist
+
+    mixed_precision = getattr(model, "mixed_precision", None)
+    reduce_dtype = mixed_precision.reduce_dtype if mixed_precision is not None else None
+    shard_world_size = dist.get_world_size(model.process_group)
+    inter_node_pg = getattr(model, "_inter_node_pg", None)
+
+    shard_bytes = 0
+    for param in model.parameters():
+        if param.requires_grad:
+            shard_bytes += param.numel() * (reduce_dtype or param.dtype).itemsize
+
+    reduce_bytes = shard_bytes * shard_world_size
+    if inter_node_pg is not None:
+        reduce_bytes += shard_bytes
+    return reduce_bytes
+
+
+def get_fsdp_tuning_kwargs(fsdp_config):
+    """
+    Maps the prefetch and rate limiting settings of the fsdp_config to FSDP constructor arguments.
+    """
+    from torch.distributed.fsdp import BackwardPrefetch
+
+    if fsdp_config.backward_prefetch == "NONE":
+        backward_prefetch = None
+    elif fsdp_config.backward_prefetch in BackwardPrefetch.__members__:
+        backward_prefetch = BackwardPrefetch[fsdp_config.backward_prefetch]
+    else:
+        raise ValueError(f"Unknown backward_prefetch: {fsdp_config.backward_prefetch}")
+
+    return dict(
+        backward_prefetch=backward_prefetch,
+        forward_prefetch=fsdp_config.forward_prefetch,
+        limit_all_gathers=fsdp_config.limit_all_gathers,
+    )
+
+
+def _get_safetensors_weight_map(model_name_or_path):
+    import json
+    import torch.distributed as dist
+    from huggingface_hub import snapshot_download
+
+    if not os.path.isdir(model_name_or_path):
+        # one process per node downloads the checkpoint, the others wait and find it in the local cache
+        download_kwargs = dict(allow_patterns=["*.safetensors", "*.json"])
+        local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        if local_rank == 0:
+            snapshot_download(model_name_or_path, **download_kwargs)
+        if dist.is_available() and dist.is_initialized():
+            dist.barrier()
+        model_name_or_path = snapshot_download(model_name_or_path, local_files_only=True, **download_kwargs)
+
+    index_file = os.path.join(model_name_or_path, "model.safetensors.index.json")
+    if os.path.isfile(index_file):
+        with open(index_file) as f:
+            weight_map = json.load(f)["weight_map"]
+        return {name: os.path.join(model_name_or_path, file) for name, file in weight_map.items()}
+
+    from safetensors import safe_open
+
+    checkpoint_file = os.path.join(model_name_or_path, "model.safetensors")
+    if not os.path.isfile(checkpoint_file):
+        raise FileNotFoundError(f"No safetensors checkpoint found in {model_name_or_path}")
+    with safe_open(checkpoint_file, framework="pt") as f:
+        return {name: checkpoint_file for name in f.keys()}
+
+
+def _get_checkpoint_key(name):
+    # PEFT moves the base model under base_model.model and the wrapped linear layers under base_layer
+    if name.startswith("base_model.model."):
+        name = name[len("base_model.model."):]
+    return name.replace(".base_layer.", ".")
+
+
+def get_safetensors_param_init_fn(model, model_name_or_path, device):
+    """
+    Creates a param_init_fn for FSDP that materializes each module of a meta device model on `device`
+    and fills it with its tensors from the model's safetensors checkpoint.
+
+    FSDP initializes the unsharded FSDP units one at a time before it shards them, so every rank reads every
+    tensor, but only one unit at a time and from memory-mapped checkpoint files that share the page cache of a
+    node. Neither the full model in CPU memory nor a broadcast from rank 0 is needed. A checkpoint on the Hub is
+    downloaded by local rank 0 of every node while the other ranks wait. Tensors missing from the
+    checkpoint, e.g. PEFT adapters, are initialized the way their module does it. Rows added to the embeddings
+    by `resize_token_embeddings` are initialized with `initializer_range`. Without `sync_module_states` the
+    ranks have to draw the same random values for these tensors, so each module is initialized from a seed
+    derived from the process seed and its name, independent of the random numbers a rank used before.
+
+    Args:
+        model: The model created on the meta device, before it is wrapped with FSDP.
+        model_name_or_path: A local directory or a model id on the Hugging Face Hub with a safetensors checkpoint.
+        device: The device to materialize the parameters on.
+
+    Returns:
+        A function that takes a module and initializes its parameters and buffers in place.
+    """
+    import zlib
+
+    import torch
+    from safetensors import safe_open
+
+    weight_map = _get_safetensors_weight_map(model_name_or_path)
+    module_names = {module: name for name, module in model.named_modules()}
+    initializer_range = getattr(getattr(model, "config", None), "initializer_range", 0.02)
+    seed = torch.initial_seed()
+    # the CPU generator is always forked, accelerators only when the module is materialized on one
+    rng_kwargs = dict(devices=[]) if device.type == "cpu" else dict(devices=[device], device_type=device.type)
+
+    def param_init_fn(module):
+        tensors = list(module.named_parameters(recurse=False)) + list(module.named_buffers(recurse=False))
+        if not any(tensor.is_meta for _, tensor in tensors):
+            return
+        module.to_empty(device=device, recurse=False)
+
+        prefix = module_names.get(module, "")
+        prefix = f"{prefix}." if prefix else ""
+        tensors = list(module.named_parameters(recurse=False)) + list(module.named_buffers(recurse=False))
+
+        files = {}
+        missing = []
+        for name, tensor in tensors:
+            key = _get_checkpoint_key(prefix + name)
+            if key in weight_map:
+                files.setdefault(weight_map[key], []).append((key, tensor))
+            else:
+                missing.append((prefix + name, tensor))
+
+        with torch.no_grad(), torch.random.fork_rng(**rng_kwargs):
+            torch.manual_seed((seed + zlib.crc32(prefix.encode())) % 2**63)
+            # initialize first, then overwrite whatever the checkpoint provides
+            if missing:
+                if any(".lora_B." in name for name, _ in missing):
+                    # LoRA starts with a zero update
+                    for _, tensor in missing:
+                        tensor.zero_()
+                elif hasattr(module, "reset_parameters"):
+                    module.reset_parameters()
+                else:
+                    raise RuntimeError(f"Can not initialize {[name for name, _ in missing]}, they are not in the checkpoint")
+
+            for file, file_tensors in files.items():
+                with safe_open(file, framework="pt", device=str(device)) as f:
+                    for key, tensor in file_tensors:
+                        checkpoint_tensor = f.get_tensor(key)
+                        if checkpoint_tensor.shape != tensor.shape:
+                            # resized embeddings keep the checkpoint rows
+                            num_rows = checkpoint_tensor.shape[0]
+                            tensor[num_rows:].normal_(mean=0.0, std=initializer_range)
+                            tensor = tensor[:num_rows]
+                        tensor.copy_(checkpoint_tensor)
+
+    return param_init_fn
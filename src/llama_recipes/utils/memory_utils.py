@@ -6,7 +6,12 @@ import psutil
 import threading
 
 import torch
-from accelerate.utils import is_xpu_available
+
+def is_xpu_available():
+    # accelerate takes over a second to import, only pay for it once memory is traced
+    from accelerate.utils import is_xpu_available
+
+    return is_xpu_available()
 
 def byte2gb(x):
     return int(x / 2**30)
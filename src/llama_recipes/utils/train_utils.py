@@ -3,11 +3,11 @@
 
 import os
 import time
-import yaml
 from contextlib import nullcontext
 from pathlib import Path
-from pkg_resources import packaging
+import packaging.version
 from datetime import datetime
+from typing import TYPE_CHECKING
 
 
 import torch
@@ -16,16 +16,24 @@ import torch.distributed as dist
 from torch.distributed.fsdp import StateDictType
 from torch.distributed.fsdp.sharded_grad_scaler import ShardedGradScaler
 from tqdm import tqdm
-from transformers import LlamaTokenizer
 import json
 
 
-from llama_recipes.model_checkpointing import save_model_checkpoint, save_model_and_optimizer_sharded, save_optimizer_checkpoint
-from llama_recipes.policies import fpSixteen,bfSixteen, get_llama_wrapper
-from llama_recipes.utils.memory_utils import MemoryTrace
-from accelerate.utils import is_xpu_available, is_ccl_available
+from llama_recipes.model_checkpointing import (
+    load_training_state,
+    save_model_checkpoint,
+    save_model_and_optimizer_sharded,
+    save_optimizer_checkpoint,
+    save_training_state,
+)
+from llama_recipes.policies import fpSixteen,bfSixteen
+from llama_recipes.utils.memory_utils import MemoryTrace, is_xpu_available
+from llama_recipes.utils.fsdp_utils import get_grad_reduce_bytes
 
-def set_tokenizer_params(tokenizer: LlamaTokenizer):
+if TYPE_CHECKING:
+    from transformers import LlamaTokenizer
+
+def set_tokenizer_params(tokenizer: "LlamaTokenizer"):
     tokenizer.pad_token_id = 0
     tokenizer.padding_side = "left"
 
@@ -63,6 +71,19 @@ def train(model, train_dataloader,eval_dataloader, tokenizer, optimizer, lr_sche
 
     autocast = torch.cuda.amp.autocast if train_config.use_fp16 else nullcontext
 
+    # Only the last micro step of a gradient accumulation window needs to reduce-scatter the gradients,
+    # the others can accumulate unsharded gradients locally under no_sync()
+    skip_grad_sync = (
+        train_config.enable_fsdp
+        and fsdp_config.gradient_accumulation_mode == "communication"
+        and gradient_accumulation_steps > 1
+    )
+    grad_sync_bytes_saved = 0
+    if skip_grad_sync:
+        grad_sync_bytes_saved = (gradient_accumulation_steps - 1) * get_grad_reduce_bytes(model)
+        if rank == 0:
+            print(f"Skipping the gradient sync of {gradient_accumulation_steps - 1} micro steps saves {byte2mb(grad_sync_bytes_saved)} MB of communication per rank and optimizer step")
+
     train_prep = []
     train_loss = []
     val_prep = []
@@ -77,15 +98,32 @@ def train(model, train_dataloader,eval_dataloader, tokenizer, optimizer, lr_sche
 
     epoch_times = []
     checkpoint_times = []
+    if train_config.compile:
+        from torch._dynamo.utils import counters
+        # steps that compiled new graphs are timed separately from the steady state steps
+        compile_step_times = []
+        step_times = []
     results = {}
     best_val_loss = float("inf")
     total_train_steps = 0
     max_steps_reached = False  # Flag to indicate max training steps reached
+    # the state of the training data, e.g. the position of a mixture, is saved and restored with the checkpoint
+    dataset_train = getattr(train_dataloader, "dataset", None)
+    starting_epoch = 0
+    if train_config.resume_training_state:
+        starting_epoch = load_training_state(dataset_train, train_config) + 1
+        for _ in range(starting_epoch):
+            lr_scheduler.step()
+        if not train_config.enable_fsdp or rank==0:
+            print(f"Resuming the training at epoch {starting_epoch+1}")
     # Start the training loop
-    for epoch in range(train_config.num_epochs):
+    for epoch in range(starting_epoch, train_config.num_epochs):
         # stop when the maximum number of training steps is reached
         if max_steps_reached:
             break
+        # datasets like the mixture draw a new order of their samples every epoch
+        if hasattr(dataset_train, "set_epoch"):
+            dataset_train.set_epoch(epoch)
         epoch_start_time = time.perf_counter()
         with MemoryTrace() as memtrace:  # track the memory usage
             model.train()
@@ -100,6 +138,9 @@ def train(model, train_dataloader,eval_dataloader, tokenizer, optimizer, lr_sche
                     if not train_config.enable_fsdp or local_rank==0:
                         print("max training steps reached, stopping training, total_train_steps: ", total_train_steps-1)
                     break
+                if train_config.compile:
+                    step_start_time = time.perf_counter()
+                    num_graphs = counters["stats"]["unique_graphs"]
                 for key in batch.keys():
                     if train_config.enable_fsdp:
                         if is_xpu_available():
@@ -119,9 +160,14 @@ def train(model, train_dataloader,eval_dataloader, tokenizer, optimizer, lr_sche
                     train_step_loss.append(loss.detach().float().item())
                     train_step_perplexity.append(float(torch.exp(loss.detach().float())))
                 total_loss += loss.detach().float()
+                is_accumulation_step = (step + 1) % gradient_accumulation_steps != 0 and step != len(train_dataloader) - 1
                 if train_config.use_fp16:
                     # if fp16 is enabled, use gradient scaler to handle gradient update
-                    scaler.scale(loss).backward()
+                    if skip_grad_sync and is_accumulation_step:
+                        with model.no_sync():
+                            scaler.scale(loss).backward()
+                    else:
+                        scaler.scale(loss).backward()
                     if (step + 1) % gradient_accumulation_steps == 0 or step == len(train_dataloader) - 1:
                         if train_config.gradient_clipping and train_config.gradient_clipping_threshold > 0.0:
                             scaler.unscale_(optimizer)
@@ -135,7 +181,11 @@ def train(model, train_dataloader,eval_dataloader, tokenizer, optimizer, lr_sche
                         pbar.update(1)
                 else:
                     # regular backpropagation when fp16 is not used
-                    loss.backward()
+                    if skip_grad_sync and is_accumulation_step:
+                        with model.no_sync():
+                            loss.backward()
+                    else:
+                        loss.backward()
                     if (step + 1) % gradient_accumulation_steps == 0 or step == len(train_dataloader) - 1:
                         if train_config.gradient_clipping and train_config.gradient_clipping_threshold > 0.0:
                             if train_config.enable_fsdp:
@@ -156,6 +206,13 @@ def train(model, train_dataloader,eval_dataloader, tokenizer, optimizer, lr_sche
 
                 pbar.set_description(f"Training Epoch: {epoch+1}/{train_config.num_epochs}, step {step}/{len(train_dataloader)} completed (loss: {loss.detach().float()})")
 
+                if train_config.compile:
+                    step_time = time.perf_counter() - step_start_time
+                    if counters["stats"]["unique_graphs"] > num_graphs:
+                        compile_step_times.append(step_time)
+                    else:
+                        step_times.append(step_time)
+
                 if train_config.save_metrics:
                     save_to_json(metrics_filename, train_step_loss, train_loss, train_step_perplexity, train_prep, val_step_loss, val_loss, val_step_perplexity, val_prep)
             pbar.close()
@@ -226,6 +283,7 @@ def train(model, train_dataloader,eval_dataloader, tokenizer, optimizer, lr_sche
                         )
                         print(" Saving the FSDP model checkpoints and optimizer using FULL_STATE_DICT")
                         print("=====================================================")
+                save_training_state(dataset_train, epoch, rank, train_config)
                 if train_config.enable_fsdp:
                     dist.barrier()
             checkpoint_end_time = time.perf_counter() - checkpoint_start_time
@@ -264,6 +322,14 @@ def train(model, train_dataloader,eval_dataloader, tokenizer, optimizer, lr_sche
         results['avg_eval_loss'] = avg_eval_loss
     results["avg_epoch_time"] = avg_epoch_time
     results["avg_checkpoint_time"] = avg_checkpoint_time
+    if train_config.compile:
+        avg_step_time = sum(step_times) / len(step_times) if len(step_times) > 0 else 0
+        results["avg_step_time"] = avg_step_time
+        results["compile_time"] = sum(t - avg_step_time for t in compile_step_times)
+        if not train_config.enable_fsdp or rank==0:
+            print(f"Compilation took {results['compile_time']:.2f}s over {len(compile_step_times)} steps, steady state step time {avg_step_time:.4f}s")
+    if skip_grad_sync:
+        results["grad_sync_bytes_saved_per_step"] = grad_sync_bytes_saved
     if train_config.save_metrics:
         results["metrics_filename"] = metrics_filename
 
@@ -367,6 +433,8 @@ def check_frozen_layers_peft_model(model):
 
 def setup():
     """Initialize the process group for distributed training"""
+    from accelerate.utils import is_ccl_available
+
     if is_ccl_available():
         # distributed training on xpus
         dist.init_process_group("ccl")
@@ -458,7 +526,10 @@ def get_policies(cfg, rank):
                 print(f"FP16 enabled")
         else:
             print(f"bFloat16 support not present. Using FP32, and not mixed precision")
-    wrapping_policy = get_llama_wrapper()
+    # the wrapping policy needs the transformers layer classes, which are slow to import
+    from llama_recipes.policies import get_llama_wrapper
+
+    wrapping_policy = get_llama_wrapper(cfg.wrapping_granularity)
     return mixed_precision_policy, wrapping_policy
 
 def save_train_params(train_config, fsdp_config, rank):
@@ -487,6 +558,8 @@ def save_train_params(train_config, fsdp_config, rank):
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
     # Convert the dictionary to a YAML string
+    import yaml
+
     config_yaml = yaml.dump(train_params_dict, indent=4)
     file_name = os.path.join(save_dir,'train_params.yaml')
 
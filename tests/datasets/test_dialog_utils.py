@@ -0,0 +1,136 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import itertools
+
+import datasets
+import pytest
+
+from llama_recipes.datasets.dialog_utils import (
+    build_message_tree,
+    get_threads,
+    to_dialog,
+    tokenize_dialogs,
+)
+from llama_recipes.utils.dataset_utils import load_module_from_py_file
+
+# root "a" with two answers, one of which has two follow up questions; "f" has no answers
+MESSAGE_IDS = ["a", "b", "c", "d", "e", "f", "g", "h"]
+PARENT_IDS = [None, "a", "a", "b", "b", None, "d", "c"]
+TEXTS = ["q1", "a1", "a2", "q2", "q3", "q4", "a3", "q5"]
+
+
+class FakeTokenizer:
+    bos_token = "<s>"
+    eos_token = "</s>"
+    vocab_size = 32000
+
+    def encode(self, text, add_special_tokens=False):
+        return [ord(c) for c in text]
+
+    def __call__(self, texts, add_special_tokens=False):
+        return {"input_ids": [self.encode(text) for text in texts]}
+
+    def get_vocab(self):
+        return {}
+
+
+def get_llama3_tokenizer():
+    tokenizers = pytest.importorskip("tokenizers")
+    from transformers import PreTrainedTokenizerFast
+
+    special_tokens = ["<|begin_of_text|>", "<|end_of_text|>", "<|start_header_id|>", "<|end_header_id|>", "<|eot_id|>"]
+    words = ["<unk>", "user", "assistant", "system", "q1", "a1", "q2", "a2", "be", "brief"]
+    tokenizer = tokenizers.Tokenizer(tokenizers.models.WordLevel({w: i for i, w in enumerate(words)}, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.Whitespace()
+    tokenizer.add_special_tokens(special_tokens)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<|begin_of_text|>", eos_token="<|end_of_text|>")
+
+
+def test_build_message_tree():
+    children, root_ids = build_message_tree(MESSAGE_IDS, PARENT_IDS)
+
+    assert children == {"a": ["b", "c"], "b": ["d", "e"], "d": ["g"], "c": ["h"]}
+    assert root_ids == ["a", "f"]
+    assert list(get_threads("a", children)) == [["a", "b", "d", "g"], ["a", "b", "e"], ["a", "c", "h"]]
+    assert list(get_threads("f", children)) == [["f"]]
+    assert list(get_threads("f", children, min_length=2)) == []
+
+
+def baseline_tokenize_dialog(dialog, tokenizer):
+    # frozen copy of the Llama 2 path of tokenize_dialog in the custom_dataset recipe before tokenize_dialogs
+    prompt_tokens = [tokenizer.encode(f"{tokenizer.bos_token}[INST] {(prompt['content']).strip()} [/INST]", add_special_tokens=False) for prompt in dialog[::2]]
+    answer_tokens = [tokenizer.encode(f"{answer['content'].strip()} {tokenizer.eos_token}", add_special_tokens=False) for answer in dialog[1::2]]
+    dialog_tokens = list(itertools.chain.from_iterable(zip(prompt_tokens, answer_tokens)))
+    labels_tokens = [len(c)*[-100,] if i % 2 == 0 else c for i,c in enumerate(dialog_tokens)]
+    combined_tokens = {
+        "input_ids": list(itertools.chain(*(t for t in dialog_tokens))),
+        "labels": list(itertools.chain(*(t for t in labels_tokens))),
+    }
+    return dict(combined_tokens, attention_mask=[1]*len(combined_tokens["input_ids"]))
+
+
+def test_custom_dataset_matches_baseline_tokenization(mocker):
+    custom_dataset = load_module_from_py_file("recipes/finetuning/datasets/custom_dataset.py")
+    oasst = datasets.Dataset.from_dict({"message_id": MESSAGE_IDS, "parent_id": PARENT_IDS, "text": TEXTS})
+    mocker.patch.object(custom_dataset.datasets, "load_dataset", return_value=oasst)
+    tokenizer = FakeTokenizer()
+
+    dataset = custom_dataset.get_custom_dataset(None, tokenizer, "train")
+
+    messages = dict(zip(MESSAGE_IDS, TEXTS))
+    children, _ = build_message_tree(MESSAGE_IDS, PARENT_IDS)
+    expected = [
+        baseline_tokenize_dialog(to_dialog([messages[m] for m in thread]), tokenizer)
+        for thread in get_threads("a", children)
+    ]
+    assert dataset.to_list() == expected
+
+
+def test_tokenize_dialogs_llama2():
+    tokenizer = FakeTokenizer()
+    dialogs = [to_dialog(["q1", "a1", "q2"]), to_dialog([" q1 ", "a1", "q2", "a2"])]
+
+    result = tokenize_dialogs(dialogs, tokenizer)
+
+    prompt = tokenizer.encode("<s>[INST] q1 [/INST]")
+    answer = tokenizer.encode("a1 </s>")
+    # the unanswered last message of the first dialog is dropped
+    assert result["input_ids"][0] == prompt + answer
+    assert result["labels"][0] == [-100] * len(prompt) + answer
+    assert result["attention_mask"][0] == [1] * len(prompt + answer)
+    assert result["input_ids"][1][:len(prompt + answer)] == prompt + answer
+    assert result["labels"][1][-len(answer):] == tokenizer.encode("a2 </s>")
+
+    # a dialog without answer has no tokens in the Llama 2 format, the dialogs around it keep theirs
+    result = tokenize_dialogs([to_dialog(["q1", "a1"]), to_dialog(["q1"]), to_dialog(["q1", "a1"])], tokenizer)
+    assert result["input_ids"] == [prompt + answer, [], prompt + answer]
+    assert result["attention_mask"][1] == []
+
+
+def test_tokenize_dialogs_llama3():
+    tokenizer = get_llama3_tokenizer()
+    dialogs = [
+        [{"role": "system", "content": "be brief"}] + to_dialog(["q1", "a1", "q2", "a2"]),
+        to_dialog(["q1", "a1", "q2"]),
+    ]
+
+    result = tokenize_dialogs(dialogs, tokenizer)
+
+    bos, eos, start_header, end_header, eot = tokenizer.convert_tokens_to_ids(
+        ["<|begin_of_text|>", "<|end_of_text|>", "<|start_header_id|>", "<|end_header_id|>", "<|eot_id|>"]
+    )
+    user, assistant, system, q1, a1, q2, a2, be, brief = range(1, 10)
+    system_turn = [start_header, system, end_header, be, brief, eot]
+    turns = [[start_header, user, end_header, q1, eot], [start_header, assistant, end_header, a1, eot]]
+    turns += [[start_header, user, end_header, q2, eot], [start_header, assistant, end_header, a2, eot]]
+
+    assert result["input_ids"][0] == [bos] + system_turn + sum(turns, [])
+    # unlike the apply_chat_template path the recipe had before, the labels hold the whole assistant turns,
+    # their header and their end of turn token, also when a user message follows and after a system message
+    assert result["labels"][0] == [-100] * 7 + [-100] * 5 + turns[1] + [-100] * 5 + turns[3]
+    # no generation prompt at the end, the last user message is kept
+    assert result["input_ids"][1] == [bos] + sum(turns[:3], [])
+    assert result["labels"][1][-5:] == [-100] * 5
+    assert eos not in result["input_ids"][0]
+    assert tokenize_dialogs([], tokenizer) == {"input_ids": [], "labels": [], "attention_mask": []}
@@ -0,0 +1,130 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import pytest
+
+from llama_recipes.configs import train_config as TRAIN_CONFIG
+from llama_recipes.datasets.mixture_dataset import MixtureDataset
+from llama_recipes.model_checkpointing import load_training_state, save_training_state
+from llama_recipes.utils.config_utils import generate_dataset_config
+from llama_recipes.utils.dataset_utils import DATASET_PREPROC, get_preprocessed_dataset
+
+
+def make_source(token, num_samples, length=3):
+    return [
+        {"input_ids": [token] * length, "attention_mask": [1] * length, "labels": [token] * length}
+        for _ in range(num_samples)
+    ]
+
+
+def test_mixture_dataset():
+    sources = {"a": make_source(1, 10), "b": make_source(2, 4)}
+    mixture = MixtureDataset(sources, {"a": 1.0, "b": 3.0}, seed=0, num_samples=400)
+
+    assert len(mixture) == 400
+    samples = [mixture[i] for i in range(len(mixture))]
+    counts = mixture.get_sample_counts()
+    assert counts["a"] + counts["b"] == 400
+    assert 60 < counts["a"] < 140
+    assert sum(s["input_ids"][0] == 1 for s in samples) == counts["a"]
+    assert mixture.token_counts == {"a": 3 * counts["a"], "b": 3 * counts["b"]}
+
+    # reading a sample again does not count its tokens twice
+    mixture[0]
+    assert mixture.token_counts == {"a": 3 * counts["a"], "b": 3 * counts["b"]}
+
+    # the same seed gives the same order, another epoch a different one
+    same = MixtureDataset(sources, {"a": 1.0, "b": 3.0}, seed=0, num_samples=400)
+    assert [same[i] for i in range(400)] == samples
+    same.set_epoch(1)
+    assert not (same.sources == mixture.sources).all()
+
+    with pytest.raises(IndexError):
+        mixture[400]
+    with pytest.raises(ValueError):
+        MixtureDataset(sources, {"a": 1.0}, seed=0)
+
+
+def test_mixture_dataset_cycles_sources():
+    source = [{"input_ids": [i], "attention_mask": [1], "labels": [i]} for i in range(5)]
+    mixture = MixtureDataset({"a": source, "b": make_source(-1, 1)}, {"a": 1.0, "b": 0.0}, num_samples=15)
+
+    ids = [mixture[i]["input_ids"][0] for i in range(15)]
+    # every pass over the source sees each sample once, in a new order
+    for start in range(0, 15, 5):
+        assert sorted(ids[start:start + 5]) == list(range(5))
+    assert ids[:5] != ids[5:10] or ids[5:10] != ids[10:]
+
+
+def test_mixture_dataset_packing():
+    mixture = MixtureDataset({"a": make_source(1, 10), "b": make_source(2, 10)}, {"a": 1.0, "b": 3.0}, seed=3, num_samples=50)
+
+    packed = mixture.pack(chunk_size=7)
+
+    # the sources are packed one by one, the mixture itself is not read
+    assert sum(mixture.token_counts.values()) == 0
+    assert len(packed) == 50
+    assert packed.weights.tolist() == [1.0, 3.0]
+    chunks = [packed[i] for i in range(len(packed))]
+    assert all(len(chunk["input_ids"]) == 7 for chunk in chunks)
+    assert all(len(set(chunk["input_ids"])) == 1 for chunk in chunks)
+
+
+def test_mixture_dataset_state_dict():
+    sources = {"a": make_source(1, 10), "b": make_source(2, 10)}
+    mixture = MixtureDataset(sources, {"a": 0.5, "b": 0.5}, seed=1)
+    mixture.set_epoch(2)
+    for i in range(5):
+        mixture[i]
+
+    resumed = MixtureDataset(sources, {"a": 0.5, "b": 0.5}, seed=7)
+    resumed.load_state_dict(mixture.state_dict())
+
+    assert resumed.epoch == 2
+    assert resumed.token_counts == mixture.token_counts
+    assert [resumed[i] for i in range(20)] == [mixture[i] for i in range(20)]
+    assert resumed.token_counts == mixture.token_counts
+
+
+def test_training_state_is_saved_with_the_checkpoint(tmp_path):
+    sources = {"a": make_source(1, 10), "b": make_source(2, 10)}
+    mixture = MixtureDataset(sources, {"a": 0.5, "b": 0.5}, seed=1)
+    mixture.set_epoch(1)
+    for i in range(5):
+        mixture[i]
+    train_config = TRAIN_CONFIG(use_peft=True, output_dir=str(tmp_path))
+
+    save_training_state(mixture, 1, 0, train_config)
+    resumed = MixtureDataset(sources, {"a": 0.5, "b": 0.5}, seed=1)
+
+    assert load_training_state(resumed, train_config) == 1
+    assert resumed.epoch == 1
+    assert resumed.token_counts == mixture.token_counts
+
+
+def test_get_mixture_dataset(mocker):
+    def get_source(token):
+        def get_dataset(dataset_config, tokenizer, split):
+            return make_source(token, 8 if split == dataset_config.train_split else 2)
+        return get_dataset
+
+    mocker.patch.dict(DATASET_PREPROC, {"alpaca_dataset": get_source(1), "samsum_dataset": get_source(2)})
+    train_config = TRAIN_CONFIG(dataset="mixture_dataset")
+    kwargs = {
+        "mixture_dataset.sources": "alpaca_dataset:2,samsum_dataset",
+        "mixture_dataset.num_samples": 30,
+        "samsum_dataset.train_split": "other",
+    }
+
+    dataset_config = generate_dataset_config(train_config, kwargs)
+    assert dataset_config.source_configs["samsum_dataset"].train_split == "other"
+
+    dataset_train = get_preprocessed_dataset(None, dataset_config, split="train")
+    dataset_val = get_preprocessed_dataset(None, dataset_config, split="test")
+
+    assert isinstance(dataset_train, MixtureDataset)
+    assert dataset_train.names == ["alpaca_dataset", "samsum_dataset"]
+    assert dataset_train.weights.tolist() == [2.0, 1.0]
+    assert len(dataset_train) == 30
+    # the validation split is every source in full, not drawn by the weights
+    assert [sample["input_ids"][0] for sample in dataset_val] == [1, 1, 2, 2]
@@ -0,0 +1,132 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import json
+from itertools import islice
+
+import pytest
+import torch
+
+from llama_recipes.configs import train_config as TRAIN_CONFIG
+from llama_recipes.datasets.streaming_dataset import StreamingDataset, get_shard_files
+from llama_recipes.utils.config_utils import get_dataloader_kwargs
+
+
+class FakeTokenizer:
+    bos_token = "<s>"
+    eos_token = "</s>"
+    pad_token_id = 0
+    padding_side = "right"
+
+    def encode(self, text, add_special_tokens=False):
+        return [int(t) for t in text.replace("<s>", " 1 ").replace("</s>", " 2 ").split()]
+
+
+def write_shards(path, num_shards, records_per_shard):
+    for shard in range(num_shards):
+        with open(path / f"shard_{shard}.jsonl", "w") as f:
+            for i in range(records_per_shard):
+                f.write(json.dumps({"text": str(100 + shard * records_per_shard + i)}) + "\n")
+    return get_shard_files(str(path / "*.jsonl"))
+
+
+@pytest.mark.parametrize("num_shards", [4, 1])
+def test_readers_do_not_overlap(tmp_path, num_shards):
+    files = write_shards(tmp_path, num_shards, 24 // num_shards)
+    dataset = StreamingDataset(files, FakeTokenizer())
+
+    # 2 ranks with 2 workers each, one pass over the data
+    seen = []
+    for reader_id in range(4):
+        samples = islice(dataset._samples(reader_id, 4), 6)
+        seen.extend(sample["input_ids"][1] for sample in samples)
+
+    assert sorted(seen) == list(range(100, 124))
+
+
+def test_packing_and_labels(tmp_path):
+    with open(tmp_path / "data.jsonl", "w") as f:
+        f.write(json.dumps({"prompt": "10 11", "response": "12"}) + "\n")
+        f.write(json.dumps({"text": "13 14 15"}) + "\n")
+    dataset = StreamingDataset([str(tmp_path / "data.jsonl")], FakeTokenizer(), chunk_size=4)
+    dataset.set_epoch_length(num_batches=2, batch_size=1)
+
+    samples = list(dataset)
+
+    assert [s["input_ids"] for s in samples] == [[1, 10, 11, 12], [2, 1, 13, 14]]
+    assert samples[0]["labels"] == [-100, -100, -100, 12]
+    assert samples[1]["labels"] == [2, 1, 13, 14]
+    assert dataset.stats["records"] == 2
+    assert set(dataset.get_throughput()) == {"read_records_per_s", "tokenize_tokens_per_s", "pack_samples_per_s"}
+
+
+def test_parquet_shards(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    pq.write_table(pa.table({"text": ["100", "101", "102"]}), tmp_path / "data.parquet")
+    dataset = StreamingDataset(get_shard_files(str(tmp_path / "*.parquet")), FakeTokenizer())
+
+    assert [s["input_ids"] for s in islice(dataset._samples(0, 1), 3)] == [[1, 100, 2], [1, 101, 2], [1, 102, 2]]
+
+
+def test_json_shards(tmp_path):
+    with open(tmp_path / "data.json", "w") as f:
+        json.dump([{"text": "100"}, {"text": "101"}], f, indent=4)
+    dataset = StreamingDataset(get_shard_files(str(tmp_path / "*.json")), FakeTokenizer())
+
+    assert [s["input_ids"] for s in islice(dataset._samples(0, 1), 2)] == [[1, 100, 2], [1, 101, 2]]
+
+
+def test_streaming_dataloader(tmp_path):
+    files = write_shards(tmp_path, 4, 6)
+    train_config = TRAIN_CONFIG()
+    train_config.batching_strategy = "packing"
+    train_config.context_length = 3
+    train_config.batch_size_training = 2
+    train_config.num_workers_dataloader = 2
+    dataset = StreamingDataset(files, FakeTokenizer(), rank=0, world_size=1)
+
+    with pytest.raises(ValueError):
+        get_dataloader_kwargs(train_config, dataset, FakeTokenizer(), "train")
+
+    # the steps of the whole training are split over the epochs
+    train_config.num_epochs = 2
+    train_config.max_train_step = 6
+    kwargs = get_dataloader_kwargs(train_config, dataset, FakeTokenizer(), "train")
+    dataloader = torch.utils.data.DataLoader(dataset, num_workers=train_config.num_workers_dataloader, **kwargs)
+
+    assert len(dataloader) == 3
+    assert dataset.chunk_size == 3
+    epochs = [[batch["input_ids"][:, 1].tolist() for batch in dataloader] for _ in range(2)]
+    assert all(len(epoch) == 3 for epoch in epochs)
+    # the second epoch continues the stream of each worker instead of starting over
+    values = [v for epoch in epochs for batch in epoch for v in batch]
+    assert len(values) == len(set(values)) == 12
+
+
+def test_readers_skip_other_records_without_parsing(tmp_path):
+    with open(tmp_path / "data.jsonl", "w") as f:
+        for i in range(4):
+            # the records of reader 1 would fail to parse
+            f.write(json.dumps({"text": str(100 + i)}) + "\n" + "{not json\n")
+    dataset = StreamingDataset([str(tmp_path / "data.jsonl")], FakeTokenizer())
+
+    assert [s["input_ids"][1] for s in islice(dataset._samples(0, 2), 4)] == [100, 101, 102, 103]
+
+
+def collate_values(samples):
+    return [sample["input_ids"][1] for sample in samples]
+
+
+def test_validation_stream_restarts_every_epoch(tmp_path):
+    files = write_shards(tmp_path, 4, 6)
+    dataset = StreamingDataset(files, FakeTokenizer(), rank=0, world_size=1, restart_each_epoch=True)
+    dataset.set_epoch_length(num_batches=4, batch_size=2)
+    dataloader = torch.utils.data.DataLoader(
+        dataset, batch_size=2, num_workers=2, persistent_workers=True, collate_fn=collate_values
+    )
+
+    epochs = [list(dataloader) for _ in range(2)]
+
+    assert epochs[0] == epochs[1]
+    assert len(epochs[0]) == 4
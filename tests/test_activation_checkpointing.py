@@ -0,0 +1,99 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import pytest
+
+import torch
+from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import CheckpointWrapper
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from llama_recipes.policies import (
+    apply_fsdp_checkpointing,
+    get_layers_to_checkpoint,
+    probe_activation_memory,
+)
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(42)
+    config = LlamaConfig(
+        vocab_size=128,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        use_cache=False,
+    )
+    return LlamaForCausalLM(config)
+
+
+@pytest.fixture
+def batch():
+    input_ids = torch.randint(0, 128, (2, 16))
+    return {"input_ids": input_ids, "labels": input_ids}
+
+
+def checkpointed_layers(model):
+    return [i for i, layer in enumerate(model.model.layers) if isinstance(layer, CheckpointWrapper)]
+
+
+def test_every_k_layers(model):
+    apply_fsdp_checkpointing(model, policy="every_k_layers", interval=2)
+
+    assert checkpointed_layers(model) == [0, 2]
+
+
+@pytest.mark.parametrize("policy, attribute", [("attention", "self_attn"), ("mlp", "mlp")])
+def test_sub_block_policies(model, policy, attribute):
+    apply_fsdp_checkpointing(model, policy=policy)
+
+    assert checkpointed_layers(model) == []
+    assert all(isinstance(getattr(layer, attribute), CheckpointWrapper) for layer in model.model.layers)
+
+
+def test_unknown_policy(model):
+    with pytest.raises(ValueError):
+        apply_fsdp_checkpointing(model, policy="unknown")
+
+
+def test_probe_activation_memory(model, batch):
+    activation_bytes, input_bytes = probe_activation_memory(model, batch)
+
+    assert sorted(activation_bytes) == [0, 1, 2, 3]
+    assert all(input_bytes[i] == 2 * 16 * 32 * 4 for i in range(4))
+    # every layer keeps more than its input for backward
+    assert all(input_bytes[i] < activation_bytes[i] for i in range(4))
+    assert all(p.grad is None for p in model.parameters())
+
+
+def test_get_layers_to_checkpoint():
+    activation_bytes = {i: 100 for i in range(4)}
+    input_bytes = {i: 10 for i in range(4)}
+
+    assert get_layers_to_checkpoint(activation_bytes, input_bytes, 400) == []
+    assert get_layers_to_checkpoint(activation_bytes, input_bytes, 220) == [1, 3]
+    assert get_layers_to_checkpoint(activation_bytes, input_bytes, 130) == [1, 2, 3]
+    assert get_layers_to_checkpoint(activation_bytes, input_bytes, 0) == [0, 1, 2, 3]
+
+
+def test_memory_budget_policy(model, batch):
+    torch.manual_seed(0)
+    ref_loss = model(**batch).loss
+    ref_loss.backward()
+    ref_grads = [p.grad.clone() for p in model.parameters()]
+    model.zero_grad(set_to_none=True)
+
+    activation_bytes, input_bytes = probe_activation_memory(model, batch)
+    budget = activation_bytes[0] + 3 * input_bytes[0]
+    layers_to_checkpoint = get_layers_to_checkpoint(activation_bytes, input_bytes, budget)
+    apply_fsdp_checkpointing(model, policy="memory_budget", layers_to_checkpoint=layers_to_checkpoint)
+
+    assert checkpointed_layers(model) == [1, 2, 3]
+
+    loss = model(**batch).loss
+    loss.backward()
+
+    assert torch.equal(loss, ref_loss)
+    for ref, p in zip(ref_grads, model.parameters()):
+        torch.testing.assert_close(ref, p.grad)
@@ -0,0 +1,221 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import pytest
+
+import torch
+
+from llama_recipes.policies import AnyPrecisionAdamW
+
+
+def make_params(seed=42):
+    torch.manual_seed(seed)
+    return [
+        torch.nn.Parameter(torch.randn(16, 8)),
+        torch.nn.Parameter(torch.randn(8)),
+        torch.nn.Parameter(torch.randn(4, 4, dtype=torch.bfloat16)),
+        torch.nn.Parameter(torch.randn(3)),
+    ]
+
+
+def run_steps(optimizer_kwargs, num_steps=4, seed=42):
+    params = make_params(seed)
+    optimizer = AnyPrecisionAdamW(params, lr=1e-2, **optimizer_kwargs)
+    torch.manual_seed(seed + 1)
+    for _ in range(num_steps):
+        for i, p in enumerate(params):
+            # leave the last parameter without a gradient
+            p.grad = None if i == len(params) - 1 else torch.randn_like(p)
+        optimizer.step()
+    return params, optimizer
+
+
+@pytest.mark.parametrize("use_kahan_summation", [False, True])
+@pytest.mark.parametrize("weight_decay", [0.0, 0.1])
+@pytest.mark.parametrize("momentum_dtype", [torch.float32, torch.bfloat16])
+def test_foreach_matches_single_tensor(use_kahan_summation, weight_decay, momentum_dtype):
+    kwargs = dict(
+        use_kahan_summation=use_kahan_summation,
+        weight_decay=weight_decay,
+        momentum_dtype=momentum_dtype,
+    )
+
+    ref_params, ref_optimizer = run_steps(dict(foreach=False, **kwargs))
+    params, optimizer = run_steps(dict(foreach=True, **kwargs))
+
+    # bf16 parameters and states included, every op rounds like the per-parameter path
+    compare = lambda a, b: torch.equal(a, b)
+
+    for ref, p in zip(ref_params, params):
+        assert compare(ref, p)
+
+    for ref, p in zip(ref_params, params):
+        ref_state, state = ref_optimizer.state[ref], optimizer.state[p]
+        assert ref_state.keys() == state.keys()
+        for key in ref_state:
+            assert compare(ref_state[key].float(), state[key].float())
+
+
+def test_foreach_defaults_to_single_tensor_on_cpu(mocker):
+    single = mocker.patch(
+        "llama_recipes.policies.anyprecision_optimizer._single_tensor_anyprecision_adamw"
+    )
+    multi = mocker.patch(
+        "llama_recipes.policies.anyprecision_optimizer._multi_tensor_anyprecision_adamw"
+    )
+
+    run_steps({}, num_steps=1)
+
+    assert single.call_count == 1
+    assert multi.call_count == 0
+
+
+@pytest.mark.parametrize("use_kahan_summation", [False, True])
+def test_fused_matches_single_tensor(use_kahan_summation):
+    # inductor keeps intermediates in fp32 where the per-parameter path rounds them to
+    # bf16, so only compare fp32 parameters and optimizer states
+    kwargs = dict(
+        use_kahan_summation=use_kahan_summation,
+        weight_decay=0.1,
+        momentum_dtype=torch.float32,
+        variance_dtype=torch.float32,
+        compensation_buffer_dtype=torch.float32,
+    )
+
+    ref_params, ref_optimizer = run_steps(dict(foreach=False, **kwargs), num_steps=3)
+    params, optimizer = run_steps(dict(fused=True, **kwargs), num_steps=3)
+
+    for ref, p in zip(ref_params, params):
+        if p.dtype != torch.float32:
+            continue
+        torch.testing.assert_close(ref, p, rtol=1e-6, atol=1e-7)
+        for key, ref_value in ref_optimizer.state[ref].items():
+            torch.testing.assert_close(ref_value, optimizer.state[p][key], rtol=1e-6, atol=1e-7)
+
+
+def bf16_ulp(t):
+    # spacing of the bf16 numbers at the magnitude of t
+    return torch.exp2(torch.floor(torch.log2(t.float().abs().clamp_min(2.0**-120))) - 7)
+
+
+@pytest.mark.parametrize("use_kahan_summation", [False, True])
+def test_fused_bf16_step_within_documented_bound(use_kahan_summation):
+    from llama_recipes.policies.anyprecision_optimizer import (
+        _fused_anyprecision_adamw,
+        _single_tensor_anyprecision_adamw,
+    )
+
+    torch.manual_seed(0)
+    param = torch.randn(4096, dtype=torch.bfloat16)
+    grad = torch.randn(4096, dtype=torch.bfloat16)
+    states = [
+        torch.randn(4096, dtype=torch.bfloat16) * 0.1,
+        (torch.rand(4096) * 1e-2).to(torch.bfloat16),
+        (torch.randn(4096) * 1e-4).to(torch.bfloat16),
+    ]
+    step, lr, beta1, beta2, eps = 3, 1e-2, 0.9, 0.999, 1e-8
+
+    results = []
+    for update in [_single_tensor_anyprecision_adamw, _fused_anyprecision_adamw]:
+        p = param.clone()
+        exp_avg, exp_avg_sq, compensation = [state.clone() for state in states]
+        update(
+            [p],
+            [grad],
+            [exp_avg],
+            [exp_avg_sq],
+            [compensation],
+            [torch.tensor(step - 1.0)],
+            beta1=beta1,
+            beta2=beta2,
+            lr=lr,
+            weight_decay=0.1,
+            eps=eps,
+            use_kahan_summation=use_kahan_summation,
+        )
+        weights = p.float() + compensation.float() if use_kahan_summation else p.float()
+        results.append((weights, exp_avg.float(), exp_avg_sq.float()))
+    (ref_weights, ref_exp_avg, ref_exp_avg_sq), (weights, exp_avg, exp_avg_sq) = results
+
+    # the bound documented for fused in AnyPrecisionAdamW
+    exp_avg_error = (ref_exp_avg - exp_avg).abs()
+    grad = grad.float()
+    assert (exp_avg_error <= bf16_ulp(torch.maximum(states[0].float().abs(), grad.abs()))).all()
+    assert ((ref_exp_avg_sq - exp_avg_sq).abs() <= bf16_ulp(torch.maximum(states[1].float(), grad**2))).all()
+
+    step_size = lr / (1 - beta1**step)
+    denom = exp_avg_sq.sqrt() / (1 - beta2**step) ** 0.5 + eps
+    weights_bound = bf16_ulp(torch.maximum(param.float().abs(), ref_weights.abs())) + step_size * (
+        exp_avg_error + 2**-6 * exp_avg.abs()
+    ) / denom
+    assert ((ref_weights - weights).abs() <= weights_bound).all()
+
+
+def test_fused_compiles_one_graph():
+    from torch._dynamo.utils import counters
+
+    torch._dynamo.reset()
+    counters.clear()
+    params = [torch.nn.Parameter(torch.randn(*shape)) for shape in [(5,), (7, 3), (9,), (2, 2, 2)]]
+    optimizer = AnyPrecisionAdamW(params, weight_decay=0.1, momentum_dtype=torch.float32, fused=True)
+    for step in range(3):
+        for p in params:
+            p.grad = torch.randn_like(p)
+        # a learning rate schedule changes the scalars of every step
+        optimizer.param_groups[0]["lr"] = 1e-3 * (step + 1)
+        optimizer.step()
+
+    # the graph updates a single parameter and is shared by all shapes and steps
+    assert counters["stats"]["unique_graphs"] == 1
+
+
+def test_quantized_state_roundtrip():
+    from llama_recipes.policies.anyprecision_optimizer import (
+        _dequantize_blockwise,
+        _dynamic_map,
+        _quantize_blockwise,
+    )
+
+    torch.manual_seed(0)
+    values = torch.randn(5000) * torch.logspace(-4, 0, 5000)
+    codes = torch.zeros_like(values, dtype=torch.uint8)
+    absmax = torch.zeros(3)
+    code_book = _dynamic_map(True, values.device)
+
+    _quantize_blockwise(values, codes, absmax, code_book, 2048)
+    restored = _dequantize_blockwise(codes, absmax, code_book, 2048)
+
+    assert torch.equal(absmax[0], values[:2048].abs().max())
+    # the dynamic map keeps the relative error small over several orders of magnitude
+    relative_error = (restored - values).abs() / absmax.repeat_interleave(2048)[:5000]
+    assert relative_error.max() < 0.01
+
+
+def test_quantized_state_follows_full_precision():
+    torch.manual_seed(0)
+    target = torch.randn(64, 64)
+    data = torch.randn(256, 64)
+
+    def train(**optimizer_kwargs):
+        torch.manual_seed(1)
+        model = torch.nn.Linear(64, 64)
+        optimizer = AnyPrecisionAdamW(model.parameters(), lr=1e-2, **optimizer_kwargs)
+        for _ in range(30):
+            optimizer.zero_grad()
+            loss = torch.nn.functional.mse_loss(model(data), data @ target)
+            loss.backward()
+            optimizer.step()
+        return model, optimizer, loss.item()
+
+    _, _, ref_loss = train(momentum_dtype=torch.float32, variance_dtype=torch.float32)
+    model, optimizer, loss = train(quantize_state=True, block_size=256)
+
+    weight_state = optimizer.state[model.weight]
+    assert weight_state["exp_avg"].dtype == torch.uint8
+    assert weight_state["exp_avg_sq"].dtype == torch.uint8
+    assert weight_state["exp_avg_absmax"].shape == (16,)
+
+    # parameters smaller than one block keep regular states
+    assert optimizer.state[model.bias]["exp_avg"].dtype == torch.bfloat16
+
+    assert loss == pytest.approx(ref_loss, rel=0.1)
@@ -17,8 +17,8 @@ EXPECTED_SAMPLE_NUMBER ={
 
 @pytest.mark.skip_missing_tokenizer
 @patch('llama_recipes.finetuning.train')
-@patch('llama_recipes.finetuning.AutoTokenizer')
-@patch('llama_recipes.finetuning.LlamaForCausalLM.from_pretrained')
+@patch('transformers.AutoTokenizer')
+@patch('transformers.LlamaForCausalLM.from_pretrained')
 @patch('llama_recipes.finetuning.optim.AdamW')
 @patch('llama_recipes.finetuning.StepLR')
 def test_packing(step_lr, optimizer, get_model, tokenizer, train, setup_tokenizer, llama_version):
@@ -59,8 +59,8 @@ def test_packing(step_lr, optimizer, get_model, tokenizer, train, setup_tokenize
 
 @pytest.mark.skip_missing_tokenizer
 @patch('llama_recipes.finetuning.train')
-@patch('llama_recipes.finetuning.AutoTokenizer')
-@patch('llama_recipes.finetuning.LlamaForCausalLM.from_pretrained')
+@patch('transformers.AutoTokenizer')
+@patch('transformers.LlamaForCausalLM.from_pretrained')
 @patch('llama_recipes.finetuning.optim.AdamW')
 @patch('llama_recipes.finetuning.StepLR')
 @patch('llama_recipes.finetuning.setup')
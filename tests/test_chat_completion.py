@@ -112,6 +112,8 @@ def test_chat_completion(
         "prompt_file": (CHAT_COMPLETION_DIR / "chats.json").as_posix(),
     }
 
+    load_model.return_value.generate.side_effect = lambda input_ids, **kwargs: torch.cat([input_ids, input_ids[:, -1:]], dim=1)
+
     main(llama_version, **kwargs)
 
     dialogs = read_dialogs_from_file(kwargs["prompt_file"])
@@ -123,33 +125,22 @@ def test_chat_completion(
 
     REF_RESULT = format_tokens(dialogs, llama_tokenizer[llama_version])
 
-    assert all(
-        (
-            load_model.return_value.generate.mock_calls[0 * 4][2]["input_ids"].cpu()
-            == torch.tensor(REF_RESULT[0]).long()
-        ).tolist()
-    )
-    assert all(
-        (
-            load_model.return_value.generate.mock_calls[1 * 4][2]["input_ids"].cpu()
-            == torch.tensor(REF_RESULT[1]).long()
-        ).tolist()
-    )
-    assert all(
-        (
-            load_model.return_value.generate.mock_calls[2 * 4][2]["input_ids"].cpu()
-            == torch.tensor(REF_RESULT[2]).long()
-        ).tolist()
-    )
-    assert all(
-        (
-            load_model.return_value.generate.mock_calls[3 * 4][2]["input_ids"].cpu()
-            == torch.tensor(REF_RESULT[3]).long()
-        ).tolist()
-    )
-    assert all(
-        (
-            load_model.return_value.generate.mock_calls[4 * 4][2]["input_ids"].cpu()
-            == torch.tensor(REF_RESULT[4]).long()
-        ).tolist()
-    )
+    # one dialog per generate call by default, the longest dialog first
+    input_ids = [call.kwargs["input_ids"].cpu() for call in load_model.return_value.generate.call_args_list]
+    assert len(input_ids) == len(REF_RESULT)
+    expected = sorted(REF_RESULT, key=len, reverse=True)
+    for tokens, ref in zip(input_ids, expected):
+        assert tokens.tolist() == [ref]
+
+
+def test_group_by_length_and_left_pad():
+    from llama_recipes.inference.chat_utils import group_by_length, left_pad
+
+    chats = [[1, 2], [3, 4, 5, 6], [7], [8, 9, 10]]
+
+    groups = group_by_length(chats, 2)
+    input_ids, attention_mask = left_pad([chats[i] for i in groups[1]], pad_token_id=0)
+
+    assert groups == [[1, 3], [0, 2]]
+    assert input_ids.tolist() == [[1, 2], [0, 7]]
+    assert attention_mask.tolist() == [[1, 1], [0, 1]]
@@ -0,0 +1,47 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import torch
+from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import CheckpointWrapper
+from peft import LoraConfig, get_peft_model
+from transformers import LlamaConfig, LlamaForCausalLM
+from transformers.models.llama.modeling_llama import LlamaDecoderLayer
+
+from llama_recipes.policies import apply_fsdp_checkpointing, apply_regional_compile
+
+
+def test_regional_compile_with_peft_and_checkpointing():
+    torch.manual_seed(42)
+    config = LlamaConfig(
+        vocab_size=128,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=1,
+        num_attention_heads=4,
+        use_cache=False,
+    )
+    model = LlamaForCausalLM(config)
+    model = get_peft_model(model, LoraConfig(r=4, target_modules=["q_proj", "v_proj"], init_lora_weights=False))
+
+    input_ids = torch.randint(0, 128, (2, 16))
+    ref_loss = model(input_ids=input_ids, labels=input_ids).loss
+    ref_loss.backward()
+    ref_grads = [p.grad.clone() for p in model.parameters() if p.requires_grad]
+    model.zero_grad(set_to_none=True)
+
+    apply_fsdp_checkpointing(model)
+    apply_regional_compile(model, dynamic=True, backend="inductor")
+
+    # the layer is compiled together with its activation checkpointing wrapper
+    wrappers = [m for m in model.modules() if isinstance(m, CheckpointWrapper)]
+    assert len(wrappers) == 1
+    assert isinstance(wrappers[0]._checkpoint_wrapped_module, LlamaDecoderLayer)
+    assert wrappers[0]._compiled_call_impl is not None
+
+    loss = model(input_ids=input_ids, labels=input_ids).loss
+    loss.backward()
+
+    torch.testing.assert_close(loss, ref_loss)
+    grads = [p.grad for p in model.parameters() if p.requires_grad]
+    for ref, grad in zip(ref_grads, grads):
+        torch.testing.assert_close(ref, grad)
@@ -0,0 +1,127 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import dataclasses
+import json
+
+import pytest
+from torch.distributed.fsdp import ShardingStrategy
+
+from llama_recipes.configs import fsdp_config as FSDP_CONFIG
+from llama_recipes.configs import lora_config as LORA_CONFIG
+from llama_recipes.configs import train_config as TRAIN_CONFIG
+from llama_recipes.utils.config_utils import (
+    generate_dataset_config,
+    load_config_files,
+    resolve_config,
+    update_config,
+)
+
+
+def test_update_config_coerces_types():
+    train_config, fsdp_config = TRAIN_CONFIG(), FSDP_CONFIG()
+
+    update_config(
+        (train_config, fsdp_config),
+        batch_size_training="8",
+        lr=1,
+        enable_fsdp="true",
+        sharding_strategy="SHARD_GRAD_OP",
+        dataset="alpaca_dataset",
+        **{"fsdp_config.pure_bf16": "1"},
+    )
+
+    assert train_config.batch_size_training == 8
+    assert train_config.lr == 1.0 and isinstance(train_config.lr, float)
+    assert train_config.enable_fsdp is True
+    assert train_config.dataset == "alpaca_dataset"
+    assert fsdp_config.sharding_strategy == ShardingStrategy.SHARD_GRAD_OP
+    assert fsdp_config.pure_bf16 is True
+
+    lora_config = LORA_CONFIG()
+    update_config(lora_config, target_modules="q_proj,k_proj")
+    assert lora_config.target_modules == ["q_proj", "k_proj"]
+
+
+@pytest.mark.parametrize("kwargs", [{"batch_size_training": "eight"}, {"sharding_strategy": "SHARDED"}, {"use_peft": "maybe"}])
+def test_update_config_invalid_values(kwargs):
+    with pytest.raises(ValueError):
+        update_config((TRAIN_CONFIG(), FSDP_CONFIG()), **kwargs)
+
+
+def test_update_config_reports_typos():
+    with pytest.warns(UserWarning) as record:
+        update_config((TRAIN_CONFIG(), FSDP_CONFIG()), pure_bf16=True, batch_size_trainig=2, **{"fsdp_confg.use_fp16": True})
+
+    messages = [str(w.message) for w in record]
+    # fsdp parameters are known, even though train_config does not accept them
+    assert not any("pure_bf16" in m for m in messages)
+    assert "Unknown parameter batch_size_trainig, did you mean batch_size_training?" in messages
+    assert "Unknown parameter fsdp_confg.use_fp16, did you mean fsdp_config?" in messages
+
+    with pytest.warns(UserWarning, match="Unknown parameter lora_rank"):
+        update_config(LORA_CONFIG(), lora_rank=16)
+
+    with pytest.raises(ValueError, match="fsdp_config does not accept parameter: fsdp_config.pure_bf17"):
+        update_config((TRAIN_CONFIG(), FSDP_CONFIG()), **{"fsdp_config.pure_bf17": True})
+
+
+def test_update_config_dataset_and_bias():
+    train_config, lora_config = TRAIN_CONFIG(), LORA_CONFIG()
+
+    update_config((train_config, lora_config), dataset="grammar_dataset", bias="lora_only")
+
+    assert train_config.dataset == "grammar_dataset"
+    assert lora_config.bias == "lora_only"
+
+
+def test_unannotated_config_attributes_are_rejected():
+    @dataclasses.dataclass
+    class some_config:
+        annotated: int = 1
+        unannotated = "ignored"
+
+    with pytest.raises(TypeError, match="unannotated"):
+        update_config(some_config(), unannotated="set")
+
+
+def test_load_config_files(tmp_path):
+    yaml_file = tmp_path / "base.yaml"
+    yaml_file.write_text("batch_size_training: 2\nlr: 0.001\nfsdp_config:\n  pure_bf16: true\n")
+    json_file = tmp_path / "override.json"
+    json_file.write_text(json.dumps({"batch_size_training": 4, "fsdp_config": {"sharding_strategy": "NO_SHARD"}}))
+
+    kwargs = load_config_files({"config_file": f"{yaml_file},{json_file}", "lr": 0.01})
+
+    assert kwargs == {
+        "batch_size_training": 4,
+        "lr": 0.01,
+        "fsdp_config.pure_bf16": True,
+        "fsdp_config.sharding_strategy": "NO_SHARD",
+    }
+
+    train_config, fsdp_config = TRAIN_CONFIG(), FSDP_CONFIG()
+    update_config((train_config, fsdp_config), **kwargs)
+    assert train_config.batch_size_training == 4
+    assert fsdp_config.pure_bf16
+    assert fsdp_config.sharding_strategy == ShardingStrategy.NO_SHARD
+
+    with pytest.raises(FileNotFoundError):
+        load_config_files({"config_file": str(tmp_path / "missing.yaml")})
+
+
+def test_resolve_config():
+    train_config, fsdp_config = TRAIN_CONFIG(), FSDP_CONFIG()
+    dataset_config = generate_dataset_config(train_config, {})
+
+    resolved = resolve_config(train_config, fsdp_config, dataset_config)
+
+    assert resolved == resolve_config(TRAIN_CONFIG(), FSDP_CONFIG(), dataset_config)
+    assert hash(resolved) == hash(resolve_config(TRAIN_CONFIG(), FSDP_CONFIG(), dataset_config))
+    assert resolved["fsdp_config"]["sharding_strategy"] == "FULL_SHARD"
+    assert resolved["samsum_dataset"]["train_split"] == "train"
+    with pytest.raises(AttributeError):
+        resolved.configs = ()
+
+    fsdp_config.sharding_strategy = ShardingStrategy.SHARD_GRAD_OP
+    assert resolve_config(train_config, fsdp_config, dataset_config).hash != resolved.hash
@@ -2,6 +2,9 @@
 # This software may be used and distributed according to the terms of the Llama Guard Community License Agreement.
 
 from enum import Enum
+import json
+import os
+import tempfile
 import unittest
 from typing import Optional, List
 
@@ -12,9 +15,11 @@ from llama_recipes.data.llama_guard.finetuning_data_formatter import (
     ExplanationPosition,
     FormatterConfigs,
     Guidelines,
+    iter_formatted_finetuning_examples,
     LlamaGuardGenerationConfigs,
     LlamaGuardPromptConfigs,
     TrainingExample,
+    write_formatted_finetuning_examples,
 )
 
 
@@ -481,3 +486,37 @@ Provide your safety assessment for AgentType.AGENT in the above conversation:
             AgentType.AGENT,
             formatter_configs,
         )
+
+    def test_parallel_formatting_matches_serial(self) -> None:
+        formatter_configs = (
+            FinetuningDataFormatterTests.create_most_conservative_formatter_configs(AgentType.AGENT)
+        )
+        formatter_configs.augmentation_configs.should_add_examples_with_dropped_nonviolated_prompt_categories = True
+        formatter_configs.augmentation_configs.should_add_examples_with_dropped_violated_and_nonviolated_prompt_categories = True
+        formatter_configs.llama_guard_prompt_configs.should_shuffle_category_codes = True
+
+        training_examples = [
+            TrainingExample(
+                prompt=f"Prompt {i}",
+                response=f"Response {i}",
+                violated_category_codes=["O2", "O4"] if i % 2 else [],
+                label="unsafe" if i % 2 else "safe",
+                explanation=f"Explanation {i}",
+            )
+            for i in range(20)
+        ]
+
+        serial = list(iter_formatted_finetuning_examples(training_examples, formatter_configs))
+
+        # the original and one augmentation for safe examples, one more for unsafe examples
+        assert len(serial) == 50
+        assert create_formatted_finetuning_examples(training_examples, formatter_configs) == serial
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_path = os.path.join(tmp_dir, "formatted.jsonl")
+            count = write_formatted_finetuning_examples(training_examples, formatter_configs, output_path)
+            with open(output_path) as f:
+                records = [json.loads(line) for line in f]
+
+        assert count == 50
+        assert [record["text"] for record in records] == serial
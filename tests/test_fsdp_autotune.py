@@ -0,0 +1,152 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import json
+
+from torch.distributed.fsdp import ShardingStrategy
+
+from llama_recipes.configs import fsdp_config as FSDP_CONFIG
+from llama_recipes.configs import train_config as TRAIN_CONFIG
+from llama_recipes.utils.fsdp_autotune import autotune_fsdp_config, get_autotune_key, greedy_search
+
+
+STEP_TIMES = {
+    ("wrapping_granularity", "block"): -0.1,
+    ("backward_prefetch", "BACKWARD_POST"): 0.2,
+    ("forward_prefetch", True): -0.05,
+    ("sharding_strategy", "SHARD_GRAD_OP"): -0.2,
+}
+
+
+def fake_benchmark(settings):
+    return 1.0 + sum(STEP_TIMES.get(item, 0.0) for item in settings.items())
+
+
+def test_greedy_search():
+    search_space = {"a": [1, 2, 3], "b": [False, True]}
+    times = {(1, False): 3.0, (2, False): 2.0, (3, False): 2.5, (2, True): 1.0, (1, True): 0.5}
+    calls = []
+
+    def benchmark(settings):
+        calls.append(settings)
+        return times[(settings["a"], settings["b"])]
+
+    best, best_time, measurements = greedy_search({"a": 1, "b": False}, search_space, benchmark)
+
+    # one setting at a time, (1, True) is never visited
+    assert best == {"a": 2, "b": True}
+    assert best_time == 1.0
+    assert len(calls) == len(measurements) == 4
+
+
+def test_autotune_fsdp_config(tmp_path, mocker):
+    train_config = TRAIN_CONFIG()
+    fsdp_config = FSDP_CONFIG()
+    fsdp_config.autotune_results_file = str(tmp_path / "results.json")
+    benchmark = mocker.MagicMock(side_effect=fake_benchmark)
+
+    best = autotune_fsdp_config(train_config, fsdp_config, rank=0, local_rank=0, benchmark_fn=benchmark)
+
+    assert best == {
+        "wrapping_granularity": "block",
+        "backward_prefetch": "BACKWARD_PRE",
+        "forward_prefetch": True,
+        "limit_all_gathers": True,
+        "sharding_strategy": "SHARD_GRAD_OP",
+    }
+    assert fsdp_config.wrapping_granularity == "block"
+    assert fsdp_config.forward_prefetch
+    assert fsdp_config.sharding_strategy == ShardingStrategy.SHARD_GRAD_OP
+
+    with open(fsdp_config.autotune_results_file) as f:
+        results = json.load(f)
+    assert len(results) == 1
+    assert len(next(iter(results.values()))["measurements"]) == benchmark.call_count
+
+    # the same setup reuses the stored result without benchmarking
+    benchmark.reset_mock()
+    fsdp_config = FSDP_CONFIG()
+    fsdp_config.autotune_results_file = str(tmp_path / "results.json")
+    assert autotune_fsdp_config(train_config, fsdp_config, rank=0, local_rank=0, benchmark_fn=benchmark) == best
+    assert benchmark.call_count == 0
+    assert fsdp_config.sharding_strategy == ShardingStrategy.SHARD_GRAD_OP
+
+    # a different setup is tuned again
+    train_config.context_length = 1024
+    autotune_fsdp_config(train_config, fsdp_config, rank=0, local_rank=0, benchmark_fn=benchmark)
+    assert benchmark.call_count > 0
+
+
+def _check_failure_flag(rank, init_file, results):
+    import torch
+    import torch.distributed as dist
+
+    from llama_recipes.utils.fsdp_autotune import _failed_on_any_rank
+
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=2)
+
+    def out_of_memory_on_rank_1():
+        if rank == 1:
+            raise torch.cuda.OutOfMemoryError("out of memory")
+
+    results[rank] = (
+        _failed_on_any_rank(out_of_memory_on_rank_1, torch.device("cpu")),
+        _failed_on_any_rank(lambda: None, torch.device("cpu")),
+    )
+    dist.destroy_process_group()
+
+
+def test_failure_on_one_rank_is_seen_by_all(tmp_path):
+    import torch.multiprocessing as mp
+
+    results = mp.Manager().dict()
+    mp.spawn(_check_failure_flag, args=(str(tmp_path / "init"), results), nprocs=2)
+
+    assert dict(results) == {0: (True, False), 1: (True, False)}
+
+
+def _autotune_with_rank_files(rank, init_file, results_files, results):
+    import torch.distributed as dist
+
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=2)
+    train_config = TRAIN_CONFIG()
+    fsdp_config = FSDP_CONFIG()
+    fsdp_config.autotune_results_file = results_files[rank]
+    calls = []
+
+    def benchmark(settings):
+        calls.append(settings)
+        return fake_benchmark(settings)
+
+    best = autotune_fsdp_config(train_config, fsdp_config, rank=rank, local_rank=rank, benchmark_fn=benchmark)
+    results[rank] = (best, len(calls))
+    # rank 0 only sends, it waits for rank 1 before the file store goes away
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+def test_autotune_ranks_follow_rank_0_results_file(tmp_path):
+    import torch.multiprocessing as mp
+
+    best = {
+        "wrapping_granularity": "block",
+        "backward_prefetch": "NONE",
+        "forward_prefetch": False,
+        "limit_all_gathers": False,
+        "sharding_strategy": "SHARD_GRAD_OP",
+    }
+    cached_file, missing_file = str(tmp_path / "cached.json"), str(tmp_path / "missing.json")
+    with open(cached_file, "w") as f:
+        json.dump({get_autotune_key(TRAIN_CONFIG(), FSDP_CONFIG(), 2): {"best_settings": best}}, f)
+
+    with mp.Manager() as manager:
+        results = manager.dict()
+        # only rank 0 sees the stored result, rank 1 runs on a node without the file
+        mp.spawn(_autotune_with_rank_files, args=(str(tmp_path / "init_cached"), [cached_file, missing_file], results), nprocs=2)
+        assert dict(results) == {0: (best, 0), 1: (best, 0)}
+
+        # only rank 1 sees a stored result, both ranks benchmark together as rank 0 has none
+        results.clear()
+        mp.spawn(_autotune_with_rank_files, args=(str(tmp_path / "init_missing"), [missing_file, cached_file], results), nprocs=2)
+        assert results[0] == results[1]
+        assert results[0][0] != best and results[0][1] > 0
@@ -0,0 +1,109 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import pytest
+
+import torch
+from accelerate import init_empty_weights
+from peft import LoraConfig, get_peft_model
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from llama_recipes.utils.fsdp_utils import get_safetensors_param_init_fn
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    torch.manual_seed(42)
+    config = LlamaConfig(
+        vocab_size=128,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        use_cache=False,
+    )
+    LlamaForCausalLM(config).save_pretrained(tmp_path, max_shard_size="20KB", safe_serialization=True)
+    return tmp_path
+
+
+def init_from_checkpoint(model, checkpoint):
+    param_init_fn = get_safetensors_param_init_fn(model, checkpoint, torch.device("cpu"))
+    # FSDP calls the function for the modules of each unit, parents first
+    for module in model.modules():
+        param_init_fn(module)
+
+
+def test_safetensors_param_init_fn(checkpoint):
+    assert (checkpoint / "model.safetensors.index.json").is_file()
+    reference = LlamaForCausalLM.from_pretrained(checkpoint)
+
+    config = LlamaConfig.from_pretrained(checkpoint)
+    with init_empty_weights(include_buffers=False):
+        model = LlamaForCausalLM(config)
+    init_from_checkpoint(model, checkpoint)
+
+    assert not any(p.is_meta for p in model.parameters())
+    reference_state_dict = reference.state_dict()
+    for name, tensor in model.state_dict().items():
+        assert torch.equal(tensor, reference_state_dict[name]), name
+
+
+def test_safetensors_param_init_fn_peft_and_resized_embeddings(checkpoint):
+    reference = LlamaForCausalLM.from_pretrained(checkpoint)
+
+    config = LlamaConfig.from_pretrained(checkpoint)
+    with init_empty_weights(include_buffers=False):
+        model = LlamaForCausalLM(config)
+        model.resize_token_embeddings(136)
+        model = get_peft_model(model, LoraConfig(r=4, target_modules=["q_proj", "v_proj"]))
+    init_from_checkpoint(model, checkpoint)
+
+    assert not any(p.is_meta for p in model.parameters())
+    base_model = model.base_model.model
+    embeddings = base_model.model.embed_tokens.weight
+    assert torch.equal(embeddings[:128], reference.model.embed_tokens.weight)
+    assert embeddings[128:].abs().sum() > 0
+    q_proj = base_model.model.layers[0].self_attn.q_proj
+    assert torch.equal(q_proj.base_layer.weight, reference.model.layers[0].self_attn.q_proj.weight)
+    assert torch.all(q_proj.lora_B["default"].weight == 0)
+    assert q_proj.lora_A["default"].weight.abs().sum() > 0
+
+
+@pytest.mark.parametrize("local_rank", ["0", "1"])
+def test_hub_checkpoint_is_downloaded_once_per_node(checkpoint, local_rank, monkeypatch, mocker):
+    monkeypatch.setenv("LOCAL_RANK", local_rank)
+    snapshot_download = mocker.patch("huggingface_hub.snapshot_download", return_value=str(checkpoint))
+    with init_empty_weights(include_buffers=False):
+        model = LlamaForCausalLM(LlamaConfig.from_pretrained(checkpoint))
+
+    get_safetensors_param_init_fn(model, "some-org/some-model", torch.device("cpu"))
+
+    downloads = [c for c in snapshot_download.call_args_list if not c.kwargs.get("local_files_only")]
+    assert len(downloads) == (1 if local_rank == "0" else 0)
+    snapshot_download.assert_called_with("some-org/some-model", local_files_only=True, allow_patterns=["*.safetensors", "*.json"])
+
+
+def _init_lora_on_rank(rank, checkpoint, results):
+    torch.manual_seed(42)
+    # the ranks used different amounts of randomness before the model is materialized
+    torch.rand(rank + 1)
+
+    config = LlamaConfig.from_pretrained(checkpoint)
+    with init_empty_weights(include_buffers=False):
+        model = get_peft_model(LlamaForCausalLM(config), LoraConfig(r=4, target_modules=["q_proj", "v_proj"]))
+    init_from_checkpoint(model, checkpoint)
+
+    results[rank] = {name: tensor for name, tensor in model.state_dict().items() if ".lora_A." in name}
+
+
+def test_safetensors_param_init_fn_lora_is_equal_across_ranks(checkpoint):
+    import torch.multiprocessing as mp
+
+    with mp.Manager() as manager:
+        results = manager.dict()
+        mp.spawn(_init_lora_on_rank, args=(checkpoint, results), nprocs=2)
+        lora_a = dict(results)
+
+    assert lora_a[0].keys() == lora_a[1].keys() and len(lora_a[0]) == 4
+    for name, tensor in lora_a[0].items():
+        assert torch.equal(tensor, lora_a[1][name]), name
@@ -0,0 +1,198 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import json
+import threading
+import urllib.request
+from pathlib import Path
+
+import pytest
+import torch
+from transformers import AutoTokenizer, LlamaConfig, LlamaForCausalLM
+
+from llama_recipes.inference import generation_utils
+from llama_recipes.inference.generation_server import GenerationServer
+from llama_recipes.inference.generation_utils import ContinuousBatchingEngine, GenerationService, PrefixCache, SamplingParams
+
+TOKENIZER_DIR = Path(__file__).parents[1] / "recipes/benchmarks/inference_throughput/tokenizer"
+
+
+@pytest.fixture
+def tiny_llama():
+    torch.manual_seed(0)
+    tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_DIR)
+    config = LlamaConfig(
+        vocab_size=tokenizer.vocab_size,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+    )
+    return LlamaForCausalLM(config), tokenizer
+
+
+def test_generation_service(tiny_llama):
+    model, tokenizer = tiny_llama
+    service = GenerationService(model, tokenizer, seed=42, max_new_tokens=5, do_sample=False)
+
+    result = service.generate("Hello there")
+    batch_results = service.generate_batch(["Hi", "Hello there"])
+
+    assert result.prompt_tokens == len(tokenizer("Hello there")["input_ids"])
+    assert result.new_tokens == 5
+    assert 0 < result.time_to_first_token <= result.latency
+    assert result.tokens_per_second > 0
+    # the prompts are padded to the longest prompt on the left, which does not change the completion
+    assert batch_results[1].text == result.text
+    assert batch_results[0].prompt_tokens < batch_results[1].prompt_tokens
+    assert service.generate("Hello there", max_new_tokens=2).new_tokens == 2
+
+
+def test_generation_service_loads_once(mocker, tiny_llama):
+    model, tokenizer = tiny_llama
+    load_model = mocker.patch.object(generation_utils, "load_model", return_value=model)
+    mocker.patch("transformers.AutoTokenizer.from_pretrained", return_value=tokenizer)
+    generate = mocker.spy(model, "generate")
+
+    service = GenerationService.from_pretrained("tiny-llama", warm_up=True, max_new_tokens=3)
+    for prompt in ["Hi", "Hello"]:
+        service.generate(prompt)
+
+    assert load_model.call_count == 1
+    assert generate.call_count == 3
+    assert generate.call_args.kwargs["max_new_tokens"] == 3
+
+
+def test_continuous_batching_matches_generate(tiny_llama):
+    model, tokenizer = tiny_llama
+    service = GenerationService(model, tokenizer, do_sample=False)
+    prompts = ["Hello there", "Hi", "A much longer prompt than the other prompts", "x y z"]
+    max_new_tokens = [12, 3, 7, 20]
+    expected = [service.generate(prompt, max_new_tokens=n).text for prompt, n in zip(prompts, max_new_tokens)]
+
+    # two slots for four requests, the short requests leave the batch early and the queued ones join it
+    engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=2).start()
+    requests = [
+        engine.submit(tokenizer(prompt)["input_ids"], SamplingParams(max_new_tokens=n, temperature=0))
+        for prompt, n in zip(prompts, max_new_tokens)
+    ]
+    assert all(request.wait(timeout=30) for request in requests)
+    engine.stop()
+
+    assert [tokenizer.decode(request.output_ids, skip_special_tokens=True) for request in requests] == expected
+    assert [len(request.output_ids) for request in requests] == max_new_tokens
+    metrics = engine.get_metrics()
+    assert metrics["completed"] == 4
+    assert metrics["generated_tokens"] == sum(max_new_tokens)
+    assert 0 < metrics["time_to_first_token_p50"] <= metrics["latency_p99"]
+
+
+def _post(url, body):
+    request = urllib.request.Request(url, json.dumps(body).encode(), {"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return response.read().decode()
+
+
+def test_generation_server(tiny_llama):
+    model, tokenizer = tiny_llama
+    engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=4).start()
+    server = GenerationServer(("127.0.0.1", 0), engine, default_params=SamplingParams(max_new_tokens=4, temperature=0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        completion = json.loads(_post(f"{url}/v1/completions", {"prompt": "Hello there", "max_tokens": 6}))
+        chat = json.loads(_post(f"{url}/v1/chat/completions", {"messages": [{"role": "user", "content": "Hi"}]}))
+        stream = _post(f"{url}/v1/completions", {"prompt": "Hello there", "max_tokens": 6, "stream": True})
+        with urllib.request.urlopen(f"{url}/metrics", timeout=30) as response:
+            metrics = json.loads(response.read())
+    finally:
+        server.shutdown()
+        server.server_close()
+        engine.stop()
+
+    assert completion["usage"]["completion_tokens"] == 6
+    assert completion["choices"][0]["finish_reason"] == "length"
+    assert chat["choices"][0]["message"]["role"] == "assistant"
+    assert chat["usage"]["completion_tokens"] == 4
+    chunks = [line[len("data: "):] for line in stream.split("\n\n") if line]
+    assert chunks[-1] == "[DONE]"
+    streamed_text = "".join(json.loads(chunk)["choices"][0]["text"] for chunk in chunks[:-1])
+    assert streamed_text == completion["choices"][0]["text"]
+    assert metrics["completed"] == 3
+    assert metrics["queue_depth"] == 0
+
+
+def test_prefix_cache(tiny_llama):
+    model, tokenizer = tiny_llama
+    system_prompt = "You are a helpful, respectful and honest assistant. " * 4
+    prompts = [system_prompt + question for question in ["What is 1 + 1?", "Name a color.", "Say hi."]]
+    service = GenerationService(model, tokenizer, max_new_tokens=6, do_sample=False)
+    expected = [service.generate(prompt).text for prompt in prompts]
+
+    prefix_cache = PrefixCache(model, min_prefix_length=16)
+    cached_service = GenerationService(model, tokenizer, max_new_tokens=6, do_sample=False, prefix_cache=prefix_cache)
+
+    # the shared system prompt is detected with the second prompt, the generation resumes from its keys and values
+    assert [cached_service.generate(prompt).text for prompt in prompts] == expected
+    metrics = prefix_cache.get_metrics()
+    assert metrics["hits"] == 2
+    assert metrics["prefixes"] == 1
+    assert metrics["reused_tokens"] >= 2 * len(tokenizer(system_prompt)["input_ids"]) - 2
+
+    engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=2, prefix_cache=prefix_cache).start()
+    requests = [engine.submit(tokenizer(prompt)["input_ids"], SamplingParams(max_new_tokens=6, temperature=0)) for prompt in prompts]
+    assert all(request.wait(timeout=30) for request in requests)
+    engine.stop()
+    assert [tokenizer.decode(request.output_ids, skip_special_tokens=True) for request in requests] == expected
+    assert prefix_cache.get_metrics()["hits"] == 5
+
+
+def test_prefix_cache_eviction(tiny_llama):
+    model, tokenizer = tiny_llama
+    prefix_cache = PrefixCache(model)
+    first = prefix_cache.register(list(range(1, 11)))
+    prefix_bytes = prefix_cache.get_metrics()["memory_bytes"]
+    prefix_cache.max_memory_bytes = 2 * prefix_bytes
+
+    prefix_cache.register(list(range(11, 21)))
+    prefix_cache.lookup(list(range(1, 12)))
+    prefix_cache.register(list(range(21, 31)))
+
+    # the least recently used prefix is evicted to stay within the memory cap
+    assert prefix_cache.get_metrics()["prefixes"] == 2
+    assert prefix_cache.get_metrics()["memory_bytes"] == 2 * prefix_bytes
+    assert prefix_cache.lookup(list(range(11, 22))) == (0, None)
+    length, past_key_values = prefix_cache.lookup(list(range(1, 12)))
+    assert length == 10 and past_key_values is first
+    # a prompt is never fully cached, its last token is computed for the next token logits
+    assert prefix_cache.lookup(list(range(1, 11))) == (0, None)
+
+
+def test_failed_prefill_finishes_only_the_joining_requests(tiny_llama):
+    model, tokenizer = tiny_llama
+    engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=4)
+    forward = engine._forward
+
+    def failing_forward(input_ids, attention_mask, past_key_values=None):
+        # the prefill of the second request fails, the decode steps of the first one do not
+        if past_key_values is None and 999 in input_ids:
+            raise RuntimeError("CUDA out of memory")
+        return forward(input_ids, attention_mask, past_key_values)
+
+    engine._forward = failing_forward
+    engine.start()
+    running = engine.submit(tokenizer("Hello there")["input_ids"], SamplingParams(max_new_tokens=30, temperature=0))
+    while not running.output_ids:
+        running.wait(0.01)
+    failing = engine.submit([1, 999, 5], SamplingParams(max_new_tokens=5, temperature=0))
+
+    assert failing.wait(timeout=10)
+    assert failing.finish_reason == "error"
+    with pytest.raises(RuntimeError):
+        list(failing)
+    assert running.wait(timeout=30)
+    engine.stop()
+
+    assert running.finish_reason == "length"
+    assert len(running.output_ids) == 30
@@ -0,0 +1,59 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import json
+import subprocess
+import sys
+
+import pytest
+
+
+IMPORT_TIME_BUDGET_S = 1.0
+HEAVY_MODULES = ["torch", "transformers", "peft", "accelerate", "datasets", "yaml"]
+
+
+def import_in_subprocess(statement):
+    # a fresh interpreter, the test session already imported everything
+    code = f"""
+import json, sys, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"elapsed": elapsed, "loaded": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+"""
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_package_import_time():
+    result = import_in_subprocess(
+        "import llama_recipes.configs, llama_recipes.datasets, llama_recipes.policies, "
+        "llama_recipes.utils, llama_recipes.model_checkpointing"
+    )
+
+    assert result["loaded"] == []
+    assert result["elapsed"] < IMPORT_TIME_BUDGET_S
+
+
+@pytest.mark.parametrize(
+    "statement, unexpected",
+    [
+        ("from llama_recipes.configs import train_config", HEAVY_MODULES),
+        ("from llama_recipes.utils.config_utils import update_config", ["transformers", "peft", "accelerate", "datasets"]),
+        ("from llama_recipes.utils.dataset_utils import get_preprocessed_dataset", ["transformers", "peft", "accelerate", "datasets"]),
+        ("import llama_recipes.finetuning", ["transformers", "peft", "accelerate", "yaml"]),
+    ],
+)
+def test_heavy_dependencies_are_deferred(statement, unexpected):
+    result = import_in_subprocess(statement)
+
+    assert not set(result["loaded"]) & set(unexpected)
+
+
+def test_lazy_attributes():
+    from llama_recipes import policies, utils
+
+    assert "AnyPrecisionAdamW" in dir(policies)
+    assert utils.get_preprocessed_dataset.__module__ == "llama_recipes.utils.dataset_utils"
+    with pytest.raises(AttributeError):
+        utils.does_not_exist
@@ -0,0 +1,67 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import pytest
+
+import torch
+from torch.optim.lr_scheduler import StepLR
+
+from llama_recipes.policies import AnyPrecisionAdamW, OptimizerInBackward
+
+
+def make_model():
+    torch.manual_seed(42)
+    model = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.ReLU(), torch.nn.Linear(16, 4))
+    model[0].bias.requires_grad = False
+    return model
+
+
+def train(model, optimizer, steps=3):
+    torch.manual_seed(0)
+    for _ in range(steps):
+        loss = model(torch.randn(5, 8)).pow(2).mean()
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+
+@pytest.mark.parametrize("optimizer_class", [torch.optim.AdamW, AnyPrecisionAdamW])
+def test_optimizer_in_backward_matches_optimizer(optimizer_class):
+    kwargs = dict(lr=1e-2, weight_decay=0.01)
+
+    ref_model = make_model()
+    train(ref_model, optimizer_class([p for p in ref_model.parameters() if p.requires_grad], **kwargs))
+
+    model = make_model()
+    optimizer = OptimizerInBackward(model.parameters(), optimizer_class, **kwargs)
+    train(model, optimizer)
+
+    for ref, p in zip(ref_model.parameters(), model.parameters()):
+        assert torch.equal(ref, p)
+
+    # gradients are released right after the update
+    assert all(p.grad is None for p in model.parameters())
+    assert len(optimizer.state) == 3
+
+
+def test_optimizer_in_backward_lr_scheduler_and_state_dict():
+    model = make_model()
+    optimizer = OptimizerInBackward(model.parameters(), torch.optim.AdamW, lr=1e-2)
+    scheduler = StepLR(optimizer, step_size=1, gamma=0.5)
+
+    train(model, optimizer, steps=1)
+    scheduler.step()
+
+    assert all(o.param_groups[0]["lr"] == pytest.approx(5e-3) for o in optimizer.optimizers)
+
+    state_dict = optimizer.state_dict()
+    assert len(state_dict["state"]) == 3
+
+    model = make_model()
+    optimizer = OptimizerInBackward(model.parameters(), torch.optim.AdamW, lr=1e-2)
+    optimizer.load_state_dict(state_dict)
+
+    for o in optimizer.optimizers:
+        assert o.param_groups[0]["lr"] == pytest.approx(5e-3)
+        assert o.state is optimizer.state
+    assert optimizer.state[model[2].weight]["step"] == 1
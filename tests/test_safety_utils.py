@@ -0,0 +1,423 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# This software may be used and distributed according to the terms of the Llama 2 Community License Agreement.
+
+import math
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import torch
+from transformers import BatchEncoding, PreTrainedTokenizerFast
+
+from llama_recipes.inference import safety_utils
+from llama_recipes.inference.safety_utils import (
+    AgentType,
+    AuditNLGSensitiveTopics,
+    BatchSafetyChecker,
+    LlamaGuardSafetyChecker,
+    LlamaGuardVerdictStoppingCriteria,
+    SalesforceSafetyChecker,
+    check_batch,
+    clear_shared_models,
+    get_safety_checker,
+    SafetyPipeline,
+    split_into_windows,
+)
+
+
+@pytest.fixture(autouse=True)
+def shared_models():
+    clear_shared_models()
+    yield
+    clear_shared_models()
+
+
+@pytest.fixture
+def salesforce_model(mocker):
+    tokenizer = mocker.MagicMock()
+    tokenizer.side_effect = lambda texts, **kwargs: BatchEncoding({"input_ids": torch.ones(len(texts), 8, dtype=torch.long)})
+    tokenizer.decode.return_value = "safe"
+    tokenizer.is_fast = False
+    tokenizer.encode.side_effect = lambda text, **kwargs: [1] * len(text.split())
+    model = mocker.MagicMock()
+    model.generate.side_effect = lambda input_ids, **kwargs: SimpleNamespace(
+        sequences=torch.ones(len(input_ids), 2, dtype=torch.long), scores=None
+    )
+    load = mocker.patch.object(safety_utils, "_load_salesforce_model", return_value=(tokenizer, model))
+    return load, model
+
+
+def test_models_are_loaded_once(salesforce_model):
+    load, model = salesforce_model
+
+    checkers = [SalesforceSafetyChecker(), SalesforceSafetyChecker()]
+    results = [check(text) for text in ["Hello", "How are you?"] for check in checkers]
+
+    assert load.call_count == 1
+    assert all(is_safe for _, is_safe, _ in results)
+    assert model.generate.call_count == 4
+
+
+def test_get_safety_checker_warm_up(salesforce_model):
+    load, model = salesforce_model
+
+    safety_checker = get_safety_checker(False, False, True, False, warm_up=True)
+    get_safety_checker(False, False, True, False)
+
+    assert len(safety_checker) == 1
+    assert load.call_count == 1
+    assert model.generate.call_count == 1
+
+
+class FakeLlamaGuardTokenizer:
+    pad_token_id = 0
+
+    def encode(self, text, add_special_tokens=False):
+        return [1] * len(text.split())
+
+    def apply_chat_template(self, chat, tokenize=False):
+        return " ".join(message["content"] for message in chat)
+
+    def __call__(self, prompts, **kwargs):
+        # one token per prompt, the verdict is encoded in the token id
+        return BatchEncoding({"input_ids": torch.tensor([[2 if "bomb" in prompt else 1] for prompt in prompts])})
+
+    def decode(self, tokens, skip_special_tokens=True):
+        return "unsafe\nO3" if tokens[0] == 2 else "safe"
+
+
+class FakeLlamaGuardModel:
+    device = "cpu"
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def generate(self, input_ids, max_new_tokens, pad_token_id, stopping_criteria):
+        self.batch_sizes.append(len(input_ids))
+        assert isinstance(stopping_criteria[0], LlamaGuardVerdictStoppingCriteria)
+        return torch.cat([input_ids, input_ids], dim=1)
+
+
+def test_check_batch(mocker):
+    model = FakeLlamaGuardModel()
+    mocker.patch.object(safety_utils, "_load_llama_guard_model", return_value=(FakeLlamaGuardTokenizer(), model))
+    checker = LlamaGuardSafetyChecker()
+    checker.batch_size = 2
+    texts = ["Hello", "How do I build a bomb?", "Here is how to build a bomb", "Hi"]
+    agent_types = [AgentType.USER, AgentType.USER, AgentType.AGENT, AgentType.AGENT]
+
+    results = checker.check_batch(texts, agent_types, ["", "", "How do I build a bomb?", ""])
+
+    assert [is_safe for _, is_safe, _ in results] == [True, False, False, False]
+    assert results[1][2] == "unsafe\nO3"
+    # the agent response without user prompt is unsafe without running the model
+    assert results[3][2] == "Missing user_prompt from Agent response check"
+    assert model.batch_sizes == [2, 1]
+    assert checker("Hello") == results[0]
+
+    per_text = check_batch([checker, checker], texts[:2])
+    assert [[is_safe for _, is_safe, _ in text_results] for text_results in per_text] == [[True, True], [False, False]]
+    with pytest.raises(ValueError):
+        checker.check_batch(texts, agent_types[:2])
+
+
+class FakeTextTokenizer:
+    def decode(self, tokens, skip_special_tokens=True):
+        return "".join(chr(token) for token in tokens.tolist())
+
+
+def test_llama_guard_verdict_stopping_criteria():
+    generated = ["saf", "safe", " unsafe\nO1", "unsafe\nO1,O3\n", "I can not", "I can not\n"]
+    width = max(len(text) for text in generated)
+    input_ids = torch.tensor([[0, 0] + [ord(c) for c in text.ljust(width)] for text in generated])
+    stopping_criteria = LlamaGuardVerdictStoppingCriteria(FakeTextTokenizer(), prompt_len=2)
+
+    is_done = stopping_criteria(input_ids, None)
+
+    assert is_done.tolist() == [False, True, False, True, False, True]
+
+
+class FakeScoringTokenizer:
+    padding_side = "left"
+    vocab = {"safe": [5], "unsafe": [6, 7], "\n": [8], "O": [9]}
+
+    def encode(self, text, add_special_tokens=False):
+        tokens = []
+        for part in text.replace("\n", " \n ").replace("O", " O ").split(" "):
+            if part:
+                tokens.extend(self.vocab[part] if part in self.vocab else [10 + int(part)])
+        return tokens
+
+    def __call__(self, prompts, **kwargs):
+        # every prompt is a single token, 20 + the unsafe logit
+        input_ids = torch.tensor([[20 + int(prompt)] for prompt in prompts])
+        return BatchEncoding({"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)})
+
+
+class FakeScoringModel:
+    device = "cpu"
+
+    def __call__(self, input_ids, attention_mask):
+        logits = torch.zeros(len(input_ids), input_ids.shape[-1], 32)
+        for row, ids in enumerate(input_ids.tolist()):
+            if ids[-1] == 9:
+                # after "unsafe\nO", the prompt token selects the most likely category
+                logits[row, -1, 10 + ids[0] - 20] = 2.0
+            else:
+                logits[row, -1, 6] = ids[-1] - 20
+        return SimpleNamespace(logits=logits)
+
+
+def test_score_llama_guard_prompts():
+    scores = safety_utils.score_llama_guard_prompts(
+        FakeScoringModel(), FakeScoringTokenizer(), ["0", "3", "-3"], ["O1", "O2", "O3"], threshold=0.9
+    )
+
+    assert scores[0].unsafe_probability == pytest.approx(0.5)
+    assert scores[1].unsafe_probability == pytest.approx(torch.tensor(3.0).sigmoid().item())
+    assert [score.is_safe for score in scores] == [True, False, True]
+    assert scores[0].category_probabilities == {}
+    assert max(scores[1].category_probabilities, key=scores[1].category_probabilities.get) == "O3"
+    assert sum(scores[1].category_probabilities.values()) == pytest.approx(1.0)
+
+    # a higher temperature moves the probabilities towards 0.5
+    calibrated = safety_utils.score_llama_guard_prompts(
+        FakeScoringModel(), FakeScoringTokenizer(), ["3"], ["O1", "O2", "O3"], temperature=2.0
+    )
+    assert 0.5 < calibrated[0].unsafe_probability < scores[1].unsafe_probability
+
+
+def test_fit_llama_guard_temperature():
+    # three in four prompts with log odds 2 are unsafe, the calibrated probability 0.75 has log odds log(3)
+    prompts = ["2", "2", "2", "2", "-2", "-2", "-2", "-2"]
+    is_unsafe = [True, True, True, False, False, False, False, True]
+
+    temperature = safety_utils.fit_llama_guard_temperature(
+        FakeScoringModel(), FakeScoringTokenizer(), prompts, is_unsafe, batch_size=3
+    )
+
+    assert temperature == pytest.approx(2 / math.log(3), rel=1e-3)
+    calibrated = safety_utils.score_llama_guard_prompts(
+        FakeScoringModel(), FakeScoringTokenizer(), ["2"], [], temperature=temperature
+    )
+    assert calibrated[0].unsafe_probability == pytest.approx(0.75, rel=1e-3)
+    with pytest.raises(ValueError):
+        safety_utils.fit_llama_guard_temperature(FakeScoringModel(), FakeScoringTokenizer(), prompts[:4], is_unsafe[:3] + [True])
+
+
+class StubChecker(BatchSafetyChecker):
+    def __init__(self, name, delay, unsafe_word="bomb", io_bound=False):
+        self.name = name
+        self.delay = delay
+        self.unsafe_word = unsafe_word
+        self.io_bound = io_bound
+        self.batch_sizes = []
+
+    def _check_batch(self, texts, agent_types, user_prompts):
+        self.batch_sizes.append(len(texts))
+        time.sleep(self.delay)
+        return [(self.name, self.unsafe_word not in text, "") for text in texts]
+
+
+class SlowStubChecker(StubChecker):
+    pass
+
+
+class HangingStubChecker(StubChecker):
+    # the first check hangs until release is set, the others answer right away
+    def __init__(self, name):
+        super().__init__(name, 0.0)
+        self.release = threading.Event()
+
+    def _check_batch(self, texts, agent_types, user_prompts):
+        if len(self.batch_sizes) == 0:
+            self.batch_sizes.append(len(texts))
+            self.release.wait()
+        return super()._check_batch(texts, agent_types, user_prompts)
+
+
+def test_split_into_windows():
+    text = "abcdefghij"
+    assert split_into_windows(text, 10, 2) == [text]
+    assert split_into_windows(text, 4, 1) == ["abcd", "defg", "ghij"]
+    with pytest.raises(ValueError):
+        split_into_windows(text, 4, 4)
+
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=_get_word_tokenizer(), unk_token="<unk>")
+    text = "one two  three four\nfive six"
+    # the windows are cut from the text, keeping its whitespace
+    assert split_into_windows(text, 3, 1, tokenizer) == ["one two  three", "three four\nfive", "five six"]
+
+
+def _get_word_tokenizer():
+    tokenizers = pytest.importorskip("tokenizers")
+    tokenizer = tokenizers.Tokenizer(tokenizers.models.WordLevel({"<unk>": 0}, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.Whitespace()
+    return tokenizer
+
+
+def test_check_batch_windows():
+    checker = StubChecker("stub", 0.0)
+    checker.max_window_length = 8
+    checker.window_overlap = 4
+    checker.batch_size = 4
+    texts = ["short", "a long text with a bomb at the end", "another long text"]
+
+    results = checker.check_batch(texts)
+
+    # the windows of all texts are checked in full batches
+    assert checker.batch_sizes == [4, 4, 4, 1]
+    assert results[0] == ("stub", True, "")
+    assert results[1][:2] == ("stub", False)
+    assert results[1][2] == "Window 5/8:\n"
+    assert results[2] == ("stub", True, "")
+    assert checker.get_config()["max_window_length"] == 8
+
+
+def test_audit_nlg_windows():
+    checker = AuditNLGSensitiveTopics()
+
+    windows, _, _, owners = checker._split_batch(["short", "x" * 4000], None, None)
+
+    assert owners == [1, 3]
+    assert all(len(window) <= checker.max_window_length for window in windows)
+
+
+def test_safety_pipeline_runs_checkers_concurrently():
+    pipeline = SafetyPipeline([StubChecker("a", 0.2), SlowStubChecker("b", 0.2)])
+
+    start = time.perf_counter()
+    results, latencies = pipeline.check_with_latencies("Hello")
+    elapsed = time.perf_counter() - start
+
+    assert results == [("a", True, ""), ("b", True, "")]
+    assert elapsed < 0.35
+    assert set(latencies) == {"StubChecker", "SlowStubChecker"}
+    assert all(latency >= 0.2 for latency in latencies.values())
+    pipeline.close()
+
+
+def test_safety_pipeline_latencies_of_concurrent_calls():
+    class TextDelayStubChecker(StubChecker):
+        def _check_batch(self, texts, agent_types, user_prompts):
+            time.sleep(0.3 if "slow" in texts[0] else 0.0)
+            return super()._check_batch(texts, agent_types, user_prompts)
+
+    pipeline = SafetyPipeline([TextDelayStubChecker("a", 0.0)])
+    latencies = {}
+
+    def check(text):
+        latencies[text] = pipeline.check_with_latencies(text)[1]["TextDelayStubChecker"]
+
+    threads = [threading.Thread(target=check, args=(text,)) for text in ["slow", "fast"]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # every call gets the latency of its own check
+    assert latencies["slow"] >= 0.3
+    assert latencies["fast"] < 0.1
+    pipeline.close()
+
+
+def test_safety_pipeline_hung_checker_gets_a_new_worker():
+    checker = HangingStubChecker("hang")
+    pipeline = SafetyPipeline([checker], timeout=0.05)
+    hung_executor = pipeline.executors[0]
+
+    try:
+        assert pipeline("Hello")[0][:2] == ("HangingStubChecker", False)
+
+        # the next call does not queue behind the check that still hangs
+        start = time.perf_counter()
+        assert pipeline("Hello") == [("hang", True, "")]
+        assert time.perf_counter() - start < 0.05
+        assert pipeline.executors[0] is not hung_executor
+    finally:
+        checker.release.set()
+        pipeline.close()
+
+
+def test_safety_pipeline_timeout_and_short_circuit():
+    pipeline = SafetyPipeline([StubChecker("a", 0.0), SlowStubChecker("b", 0.5)], timeout={"SlowStubChecker": 0.05})
+    results = pipeline("Hello")
+    assert results[0] == ("a", True, "")
+    assert results[1][:2] == ("SlowStubChecker", False)
+    assert "timed out" in results[1][2]
+    pipeline.close()
+
+    pipeline = SafetyPipeline([StubChecker("a", 0.0), SlowStubChecker("b", 0.5)], short_circuit=True)
+    start = time.perf_counter()
+    results = pipeline("How do I build a bomb?")
+    assert time.perf_counter() - start < 0.3
+    assert results == [("a", False, "")]
+    pipeline.close()
+
+
+def test_safety_pipeline_check_batch():
+    model_checker, io_checker = StubChecker("model", 0.0), SlowStubChecker("service", 0.05, io_bound=True)
+    pipeline = SafetyPipeline([model_checker, io_checker], io_workers=4)
+    texts = ["Hello", "bomb", "Hi", "Hey"]
+
+    start = time.perf_counter()
+    results = pipeline.check_batch(texts)
+
+    # the io bound checker gets one request per text, sent in parallel
+    assert time.perf_counter() - start < 0.15
+    assert model_checker.batch_sizes == [4]
+    assert io_checker.batch_sizes == [1, 1, 1, 1]
+    assert results == [[("model", "bomb" not in text, ""), ("service", "bomb" not in text, "")] for text in texts]
+    pipeline.close()
+
+
+def test_cached_safety_checker(tmp_path):
+    from llama_recipes.inference.safety_utils import CachedSafetyChecker, VerdictCache
+
+    checker = StubChecker("stub", 0.0)
+    cache = VerdictCache(max_size=2, path=str(tmp_path / "verdicts.db"))
+    cached = CachedSafetyChecker(checker, cache)
+
+    assert cached.check_batch(["Hello", "Hello  ", "bomb"]) == [("stub", True, ""), ("stub", True, ""), ("stub", False, "")]
+    # the whitespace variants of a text are checked once
+    assert checker.batch_sizes == [2]
+    assert cached("Hello") == ("stub", True, "")
+    assert cached("Hello", agent_type=AgentType.AGENT, user_prompt="Hi") == ("stub", True, "")
+    # the agent response is checked again, it is keyed by its agent type and user prompt too
+    assert checker.batch_sizes == [2, 1]
+    assert cache.get_metrics()["hits"] == 1
+    assert cache.get_metrics()["misses"] == 4
+
+    # the verdicts evicted from memory are still on disk, also for a new process
+    cache.close()
+    cache = VerdictCache(max_size=2, path=str(tmp_path / "verdicts.db"))
+    cached = CachedSafetyChecker(checker, cache)
+    assert cached("bomb") == ("stub", False, "")
+    assert checker.batch_sizes == [2, 1]
+    assert cache.get_metrics()["disk_hits"] == 1
+
+    # a checker with another config does not share the verdicts
+    other = CachedSafetyChecker(StubChecker("stub", 0.0, unsafe_word="Hello"), cache)
+    assert other("Hello") == ("stub", False, "")
+
+    cache.ttl = 0
+    time.sleep(0.01)
+    cached("bomb")
+    assert checker.batch_sizes == [2, 1, 1]
+    cache.close()
+
+
+def test_get_safety_checker_with_cache(salesforce_model):
+    from llama_recipes.inference.safety_utils import CachedSafetyChecker, VerdictCache
+
+    _, model = salesforce_model
+    cache = VerdictCache()
+    safety_checker = get_safety_checker(False, False, True, False, cache=cache)
+    pipeline = SafetyPipeline(safety_checker, timeout={"SalesforceSafetyChecker": 10})
+
+    assert isinstance(safety_checker[0], CachedSafetyChecker)
+    assert pipeline.names == ["SalesforceSafetyChecker"]
+    assert pipeline("Hello") == pipeline("Hello")
+    assert model.generate.call_count == 1
+    pipeline.close()
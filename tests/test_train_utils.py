@@ -45,6 +45,7 @@ def test_gradient_accumulation(autocast, scaler, nullcontext, mem_trace, mocker)
     train_config.run_validation = False
     train_config.gradient_clipping = False
     train_config.max_train_step = 0
+    train_config.resume_training_state = False
     train_config.max_eval_step = 0
     train_config.save_metrics = False
 
@@ -101,6 +102,7 @@ def test_save_to_json(temp_output_dir, mocker):
     train_config.gradient_clipping = False
     train_config.save_metrics = True
     train_config.max_train_step = 0
+    train_config.resume_training_state = False
     train_config.max_eval_step = 0
     train_config.output_dir = temp_output_dir
 
@@ -118,3 +120,154 @@ def test_save_to_json(temp_output_dir, mocker):
 
     assert results["metrics_filename"] not in ["", None]
     assert os.path.isfile(results["metrics_filename"])
+
+
+@patch("llama_recipes.utils.train_utils.get_grad_reduce_bytes")
+@patch("llama_recipes.utils.train_utils.MemoryTrace")
+def test_gradient_accumulation_no_sync(mem_trace, get_grad_reduce_bytes, mocker):
+    get_grad_reduce_bytes.return_value = 1024
+    mocker.patch.dict(os.environ, {"WORLD_SIZE": "1"})
+
+    model = mocker.MagicMock(name="model")
+    model().loss.__truediv__().detach.return_value = torch.tensor(1)
+    mock_tensor = mocker.MagicMock(name="tensor")
+    batch = {"input": mock_tensor}
+    train_dataloader = [batch, batch, batch, batch, batch]
+    eval_dataloader = None
+    tokenizer = mocker.MagicMock()
+    optimizer = mocker.MagicMock()
+    lr_scheduler = mocker.MagicMock()
+    gradient_accumulation_steps = 2
+    train_config = mocker.MagicMock()
+    train_config.enable_fsdp = True
+    train_config.use_peft = True
+    train_config.use_fp16 = False
+    train_config.run_validation = False
+    train_config.gradient_clipping = False
+    train_config.max_train_step = 0
+    train_config.resume_training_state = False
+    train_config.max_eval_step = 0
+    train_config.save_metrics = False
+    fsdp_config = mocker.MagicMock()
+    fsdp_config.gradient_accumulation_mode = "communication"
+
+    results = train(
+        model,
+        train_dataloader,
+        eval_dataloader,
+        tokenizer,
+        optimizer,
+        lr_scheduler,
+        gradient_accumulation_steps,
+        train_config,
+        fsdp_config,
+        local_rank=0,
+        rank=0,
+    )
+
+    # micro steps 0 and 2 accumulate, 1, 3 and the last batch sync the gradients
+    assert model.no_sync.call_count == 2
+    assert optimizer.step.call_count == 3
+    assert results["grad_sync_bytes_saved_per_step"] == 1024
+
+    model.no_sync.reset_mock()
+    fsdp_config.gradient_accumulation_mode = "memory"
+    results = train(
+        model,
+        train_dataloader,
+        eval_dataloader,
+        tokenizer,
+        optimizer,
+        lr_scheduler,
+        gradient_accumulation_steps,
+        train_config,
+        fsdp_config,
+        local_rank=0,
+        rank=0,
+    )
+
+    assert model.no_sync.call_count == 0
+    assert "grad_sync_bytes_saved_per_step" not in results
+
+
+@patch("llama_recipes.utils.train_utils.MemoryTrace")
+def test_compile_time_reporting(mem_trace, mocker):
+    from torch._dynamo.utils import counters
+
+    def forward(**kwargs):
+        # the first step compiles a new graph
+        if not compiled:
+            counters["stats"]["unique_graphs"] += 1
+            compiled.append(True)
+        return output
+
+    compiled = []
+    output = mocker.MagicMock()
+    output.loss.__truediv__().detach.return_value = torch.tensor(1)
+    model = mocker.MagicMock(name="model", side_effect=forward)
+    mock_tensor = mocker.MagicMock(name="tensor")
+    batch = {"input": mock_tensor}
+    train_dataloader = [batch, batch, batch, batch, batch]
+    train_config = mocker.MagicMock()
+    train_config.enable_fsdp = False
+    train_config.use_fp16 = False
+    train_config.run_validation = False
+    train_config.gradient_clipping = False
+    train_config.max_train_step = 0
+    train_config.resume_training_state = False
+    train_config.max_eval_step = 0
+    train_config.save_metrics = False
+    train_config.compile = True
+
+    results = train(
+        model,
+        train_dataloader,
+        None,
+        mocker.MagicMock(),
+        mocker.MagicMock(),
+        mocker.MagicMock(),
+        1,
+        train_config,
+    )
+
+    assert "compile_time" in results
+    assert results["avg_step_time"] > 0
+
+
+class EpochDataLoader(list):
+    def __init__(self, batches, dataset):
+        super().__init__(batches)
+        self.dataset = dataset
+
+
+@pytest.mark.parametrize("resume", [False, True])
+@patch("llama_recipes.utils.train_utils.MemoryTrace")
+def test_set_epoch_and_resume(mem_trace, mocker, resume):
+    model = mocker.MagicMock(name="model")
+    model().loss.__truediv__().detach.return_value = torch.tensor(1)
+    dataset = mocker.MagicMock(name="dataset")
+    train_dataloader = EpochDataLoader([{"input": mocker.MagicMock(name="tensor")}] * 2, dataset)
+    lr_scheduler = mocker.MagicMock()
+    train_config = mocker.MagicMock()
+    train_config.enable_fsdp = False
+    train_config.use_fp16 = False
+    train_config.run_validation = False
+    train_config.gradient_clipping = False
+    train_config.max_train_step = 0
+    train_config.max_eval_step = 0
+    train_config.save_metrics = False
+    train_config.compile = False
+    train_config.num_epochs = 3
+    train_config.resume_training_state = resume
+    load_training_state = mocker.patch("llama_recipes.utils.train_utils.load_training_state", return_value=0)
+
+    train(model, train_dataloader, None, mocker.MagicMock(), mocker.MagicMock(), lr_scheduler, 1, train_config)
+
+    if resume:
+        # the checkpoint was saved after the first epoch
+        load_training_state.assert_called_once_with(dataset, train_config)
+        assert [c.args for c in dataset.set_epoch.call_args_list] == [(1,), (2,)]
+    else:
+        load_training_state.assert_not_called()
+        assert [c.args for c in dataset.set_epoch.call_args_list] == [(0,), (1,), (2,)]
+    assert lr_scheduler.step.call_count == 3